@@ -0,0 +1,102 @@
+"""
+Benchmark of the durability of sandboxes (/create/ "durability").
+Creates two sandboxes from the file, with logged and unlogged tables,
+runs the same submission of a data modifying task in each of them
+and prints the time of the submissions and the amount of written WAL.
+
+Usage (from the directory src, the database is configured by PSQL_* env):
+    python ../scripts/benchmark_durability.py test.sql \
+        --code "UPDATE tasks_solution SET score = score + 1" \
+        --check "SELECT 1" --runs 50
+"""
+
+import time
+import argparse
+from statistics import median
+from app.entities import TestingData, TestData
+from app.service.main import PostgresqlService
+from app.service.enums import SQLCommandType, Durability
+from app.service.pool import pools
+
+
+def get_wal_lsn() -> int:
+    with pools.connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_current_wal_lsn() - '0/0'::pg_lsn"
+            )
+            return int(cursor.fetchone()[0])
+
+
+def run(name: str, args: argparse.Namespace) -> dict:
+    times = []
+    # проверка DELETE - запрос, INSERT/UPDATE - количество строк и запрос
+    check_code = args.check
+    if args.request_type != SQLCommandType.DELETE:
+        check_code = f'0\n{args.check}'
+    wal_lsn = get_wal_lsn()
+    for _ in range(args.runs):
+        data = TestingData(
+            name=name,
+            code=args.code,
+            request_type=args.request_type,
+            tests=[
+                TestData(data_in=check_code)
+                for _ in range(args.tests)
+            ]
+        )
+        started = time.perf_counter()
+        PostgresqlService.testing(data)
+        times.append(time.perf_counter() - started)
+        errors = {test.error for test in data.tests if test.error}
+        if errors:
+            raise SystemExit(f'{name}: {errors}')
+    return {
+        'median_ms': median(times) * 1000,
+        'total_s': sum(times),
+        'wal_bytes': get_wal_lsn() - wal_lsn,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('filename', help='file from the directory /files')
+    parser.add_argument('--code', required=True, help='submission')
+    parser.add_argument('--check', default='SELECT 1', help='check query')
+    parser.add_argument(
+        '--request-type',
+        default=SQLCommandType.UPDATE,
+        choices=(
+            SQLCommandType.INSERT,
+            SQLCommandType.UPDATE,
+            SQLCommandType.DELETE
+        )
+    )
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--tests', type=int, default=5)
+    args = parser.parse_args()
+
+    for durability in Durability.VALUES:
+        name = f'benchmark_{durability}'
+        started = time.perf_counter()
+        PostgresqlService.create(
+            name=name,
+            filename=args.filename,
+            force=True,
+            durability=durability
+        )
+        created = time.perf_counter() - started
+        # первый прогон прогревает кэши
+        run(name, args)
+        result = run(name, args)
+        print(
+            f'{durability:>10}: create {created:.2f}s, '
+            f'submission median {result["median_ms"]:.1f}ms, '
+            f'total {result["total_s"]:.2f}s, '
+            f'WAL {result["wal_bytes"] / 1024:.0f}kB'
+        )
+        PostgresqlService.delete(name)
+
+
+if __name__ == '__main__':
+    main()
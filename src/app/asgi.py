@@ -0,0 +1,352 @@
+"""
+ASGI version of the application, see app.main.
+Database queries are executed asynchronously by AsyncPostgresqlService,
+so one worker serves many slow queries concurrently.
+Run with: hypercorn app.asgi:app
+"""
+
+from typing import AsyncIterator, Callable
+from functools import wraps
+from contextlib import AsyncExitStack
+from quart import (
+    Quart,
+    Response,
+    request,
+    render_template,
+    abort,
+    current_app,
+    stream_with_context,
+    g,
+)
+from quart.wrappers.response import IterableBody
+from marshmallow import ValidationError
+from app.entities import DebugData, TestingBatchData
+from app.service.aio import AsyncPostgresqlService, async_pools
+from app.service.enums import DebugFormat
+from app.schema import (
+    DebugSchema,
+    TestingSchema,
+    TestingBatchSchema,
+    CreateSchema,
+    BulkCreateSchema,
+    BulkDeleteSchema,
+    JobSchema,
+    LeaseSchema,
+    StatusSchema,
+    StatsSchema,
+    BadRequestSchema,
+    ServiceExceptionSchema
+)
+from app.service.scheduler import async_scheduler
+from app.service.exceptions import (
+    ServiceException,
+    QueueFullException,
+    JobNotFound,
+)
+
+
+def scheduled(kind: str) -> Callable:
+
+    """ see app.main.scheduled """
+
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            name = kwargs.get('name')
+            if name is None:
+                data = await request.get_json(silent=True)
+                if isinstance(data, dict):
+                    name = data.get('name')
+            try:
+                async with AsyncExitStack() as g.slot:
+                    await g.slot.enter_async_context(
+                        async_scheduler.slot(kind, name)
+                    )
+                    return await view(*args, **kwargs)
+            except QueueFullException as ex:
+                abort(429, ex)
+        return wrapper
+    return decorator
+
+
+class SlotBody(IterableBody):
+
+    """
+    Body of the streaming response, releases the slot of the scheduler
+    when the response is closed, even if the stream has not been started
+    (the client disconnected before the first chunk)
+    """
+
+    def __init__(self, iterable: AsyncIterator[str], slot: AsyncExitStack):
+        super().__init__(iterable)
+        self.slot = slot
+
+    async def __aexit__(self, *args):
+        try:
+            await super().__aexit__(*args)
+        finally:
+            await self.slot.aclose()
+
+
+async def stream_debug(
+    data: DebugData,
+    slot: AsyncExitStack
+) -> AsyncIterator[str]:
+
+    """ see app.main.stream_debug """
+
+    async with slot:
+        yield '{"result": ['
+        num = 0
+        try:
+            async for row in AsyncPostgresqlService.debug_rows(data):
+                yield (', ' if num else '') + current_app.json.dumps(row)
+                num += 1
+        except ServiceException as ex:
+            data.error = ex.message
+        tail = DebugSchema(only=('error', 'truncated')).dump(data)
+        yield '], ' + current_app.json.dumps(tail)[1:]
+
+
+async def stream_testing_batch(
+    data: TestingBatchData,
+    slot: AsyncExitStack
+) -> AsyncIterator[str]:
+
+    """ see app.main.stream_testing_batch """
+
+    async with slot:
+        yield '{"results": ['
+        schema = TestingSchema()
+        error = None
+        num = 0
+        try:
+            async for result in AsyncPostgresqlService.testing_batch(data):
+                yield (', ' if num else '') + current_app.json.dumps(
+                    schema.dump(result)
+                )
+                num += 1
+        except ServiceException as ex:
+            error = ex.message
+        yield '], "error": ' + current_app.json.dumps(error) + '}'
+
+
+def create_app():
+    app = Quart(__name__)
+
+    @app.errorhandler(400)
+    async def bad_request_handler(ex: ValidationError):
+        return BadRequestSchema().dump(ex), 400
+
+    @app.errorhandler(404)
+    async def not_found_handler(ex: ServiceException):
+        return ServiceExceptionSchema().dump(ex), 404
+
+    @app.errorhandler(500)
+    async def bad_request_handler(ex: ServiceException):
+        return ServiceExceptionSchema().dump(ex), 500
+
+    @app.errorhandler(429)
+    async def too_many_requests_handler(ex: QueueFullException):
+        return (
+            ServiceExceptionSchema().dump(ex),
+            429,
+            {'Retry-After': str(ex.description.retry_after)}
+        )
+
+    @app.before_serving
+    async def start_eviction():
+        AsyncPostgresqlService.start_eviction()
+        AsyncPostgresqlService.start_leases()
+
+    @app.after_serving
+    async def close_pools():
+        await async_pools.close()
+
+    @app.route('/', methods=['get'])
+    async def index():
+        return await render_template("index.html")
+
+    @app.route('/status/', methods=['get'])
+    @scheduled('status')
+    async def status():
+        try:
+            data = await AsyncPostgresqlService.status_all()
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return StatusSchema().dumps(data, many=True)
+
+    @app.route('/status/<name>/', methods=['get'])
+    @scheduled('status')
+    async def status_name(name):
+        try:
+            data = await AsyncPostgresqlService.status(name)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return StatusSchema().dump(data)
+
+    @app.route('/stats/', methods=['get'])
+    async def stats():
+        return StatsSchema().dump(await AsyncPostgresqlService.stats())
+
+    @app.route('/create/', methods=['post'])
+    @scheduled('create')
+    async def create():
+        schema = CreateSchema()
+        try:
+            data = schema.load(await request.get_json())
+            job = await AsyncPostgresqlService.create_job(data)
+            if data.wait:
+                job = await AsyncPostgresqlService.wait_job(job.id)
+        except ValidationError as ex:
+            abort(400, ex)
+        except QueueFullException:
+            raise
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return JobSchema().dump(job), 200 if data.wait else 202
+
+    @app.route('/jobs/<job_id>/', methods=['get'])
+    async def job(job_id):
+        try:
+            data = AsyncPostgresqlService.get_job(job_id)
+        except JobNotFound as ex:
+            abort(404, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return JobSchema().dump(data)
+
+    @app.route('/create/bulk/', methods=['post'])
+    @scheduled('create')
+    async def create_bulk():
+        schema = BulkCreateSchema()
+        try:
+            data = await AsyncPostgresqlService.create_bulk(
+                schema.load(await request.get_json())
+            )
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/delete/bulk/', methods=['post'])
+    @scheduled('delete')
+    async def delete_bulk():
+        schema = BulkDeleteSchema()
+        try:
+            data = await AsyncPostgresqlService.delete_bulk(
+                schema.load(await request.get_json())
+            )
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/delete/<name>/', methods=['post'])
+    @scheduled('delete')
+    async def delete(name):
+        try:
+            await AsyncPostgresqlService.delete(name)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return ''
+
+    @app.route('/lease/', methods=['post'])
+    @scheduled('lease')
+    async def lease():
+        schema = LeaseSchema()
+        try:
+            data = schema.load(await request.get_json())
+            data = await AsyncPostgresqlService.lease(data.name, data.ttl)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/release/<name>/', methods=['post'])
+    @scheduled('delete')
+    async def release(name):
+        try:
+            await AsyncPostgresqlService.release(name)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return ''
+
+    @app.route('/debug/', methods=['post'])
+    @scheduled('debug')
+    async def debug():
+        schema = DebugSchema()
+        try:
+            data = schema.load(await request.get_json())
+            if data.stream and data.format == DebugFormat.ARRAY:
+                slot = g.slot.pop_all()
+                return Response(
+                    SlotBody(
+                        stream_with_context(stream_debug)(data, slot),
+                        slot
+                    ),
+                    mimetype='application/json'
+                )
+            data = await AsyncPostgresqlService.debug(data)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/testing/', methods=['post'])
+    @scheduled('testing')
+    async def testing():
+        schema = TestingSchema()
+        try:
+            data = await AsyncPostgresqlService.testing(
+                schema.load(await request.get_json())
+            )
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/testing/batch/', methods=['post'])
+    @scheduled('testing')
+    async def testing_batch():
+        try:
+            data = TestingBatchSchema().load(await request.get_json())
+        except ValidationError as ex:
+            abort(400, ex)
+        slot = g.slot.pop_all()
+        return Response(
+            SlotBody(
+                stream_with_context(stream_testing_batch)(data, slot),
+                slot
+            ),
+            mimetype='application/json'
+        )
+
+    return app
+
+
+app = create_app()
@@ -1,4 +1,4 @@
-from os import environ as env
+from os import environ as env, cpu_count
 from psycopg2.extras import LoggingConnection
 from psycopg2.extensions import connection
 
@@ -17,6 +17,181 @@ PSQL_CONFIG = {
     'connection_factory': LoggingConnection if DEBUG else connection
 }
 
+# Пулы соединений, создаются отдельно для каждой базы песочницы
+# минимальное количество соединений, которые не закрываются при простое
+PSQL_POOL_MIN_SIZE = int(env.get('PSQL_POOL_MIN_SIZE', 1))
+# максимальное количество открытых соединений к одной базе
+PSQL_POOL_MAX_SIZE = int(env.get('PSQL_POOL_MAX_SIZE', 5))
+# время ожидания свободного соединения (сек.)
+PSQL_POOL_TIMEOUT = float(env.get('PSQL_POOL_TIMEOUT', 30))
+# время простоя (сек.), после которого соединение сверх минимума закрывается
+PSQL_POOL_MAX_IDLE = float(env.get('PSQL_POOL_MAX_IDLE', 300))
+# время простоя (сек.), после которого соединение проверяется запросом
+PSQL_POOL_PING_INTERVAL = float(env.get('PSQL_POOL_PING_INTERVAL', 30))
+
+# Ограничения результата отладки запроса (/debug/), строки сверх
+# ограничений не загружаются с сервера, результат помечается как неполный
+DEBUG_MAX_ROWS = int(env.get('DEBUG_MAX_ROWS', 10000))
+DEBUG_MAX_BYTES = int(env.get('DEBUG_MAX_BYTES', 16 * 1024 * 1024))
+# количество строк, загружаемых с сервера за один запрос
+DEBUG_FETCH_SIZE = int(env.get('DEBUG_FETCH_SIZE', 500))
+
+# Кэш отпечатков результатов эталонных запросов SELECT-задач
+# размер кэша в байтах
+REFERENCE_CACHE_MAX_BYTES = int(
+    env.get('REFERENCE_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+)
+# время жизни записи (сек.), ограничивает устаревание результатов
+# запросов, зависящих от текущего времени
+REFERENCE_CACHE_TTL = float(env.get('REFERENCE_CACHE_TTL', 3600))
+# Кэш оценок планировщика запросов пользователей
+PLAN_CACHE_MAX_BYTES = int(env.get('PLAN_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+PLAN_CACHE_TTL = float(env.get('PLAN_CACHE_TTL', 3600))
+# Кэш вердиктов /testing/: результаты тестов одинаковых (после нормализации)
+# запросов к одной версии песочницы возвращаются без выполнения
+VERDICT_CACHE_MAX_BYTES = int(
+    env.get('VERDICT_CACHE_MAX_BYTES', 8 * 1024 * 1024)
+)
+VERDICT_CACHE_TTL = float(env.get('VERDICT_CACHE_TTL', 3600))
+# Кэш результатов /debug/ запросов только на чтение, общий для процессов
+# сервера: файл базы SQLite, пустое значение - кэш отключен.
+# Каталог файла должен принадлежать пользователю сервера и быть закрыт
+# на запись для остальных, иначе кэш не используется
+DEBUG_CACHE_PATH = env.get(
+    'DEBUG_CACHE_PATH', '/tmp/sandbox_cache/debug.sqlite3'
+)
+DEBUG_CACHE_MAX_BYTES = int(env.get('DEBUG_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+DEBUG_CACHE_TTL = float(env.get('DEBUG_CACHE_TTL', 3600))
+
+# Ограничения ресурсов запросов в базах песочниц, устанавливаются
+# в начале каждой транзакции и могут быть переопределены для песочницы
+# при ее создании, пустое значение - ограничение не устанавливается
+SANDBOX_LIMITS = {
+    'statement_timeout': env.get('SANDBOX_STATEMENT_TIMEOUT', '10s'),
+    'lock_timeout': env.get('SANDBOX_LOCK_TIMEOUT', '5s'),
+    'work_mem': env.get('SANDBOX_WORK_MEM', '32MB'),
+    # требует прав суперпользователя (или GRANT SET для PostgreSQL >= 15)
+    'temp_file_limit': env.get('SANDBOX_TEMP_FILE_LIMIT', '1GB'),
+    # ограничения оценки планировщика (EXPLAIN) для запросов пользователя,
+    # запрос с большей оценкой стоимости или количества строк не выполняется
+    'sandbox.max_cost': env.get('SANDBOX_MAX_COST', '1e8'),
+    'sandbox.max_rows': env.get('SANDBOX_MAX_ROWS', '1e8'),
+}
+
+# Планировщик запросов к базам песочниц, ограничения очереди
+# и одновременных запросов действуют в пределах одного процесса,
+# поэтому воркеры gunicorn должны быть многопоточными (gthread, см. start.sh)
+# максимальное количество одновременно выполняемых запросов процесса
+SCHEDULER_MAX_ACTIVE = int(env.get('SCHEDULER_MAX_ACTIVE', 8))
+# максимальное количество одновременно выполняемых запросов к одной песочнице
+SCHEDULER_MAX_ACTIVE_PER_SANDBOX = int(
+    env.get('SCHEDULER_MAX_ACTIVE_PER_SANDBOX', 4)
+)
+# размер очереди ожидания, при заполнении запросы отклоняются с кодом 429
+SCHEDULER_MAX_QUEUE = int(env.get('SCHEDULER_MAX_QUEUE', 32))
+# максимальное время ожидания в очереди (сек.)
+SCHEDULER_QUEUE_TIMEOUT = float(env.get('SCHEDULER_QUEUE_TIMEOUT', 30))
+# максимальное количество одновременно выполняемых запросов всех процессов
+# сервера, общие слоты - advisory-блокировки в основной базе, 0 - общие
+# слоты не используются. Запрос ожидает общий слот не дольше
+# SCHEDULER_QUEUE_TIMEOUT с начала ожидания в очереди
+SCHEDULER_MAX_ACTIVE_TOTAL = int(env.get('SCHEDULER_MAX_ACTIVE_TOTAL', 16))
+# период (сек.) попыток занять общий слот
+SCHEDULER_SHARED_POLL_INTERVAL = float(
+    env.get('SCHEDULER_SHARED_POLL_INTERVAL', 0.05)
+)
+# приоритеты типов запросов, от высшего к низшему
+SCHEDULER_PRIORITIES = env.get(
+    'SCHEDULER_PRIORITIES', 'testing,debug,status,lease,create,delete'
+).split(',')
+
+# Параллельное выполнение тестов одной посылки (/testing/)
+# режим по умолчанию, если он не указан в запросе
+TESTING_PARALLEL = env.get('TESTING_PARALLEL', 'false') == 'true'
+# максимальное количество соединений для тестов одной посылки
+TESTING_PARALLEL_WORKERS = int(env.get('TESTING_PARALLEL_WORKERS', 4))
+# максимальное количество дополнительных потоков для тестов всех посылок,
+# при их нехватке тесты выполняются в меньшем количестве соединений
+TESTING_MAX_WORKERS = int(env.get('TESTING_MAX_WORKERS', 16))
+
+# Загрузка .sql файлов в базы данных
+# объем команд (байт), отправляемых на сервер одним запросом
+LOADER_BATCH_SIZE = int(env.get('LOADER_BATCH_SIZE', 1024 * 1024))
+# размер блока данных (байт) секций COPY ... FROM stdin
+LOADER_COPY_BUFFER = int(env.get('LOADER_COPY_BUFFER', 1024 * 1024))
+# шаг (байт) сообщений о ходе загрузки
+LOADER_PROGRESS_STEP = int(env.get('LOADER_PROGRESS_STEP', 16 * 1024 * 1024))
+# память для построения индексов после загрузки данных
+LOADER_MAINTENANCE_WORK_MEM = env.get('LOADER_MAINTENANCE_WORK_MEM', '256MB')
+
+# Восстановление баз из архивов pg_dump
+# количество параллельных процессов pg_restore/pg_dump
+RESTORE_JOBS = int(env.get('RESTORE_JOBS', cpu_count() or 1))
+# директория (доступная для записи) для архивов, в которые компилируются
+# .sql файлы после первой загрузки, пустое значение - архивы не создаются
+ARCHIVE_DIR = env.get('ARCHIVE_DIR', '')
+
+# Подготовка баз песочниц к первым запросам
+# VACUUM (FREEZE, ANALYZE) шаблона после загрузки: статистика планировщика,
+# биты-подсказки и карты видимости наследуются базами песочниц
+WARMUP_VACUUM = env.get('WARMUP_VACUUM', 'true') == 'true'
+# объем (байт) таблиц и индексов, загружаемых в shared_buffers
+# после создания песочницы, 0 - не загружаются
+WARMUP_PREWARM_MAX_BYTES = int(
+    env.get('WARMUP_PREWARM_MAX_BYTES', 64 * 1024 * 1024)
+)
+
+# Реестр песочниц, статусы песочниц возвращаются из памяти процесса
+# период (сек.) сверки реестра с pg_database
+REGISTRY_REFRESH_INTERVAL = float(env.get('REGISTRY_REFRESH_INTERVAL', 30))
+
+# Вытеснение давно не используемых песочниц, вытесненная песочница
+# создается заново из своего файла при следующем обращении к ней
+# суммарный размер (байт) баз песочниц, при превышении которого
+# вытесняются давно не используемые песочницы, 0 - вытеснение отключено
+EVICTION_DISK_BUDGET = int(env.get('EVICTION_DISK_BUDGET', 0))
+# период (сек.) проверки размера баз песочниц
+EVICTION_INTERVAL = float(env.get('EVICTION_INTERVAL', 60))
+# время (сек.) с последнего обращения, до истечения которого
+# песочница не вытесняется
+EVICTION_MIN_IDLE = float(env.get('EVICTION_MIN_IDLE', 3600))
+
+# Фоновое создание песочниц (/create/ возвращает задание, /jobs/<id>/)
+# количество одновременно выполняемых заданий
+JOBS_WORKERS = int(env.get('JOBS_WORKERS', 2))
+# максимальное количество ожидающих заданий, при превышении
+# запросы отклоняются с кодом 429
+JOBS_MAX_QUEUE = int(env.get('JOBS_MAX_QUEUE', 32))
+# время (сек.) хранения завершенных заданий
+JOBS_TTL = float(env.get('JOBS_TTL', 3600))
+# состояния заданий, общие для процессов сервера (см. DEBUG_CACHE_PATH),
+# задание запрашивается из любого процесса, пустое значение - состояния
+# доступны только в процессе, создавшем задание
+JOBS_STORE_PATH = env.get('JOBS_STORE_PATH', '/tmp/sandbox_cache/jobs.sqlite3')
+JOBS_STORE_MAX_BYTES = int(env.get('JOBS_STORE_MAX_BYTES', 16 * 1024 * 1024))
+
+# Массовое создание и удаление песочниц (/create/bulk/, /delete/bulk/)
+# количество одновременно загружаемых файлов (загрузка нагружает диск сервера)
+BULK_LOAD_WORKERS = int(env.get('BULK_LOAD_WORKERS', 2))
+# количество одновременно создаваемых или удаляемых песочниц,
+# каждая создаваемая песочница занимает соединение из пула
+# основной базы (PSQL_POOL_MAX_SIZE)
+BULK_WORKERS = int(env.get('BULK_WORKERS', 3))
+
+# Аренда копий песочниц: сеанс получает собственную копию песочницы,
+# изменения в которой сохраняются между запросами
+# количество готовых копий каждой арендуемой песочницы,
+# создаваемых заранее в фоне
+LEASE_POOL_SIZE = int(env.get('LEASE_POOL_SIZE', 2))
+# срок аренды (сек.) по умолчанию
+LEASE_TTL = int(env.get('LEASE_TTL', 1800))
+# максимальный срок аренды (сек.), готовые копии удаляются по его истечении
+LEASE_MAX_TTL = int(env.get('LEASE_MAX_TTL', 4 * 3600))
+# период (сек.) удаления копий с истекшим сроком аренды
+LEASE_INTERVAL = float(env.get('LEASE_INTERVAL', 30))
+# количество потоков, создающих и удаляющих копии в фоне
+LEASE_WORKERS = int(env.get('LEASE_WORKERS', 2))
+
 # Директория внутри контейнера с приложением
 # где хранятся .sql файлы создаваемых баз
 SQL_FILES_DIR = '/files'
@@ -2,6 +2,8 @@ from typing import Optional, List
 from dataclasses import dataclass
 from app.service.enums import SQLCommandType
 from app.service.enums import DebugFormat
+from app.service.enums import Durability
+from app.service.enums import JobStatus
 
 
 @dataclass
@@ -11,6 +13,8 @@ class DebugData:
     name: Optional[str] = None
     code: Optional[str] = None
     format: DebugFormat = None
+    truncated: bool = False
+    stream: bool = False
 
 
 @dataclass
@@ -20,6 +24,7 @@ class TestData:
     data_in: Optional[str] = None
     error: Optional[str] = None
     ok: Optional[bool] = None
+    duration: Optional[float] = None
 
 
 @dataclass
@@ -33,15 +38,128 @@ class TestingData:
     name: Optional[str] = None
     check_code: Optional[str] = None
     request_type: Optional[SQLCommandType] = None
+    ordered: bool = False
+    parallel: bool = False
+
+
+@dataclass
+class TestingBatchData:
+    __test__ = False
+
+    tests: List[TestData] = None
+    codes: List[str] = None
+    name: Optional[str] = None
+    request_type: Optional[SQLCommandType] = None
+    ordered: bool = False
+    parallel: bool = False
 
 
 @dataclass
 class CreateData:
     name: Optional[str] = None
     filename: Optional[str] = None
+    limits: Optional[dict] = None
+    force: bool = False
+    durability: str = Durability.FULL
+    wait: bool = False
+
+
+@dataclass
+class BulkItemData:
+    name: Optional[str] = None
+    ok: bool = False
+    error: Optional[str] = None
+    details: Optional[str] = None
+    duration: Optional[float] = None
+
+
+@dataclass
+class BulkData:
+    items: List[CreateData] = None
+    names: List[str] = None
+    results: List[BulkItemData] = None
+    duration: Optional[float] = None
+
+
+@dataclass
+class JobData:
+    id: Optional[str] = None
+    name: Optional[str] = None
+    status: str = JobStatus.QUEUED
+    phase: Optional[str] = None
+    progress: Optional[float] = None
+    created_at: Optional[str] = None
+    duration: Optional[float] = None
+    error: Optional[str] = None
+    details: Optional[str] = None
+
+
+@dataclass
+class LeaseData:
+    name: Optional[str] = None
+    ttl: Optional[int] = None
+    lease: Optional[str] = None
+    expires_at: Optional[str] = None
 
 
 @dataclass
 class StatusData:
     name: Optional[str] = None
     status: Optional[str] = None
+    size: Optional[int] = None
+    filename: Optional[str] = None
+    created_at: Optional[str] = None
+    last_used: Optional[str] = None
+    queries: int = 0
+
+
+@dataclass
+class PoolStatsData:
+    database: Optional[str] = None
+    size: int = 0
+    idle: int = 0
+    in_use: int = 0
+    min_size: int = 0
+    max_size: int = 0
+    checkouts: int = 0
+    created: int = 0
+    discarded: int = 0
+    waits: int = 0
+    timeouts: int = 0
+
+
+@dataclass
+class CacheStatsData:
+    name: Optional[str] = None
+    items: int = 0
+    bytes: int = 0
+    max_bytes: int = 0
+    hits: int = 0
+    misses: int = 0
+    hit_ratio: float = 0.0
+    evictions: int = 0
+
+
+@dataclass
+class SchedulerStatsData:
+    name: Optional[str] = None
+    active: int = 0
+    queued: int = 0
+    max_active: int = 0
+    max_active_per_sandbox: int = 0
+    max_queue: int = 0
+    max_active_total: int = 0
+    shared_active: int = 0
+    admitted: int = 0
+    rejected: int = 0
+    timeouts: int = 0
+    wait_time: float = 0.0
+    avg_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+
+
+@dataclass
+class StatsData:
+    pools: List[PoolStatsData] = None
+    caches: List[CacheStatsData] = None
+    schedulers: List[SchedulerStatsData] = None
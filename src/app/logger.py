@@ -8,6 +8,8 @@ def get_logger():
 
     logger = logging.getLogger('logger')
     logger.setLevel(logging.DEBUG if config.DEBUG else logging.ERROR)
+    if logger.handlers:
+        return logger
     handler = StreamHandler(stream=sys.stdout)
     logger.addHandler(handler)
     handler.setFormatter(
@@ -1,38 +1,144 @@
+from typing import Iterator, Callable
+from functools import wraps
+from contextlib import ExitStack
 from flask import (
     Flask,
+    Response,
     request,
     render_template,
-    abort
+    abort,
+    current_app,
+    stream_with_context,
+    g,
 )
 from marshmallow import ValidationError
+from app.entities import DebugData, TestingBatchData
 from app.service.main import PostgresqlService
+from app.service.enums import DebugFormat
 from app.schema import (
     DebugSchema,
     TestingSchema,
+    TestingBatchSchema,
     CreateSchema,
+    BulkCreateSchema,
+    BulkDeleteSchema,
+    JobSchema,
+    LeaseSchema,
     StatusSchema,
+    StatsSchema,
     BadRequestSchema,
     ServiceExceptionSchema
 )
-from app.service.exceptions import ServiceException
+from app.service.scheduler import scheduler
+from app.service.exceptions import (
+    ServiceException,
+    QueueFullException,
+    JobNotFound,
+)
+
+
+def scheduled(kind: str) -> Callable:
+
+    """
+    Runs the view in the slot of the scheduler, the request is limited
+    by the sandbox from the URL or the request body.
+    The slot is available in g.slot, a streaming view takes it over
+    by g.slot.pop_all() to hold it until the response is closed
+    """
+
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            name = kwargs.get('name')
+            if name is None:
+                data = request.get_json(silent=True)
+                if isinstance(data, dict):
+                    name = data.get('name')
+            try:
+                with ExitStack() as g.slot:
+                    g.slot.enter_context(scheduler.slot(kind, name))
+                    return view(*args, **kwargs)
+            except QueueFullException as ex:
+                abort(429, ex)
+        return wrapper
+    return decorator
+
+
+def stream_debug(data: DebugData, slot: ExitStack) -> Iterator[str]:
+
+    """
+    Yields the result of the debug query in the DebugSchema format
+    row by row, rows are fetched from the database while streaming,
+    the slot of the scheduler is released after streaming
+    """
+
+    with slot:
+        yield '{"result": ['
+        try:
+            for num, row in enumerate(PostgresqlService.debug_rows(data)):
+                yield (', ' if num else '') + current_app.json.dumps(row)
+        except ServiceException as ex:
+            data.error = ex.message
+        tail = DebugSchema(only=('error', 'truncated')).dump(data)
+        yield '], ' + current_app.json.dumps(tail)[1:]
+
+
+def stream_testing_batch(
+    data: TestingBatchData,
+    slot: ExitStack
+) -> Iterator[str]:
+
+    """
+    Yields results of the submissions of the batch in the TestingSchema
+    format one by one, the slot of the scheduler is released after streaming
+    """
+
+    with slot:
+        yield '{"results": ['
+        schema = TestingSchema()
+        error = None
+        try:
+            results = PostgresqlService.testing_batch(data)
+            for num, result in enumerate(results):
+                yield (', ' if num else '') + current_app.json.dumps(
+                    schema.dump(result)
+                )
+        except ServiceException as ex:
+            error = ex.message
+        yield '], "error": ' + current_app.json.dumps(error) + '}'
 
 
 def create_app():
     app = Flask(__name__)
+    PostgresqlService.start_eviction()
+    PostgresqlService.start_leases()
 
     @app.errorhandler(400)
     def bad_request_handler(ex: ValidationError):
         return BadRequestSchema().dump(ex), 400
 
+    @app.errorhandler(404)
+    def not_found_handler(ex: ServiceException):
+        return ServiceExceptionSchema().dump(ex), 404
+
     @app.errorhandler(500)
     def bad_request_handler(ex: ServiceException):
         return ServiceExceptionSchema().dump(ex), 500
 
+    @app.errorhandler(429)
+    def too_many_requests_handler(ex: QueueFullException):
+        return (
+            ServiceExceptionSchema().dump(ex),
+            429,
+            {'Retry-After': str(ex.description.retry_after)}
+        )
+
     @app.route('/', methods=['get'])
     def index():
         return render_template("index.html")
 
     @app.route('/status/', methods=['get'])
+    @scheduled('status')
     def status():
         try:
             data = PostgresqlService.status_all()
@@ -44,6 +150,7 @@ def create_app():
             return StatusSchema().dumps(data, many=True)
 
     @app.route('/status/<name>/', methods=['get'])
+    @scheduled('status')
     def status_name(name):
         try:
             data = PostgresqlService.status(name)
@@ -54,23 +161,71 @@ def create_app():
         else:
             return StatusSchema().dump(data)
 
+    @app.route('/stats/', methods=['get'])
+    def stats():
+        return StatsSchema().dump(PostgresqlService.stats())
+
     @app.route('/create/', methods=['post'])
+    @scheduled('create')
     def create():
         schema = CreateSchema()
-        data = schema.load(request.get_json())
         try:
-            PostgresqlService.create(
-                name=data.name,
-                filename=data.filename
+            data = schema.load(request.get_json())
+            job = PostgresqlService.create_job(data)
+            if data.wait:
+                job = PostgresqlService.wait_job(job.id)
+        except ValidationError as ex:
+            abort(400, ex)
+        except QueueFullException:
+            raise
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return JobSchema().dump(job), 200 if data.wait else 202
+
+    @app.route('/jobs/<job_id>/', methods=['get'])
+    def job(job_id):
+        try:
+            data = PostgresqlService.get_job(job_id)
+        except JobNotFound as ex:
+            abort(404, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return JobSchema().dump(data)
+
+    @app.route('/create/bulk/', methods=['post'])
+    @scheduled('create')
+    def create_bulk():
+        schema = BulkCreateSchema()
+        try:
+            data = PostgresqlService.create_bulk(
+                schema.load(request.get_json())
+            )
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/delete/bulk/', methods=['post'])
+    @scheduled('delete')
+    def delete_bulk():
+        schema = BulkDeleteSchema()
+        try:
+            data = PostgresqlService.delete_bulk(
+                schema.load(request.get_json())
             )
         except ValidationError as ex:
             abort(400, ex)
         except ServiceException as ex:
             abort(500, ex)
         else:
-            return ''
+            return schema.dump(data)
 
     @app.route('/delete/<name>/', methods=['post'])
+    @scheduled('delete')
     def delete(name):
         try:
             PostgresqlService.delete(name)
@@ -81,13 +236,49 @@ def create_app():
         else:
             return ''
 
+    @app.route('/lease/', methods=['post'])
+    @scheduled('lease')
+    def lease():
+        schema = LeaseSchema()
+        try:
+            data = schema.load(request.get_json())
+            data = PostgresqlService.lease(data.name, data.ttl)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return schema.dump(data)
+
+    @app.route('/release/<name>/', methods=['post'])
+    @scheduled('delete')
+    def release(name):
+        try:
+            PostgresqlService.release(name)
+        except ValidationError as ex:
+            abort(400, ex)
+        except ServiceException as ex:
+            abort(500, ex)
+        else:
+            return ''
+
     @app.route('/debug/', methods=['post'])
+    @scheduled('debug')
     def debug():
         schema = DebugSchema()
         try:
-            data = PostgresqlService.debug(
-                schema.load(request.get_json())
-            )
+            data = schema.load(request.get_json())
+            if data.stream and data.format == DebugFormat.ARRAY:
+                slot = g.slot.pop_all()
+                response = Response(
+                    stream_with_context(stream_debug(data, slot)),
+                    mimetype='application/json'
+                )
+                # генератор не выполняется, если клиент отключился
+                # до первой части ответа, слот освобождается при закрытии
+                response.call_on_close(slot.close)
+                return response
+            data = PostgresqlService.debug(data)
         except ValidationError as ex:
             abort(400, ex)
         except ServiceException as ex:
@@ -96,6 +287,7 @@ def create_app():
             return schema.dump(data)
 
     @app.route('/testing/', methods=['post'])
+    @scheduled('testing')
     def testing():
         schema = TestingSchema()
         try:
@@ -109,6 +301,21 @@ def create_app():
         else:
             return schema.dump(data)
 
+    @app.route('/testing/batch/', methods=['post'])
+    @scheduled('testing')
+    def testing_batch():
+        try:
+            data = TestingBatchSchema().load(request.get_json())
+        except ValidationError as ex:
+            abort(400, ex)
+        slot = g.slot.pop_all()
+        response = Response(
+            stream_with_context(stream_testing_batch(data, slot)),
+            mimetype='application/json'
+        )
+        response.call_on_close(slot.close)
+        return response
+
     return app
 
 
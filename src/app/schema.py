@@ -1,9 +1,12 @@
 from typing import Optional
-from marshmallow import Schema, validate
+from marshmallow import Schema, ValidationError, validate
 from marshmallow.fields import (
     Nested,
     Field,
     Boolean,
+    Float,
+    Integer,
+    List,
     Method,
     Raw,
 )
@@ -11,20 +14,37 @@ from marshmallow.decorators import (
     post_load,
     pre_dump
 )
+from app import config
 from app.entities import (
     DebugData,
     TestData,
     TestingData,
+    TestingBatchData,
     CreateData,
+    BulkData,
+    LeaseData,
     StatusData,
 )
 from app.utils import clean_str
 from app.service.enums import (
     DebugFormat,
-    SQLCommandType
+    SQLCommandType,
+    Durability,
+    NamePrefix,
 )
 
 
+def validate_sandbox_name(name: Optional[str]):
+
+    """ Names of leased sandboxes and templates can't be created """
+
+    if name and name.startswith(NamePrefix.VALUES):
+        raise ValidationError(
+            f'Names starting with {", ".join(NamePrefix.VALUES)} '
+            'are reserved'
+        )
+
+
 class StrField(Field):
 
     def _deserialize(self, value: Optional[str], *args, **kwargs):
@@ -43,8 +63,10 @@ class DebugSchema(Schema):
         required=True,
         validate=validate.OneOf(DebugFormat.VALUES)
     )
+    stream = Boolean(load_only=True, load_default=False)
     result = Raw(dump_only=True)
     error = StrField(dump_only=True)
+    truncated = Boolean(dump_only=True)
 
     @post_load
     def make_debug_data(self, data, **kwargs) -> DebugData:
@@ -56,6 +78,7 @@ class TestsSchema(Schema):
     ok = Boolean(dump_only=True)
     error = StrField(dump_only=True)
     result = Raw(dump_only=True)
+    duration = Float(dump_only=True)
 
     @post_load
     def make_test_data(self, data, **kwargs) -> TestData:
@@ -72,6 +95,11 @@ class TestingSchema(Schema):
         required=True,
         validate=validate.OneOf(SQLCommandType.VALUES)
     )
+    ordered = Boolean(load_only=True, load_default=False)
+    parallel = Boolean(
+        load_only=True,
+        load_default=lambda: config.TESTING_PARALLEL
+    )
     ok = Boolean(dump_only=True)
 
     @post_load
@@ -90,25 +118,187 @@ class TestingSchema(Schema):
         return data
 
 
-class CreateSchema(Schema):
+class TestingBatchSchema(Schema):
 
+    tests = Nested(TestsSchema, many=True, load_only=True, required=True)
+    codes = List(StrField(), load_only=True, required=True)
     name = StrField(load_only=True, required=True)
+    request_type = StrField(
+        load_only=True,
+        required=True,
+        validate=validate.OneOf(SQLCommandType.VALUES)
+    )
+    ordered = Boolean(load_only=True, load_default=False)
+    parallel = Boolean(
+        load_only=True,
+        load_default=lambda: config.TESTING_PARALLEL
+    )
+
+    @post_load
+    def make_batch_data(self, data, **kwargs) -> TestingBatchData:
+        return TestingBatchData(**data)
+
+
+class LimitsSchema(Schema):
+
+    statement_timeout = StrField(load_only=True)
+    lock_timeout = StrField(load_only=True)
+    work_mem = StrField(load_only=True)
+    temp_file_limit = StrField(load_only=True)
+    max_cost = Float(load_only=True, validate=validate.Range(min=0))
+    max_rows = Float(load_only=True, validate=validate.Range(min=0))
+
+    @post_load
+    def make_limits(self, data, **kwargs) -> dict:
+        # ограничения оценки планировщика - параметры настройки песочницы
+        for key in ('max_cost', 'max_rows'):
+            if key in data:
+                data[f'sandbox.{key}'] = str(data.pop(key))
+        return data
+
+
+class CreateSchema(Schema):
+
+    name = StrField(
+        load_only=True,
+        required=True,
+        validate=validate_sandbox_name
+    )
     filename = StrField(load_only=True, required=True)
+    limits = Nested(LimitsSchema, load_only=True, load_default=None)
+    force = Boolean(load_only=True, load_default=False)
+    durability = StrField(
+        load_only=True,
+        load_default=Durability.FULL,
+        validate=validate.OneOf(Durability.VALUES)
+    )
+    wait = Boolean(load_only=True, load_default=False)
 
     @post_load
     def make_create_data(self, data, **kwargs) -> CreateData:
         return CreateData(**data)
 
 
+class BulkItemSchema(Schema):
+    name = StrField(dump_only=True)
+    ok = Boolean(dump_only=True)
+    error = StrField(dump_only=True)
+    details = Raw(dump_only=True)
+    duration = Float(dump_only=True)
+
+
+class BulkCreateSchema(Schema):
+
+    items = Nested(CreateSchema, many=True, load_only=True, required=True)
+    results = Nested(BulkItemSchema, many=True, dump_only=True)
+    duration = Float(dump_only=True)
+
+    @post_load
+    def make_bulk_data(self, data, **kwargs) -> BulkData:
+        return BulkData(**data)
+
+
+class BulkDeleteSchema(Schema):
+
+    names = List(StrField(), load_only=True, required=True)
+    results = Nested(BulkItemSchema, many=True, dump_only=True)
+    duration = Float(dump_only=True)
+
+    @post_load
+    def make_bulk_data(self, data, **kwargs) -> BulkData:
+        return BulkData(**data)
+
+
+class JobSchema(Schema):
+    id = StrField(dump_only=True)
+    name = StrField(dump_only=True)
+    status = StrField(dump_only=True)
+    phase = StrField(dump_only=True)
+    progress = Float(dump_only=True)
+    created_at = StrField(dump_only=True)
+    duration = Float(dump_only=True)
+    error = StrField(dump_only=True)
+    details = Raw(dump_only=True)
+
+
+class LeaseSchema(Schema):
+
+    name = StrField(load_only=True, required=True)
+    ttl = Integer(
+        load_only=True,
+        load_default=lambda: config.LEASE_TTL,
+        validate=validate.Range(min=1, max=config.LEASE_MAX_TTL)
+    )
+    lease = StrField(dump_only=True)
+    expires_at = StrField(dump_only=True)
+
+    @post_load
+    def make_lease_data(self, data, **kwargs) -> LeaseData:
+        return LeaseData(**data)
+
+
 class StatusSchema(Schema):
     name = StrField(dump_only=True, required=True)
     status = StrField(dump_only=True, required=True)
+    size = Integer(dump_only=True)
+    filename = StrField(dump_only=True)
+    created_at = StrField(dump_only=True)
+    last_used = StrField(dump_only=True)
+    queries = Integer(dump_only=True)
 
     @post_load
     def make_status_data(self, data, **kwargs) -> StatusData:
         return StatusData(**data)
 
 
+class PoolStatsSchema(Schema):
+    database = StrField(dump_only=True)
+    size = Integer(dump_only=True)
+    idle = Integer(dump_only=True)
+    in_use = Integer(dump_only=True)
+    min_size = Integer(dump_only=True)
+    max_size = Integer(dump_only=True)
+    checkouts = Integer(dump_only=True)
+    created = Integer(dump_only=True)
+    discarded = Integer(dump_only=True)
+    waits = Integer(dump_only=True)
+    timeouts = Integer(dump_only=True)
+
+
+class CacheStatsSchema(Schema):
+    name = StrField(dump_only=True)
+    items = Integer(dump_only=True)
+    bytes = Integer(dump_only=True)
+    max_bytes = Integer(dump_only=True)
+    hits = Integer(dump_only=True)
+    misses = Integer(dump_only=True)
+    hit_ratio = Float(dump_only=True)
+    evictions = Integer(dump_only=True)
+
+
+class SchedulerStatsSchema(Schema):
+    name = StrField(dump_only=True)
+    active = Integer(dump_only=True)
+    queued = Integer(dump_only=True)
+    max_active = Integer(dump_only=True)
+    max_active_per_sandbox = Integer(dump_only=True)
+    max_queue = Integer(dump_only=True)
+    max_active_total = Integer(dump_only=True)
+    shared_active = Integer(dump_only=True)
+    admitted = Integer(dump_only=True)
+    rejected = Integer(dump_only=True)
+    timeouts = Integer(dump_only=True)
+    wait_time = Float(dump_only=True)
+    avg_wait_time = Float(dump_only=True)
+    max_wait_time = Float(dump_only=True)
+
+
+class StatsSchema(Schema):
+    pools = Nested(PoolStatsSchema, many=True, dump_only=True)
+    caches = Nested(CacheStatsSchema, many=True, dump_only=True)
+    schedulers = Nested(SchedulerStatsSchema, many=True, dump_only=True)
+
+
 class BadRequestSchema(Schema):
 
     error = Method('dump_error')
@@ -0,0 +1,1060 @@
+import time
+import select
+import asyncio
+import psycopg
+from functools import partial
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import (
+    Optional,
+    Tuple,
+    Dict,
+    List,
+    Sequence,
+    AsyncIterator,
+    Callable,
+    Any,
+)
+from psycopg import AsyncConnection, AsyncCursor
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from tabulate import tabulate
+from app import config
+from app.entities import (
+    DebugData,
+    TestData,
+    TestingData,
+    TestingBatchData,
+    CreateData,
+    BulkData,
+    JobData,
+    LeaseData,
+    StatusData,
+    StatsData,
+    PoolStatsData,
+)
+from app.utils import normalize_sql, clean_sql, split_sql
+from app.service import exceptions, comparison, governor
+from app.service.main import PostgresqlService
+from app.service.cache import reference_cache, plan_cache, debug_cache
+from app.service.scheduler import async_scheduler
+from app.service.registry import registry
+from app.service.jobs import jobs
+from app.service.entities import ResultFingerprint
+from app.service.enums import (
+    SQLCommandType,
+    DbStatus,
+    DebugFormat,
+    Durability,
+)
+from app.logger import get_logger
+logger = get_logger()
+
+
+async def check_connection(con: AsyncConnection):
+
+    """
+    Checks the idle connection before checkout, see ConnectionPool._is_healthy
+    """
+
+    if con.closed or select.select([con.fileno()], [], [], 0)[0]:
+        raise psycopg.OperationalError('the connection is broken')
+
+
+async def reset_connection(con: AsyncConnection):
+
+    """ Resets the state of the session, see ConnectionPool._reset """
+
+    await con.set_autocommit(True)
+    await con.execute('DISCARD ALL')
+    await con.set_autocommit(False)
+
+
+class AsyncPoolManager:
+
+    """ Async connection pools keyed by database name """
+
+    def __init__(self):
+        self._pools: Dict[Optional[str], AsyncConnectionPool] = {}
+        self._opening: Dict[Optional[str], asyncio.Future] = {}
+
+    async def _open(
+        self,
+        database: Optional[str],
+        pool: AsyncConnectionPool,
+        params: dict
+    ):
+
+        """
+        Opens the pool after the first connection to the database,
+        so a pool isn't kept for the database which doesn't exist
+        (e.g. the name of an unknown sandbox), the error of the connection
+        is raised at once instead of waiting for the timeout of the pool
+        """
+
+        try:
+            con = await AsyncConnection.connect(**params)
+            await con.close()
+            await pool.open()
+        except Exception:
+            if self._pools.get(database) is pool:
+                del self._pools[database]
+                del self._opening[database]
+            raise
+
+    async def get_pool(
+        self,
+        database: Optional[str] = None
+    ) -> AsyncConnectionPool:
+        pool = self._pools.get(database)
+        if pool is None:
+            params = dict(config.PSQL_CONFIG)
+            params.pop('connection_factory')
+            # psycopg 3 не декодирует строки из баз SQL_ASCII, в отличие
+            # от psycopg2, поэтому кодировка клиента задается явно
+            params['client_encoding'] = 'utf8'
+            if database:
+                params['dbname'] = database
+            pool = AsyncConnectionPool(
+                kwargs=params,
+                # соединения с базами песочниц открываются по запросу
+                min_size=0 if database else config.PSQL_POOL_MIN_SIZE,
+                max_size=config.PSQL_POOL_MAX_SIZE,
+                timeout=config.PSQL_POOL_TIMEOUT,
+                max_idle=config.PSQL_POOL_MAX_IDLE,
+                check=check_connection,
+                reset=reset_connection,
+                open=False,
+            )
+            self._pools[database] = pool
+            self._opening[database] = asyncio.ensure_future(
+                self._open(database, pool, params)
+            )
+        await self._opening[database]
+        return pool
+
+    @asynccontextmanager
+    async def connection(
+        self,
+        database: Optional[str] = None,
+        autocommit: bool = False
+    ) -> AsyncIterator[AsyncConnection]:
+
+        """
+        Checks out the connection to the database,
+        an open transaction is rolled back when the connection is returned
+        """
+
+        pool = await self.get_pool(database)
+        try:
+            con = await pool.getconn()
+        except PoolTimeout as e:
+            raise exceptions.ConnectionPoolException(details=str(e))
+        try:
+            if autocommit:
+                await con.set_autocommit(True)
+            yield con
+        finally:
+            if not con.closed and not con.autocommit:
+                try:
+                    await con.rollback()
+                except psycopg.Error as e:
+                    logger.debug(e)
+            await pool.putconn(con)
+
+    async def invalidate(self, database: str):
+
+        """ Closes the pool of the database before it will be dropped """
+
+        pool = self._pools.pop(database, None)
+        opening = self._opening.pop(database, None)
+        if pool:
+            try:
+                await opening
+            except psycopg.Error as e:
+                logger.debug(e)
+            await pool.close()
+
+    async def close(self):
+        for database in list(self._pools):
+            await self.invalidate(database)
+
+    def stats(self) -> List[PoolStatsData]:
+        data = []
+        for database, pool in self._pools.items():
+            stats = pool.get_stats()
+            data.append(
+                PoolStatsData(
+                    database=database,
+                    size=stats.get('pool_size', 0),
+                    idle=stats.get('pool_available', 0),
+                    in_use=(
+                        stats.get('pool_size', 0) -
+                        stats.get('pool_available', 0)
+                    ),
+                    min_size=stats.get('pool_min', 0),
+                    max_size=stats.get('pool_max', 0),
+                    checkouts=stats.get('requests_num', 0),
+                    created=stats.get('connections_num', 0),
+                    discarded=(
+                        stats.get('connections_lost', 0) +
+                        stats.get('returns_bad', 0)
+                    ),
+                    waits=stats.get('requests_queued', 0),
+                    timeouts=stats.get('requests_errors', 0),
+                )
+            )
+        return data
+
+
+async_pools = AsyncPoolManager()
+
+
+async def run_sync(func: Callable, *args, **kwargs) -> Any:
+
+    """ Runs the blocking function in the thread """
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def get_fingerprint(
+    cursor: AsyncCursor,
+    query: str,
+    ordered: bool = False
+) -> ResultFingerprint:
+    await cursor.execute(comparison.get_columns_sql(query))
+    columns = tuple(column.type_code for column in cursor.description)
+    await cursor.execute(comparison.get_fingerprint_sql(query, ordered))
+    rows, first_hash, second_hash = await cursor.fetchone()
+    return ResultFingerprint(
+        columns=columns,
+        rows=rows,
+        hash=(first_hash, second_hash)
+    )
+
+
+async def compare(
+    cursor: AsyncCursor,
+    first_query: str,
+    second_query: str,
+    ordered: bool = False,
+    fingerprints: Dict[str, ResultFingerprint] = None,
+) -> bool:
+
+    """ Asynchronous version of comparison.compare """
+
+    if fingerprints is None:
+        fingerprints = {}
+    await cursor.execute(*comparison.get_settings_sql())
+    for query in (first_query, second_query):
+        if query not in fingerprints:
+            fingerprints[query] = await get_fingerprint(
+                cursor, clean_sql(query), ordered
+            )
+    result = comparison.check_fingerprints(
+        fingerprints[first_query],
+        fingerprints[second_query]
+    )
+    if result is None:
+        try:
+            await cursor.execute(
+                comparison.get_exact_sql(
+                    clean_sql(first_query), clean_sql(second_query), ordered
+                )
+            )
+        except psycopg.errors.SyntaxError as e:
+            if comparison.is_columns_mismatch(e):
+                raise exceptions.CheckException()
+            raise
+        result = (await cursor.fetchone())[0]
+    return result
+
+
+class AsyncPostgresqlService(PostgresqlService):
+
+    """
+    Asynchronous version of PostgresqlService for the ASGI application.
+    Queries are executed by psycopg 3 on connections from async pools,
+    creation and deletion of databases are executed in threads
+    by PostgresqlService
+    """
+
+    # количество занятых дополнительных соединений параллельного тестирования
+    _testing_workers = 0
+    # восстановление песочниц после вытеснения: база -> задача восстановления
+    _restoring: Dict[str, asyncio.Future] = {}
+
+    @classmethod
+    async def _get_db_version(cls, cursor: AsyncCursor) -> int:
+        await cursor.execute(
+            'SELECT oid FROM pg_database WHERE datname = current_database()'
+        )
+        return (await cursor.fetchone())[0]
+
+    @classmethod
+    async def _get_db_oid(cls, db_name: str) -> Optional[int]:
+
+        """ see PostgresqlService._get_db_oid """
+
+        async with async_pools.connection() as con:
+            cursor = await con.execute(
+                'SELECT oid FROM pg_database WHERE datname = %(db_name)s',
+                {'db_name': db_name}
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    async def _get_verdict_key(cls, data: TestingData) -> Optional[tuple]:
+
+        """ see PostgresqlService._get_verdict_key """
+
+        if not cls._is_verdict_cacheable(data):
+            return None
+        return cls._make_verdict_key(
+            data, await cls._get_db_oid(cls._get_db_name(data.name))
+        )
+
+    @classmethod
+    async def _get_debug_cache_key(cls, data: DebugData) -> Optional[tuple]:
+
+        """ see PostgresqlService._get_debug_cache_key """
+
+        if not cls._is_debug_cacheable(data):
+            return None
+        return cls._make_debug_cache_key(
+            data, await cls._get_db_oid(cls._get_db_name(data.name))
+        )
+
+    @classmethod
+    async def _set_limits(cls, cursor: AsyncCursor):
+        await cursor.execute(*governor.get_limits_sql())
+
+    @classmethod
+    async def _check_cost(cls, cursor: AsyncCursor, code: str):
+
+        """ see PostgresqlService._check_cost """
+
+        await cursor.execute(*governor.get_cost_limits_sql())
+        values, db_oid = await cursor.fetchone()
+        limits = governor.parse_cost_limits(values)
+        if not limits:
+            return
+        db_name = cursor.connection.info.dbname
+        for statement in governor.get_explain_statements(code):
+            cache_key = (db_name, db_oid, normalize_sql(statement))
+            estimate = plan_cache.get(cache_key)
+            if estimate is None:
+                await cursor.execute('SAVEPOINT explain')
+                try:
+                    await cursor.execute(governor.get_explain_sql(statement))
+                    estimate = governor.get_estimate(
+                        (await cursor.fetchone())[0]
+                    )
+                except psycopg.Error as e:
+                    logger.debug(e)
+                    await cursor.execute('ROLLBACK TO SAVEPOINT explain')
+                    continue
+                await cursor.execute('RELEASE SAVEPOINT explain')
+                plan_cache.set(cache_key, estimate)
+            governor.check_estimate(estimate, limits)
+
+    @classmethod
+    async def _execute_student_command(
+        cls,
+        cursor: AsyncCursor,
+        student_command: str,
+        request_type: SQLCommandType
+    ) -> Tuple[str, Optional[Exception]]:
+
+        """ see PostgresqlService._execute_student_command """
+
+        await cls._check_cost(cursor, student_command)
+        await cursor.execute('SAVEPOINT student_command')
+        try:
+            if request_type == SQLCommandType.SELECT:
+                await cursor.execute(
+                    cls._get_student_result_sql(student_command)
+                )
+                return f'TABLE {cls.student_result_table}', None
+            await cursor.execute(student_command)
+        except Exception as e:
+            await cursor.execute('ROLLBACK TO SAVEPOINT student_command')
+            if request_type != SQLCommandType.SELECT:
+                return student_command, e
+            if governor.get_limit_exception(e):
+                raise
+            return student_command, None
+        return student_command, None
+
+    @classmethod
+    async def _check_select_command(
+        cls,
+        cursor: AsyncCursor,
+        student_command: str,
+        true_command: str,
+        ordered: bool = False,
+        fingerprints: Optional[Dict[str, ResultFingerprint]] = None
+    ) -> bool:
+
+        """ see PostgresqlService._check_select_command """
+
+        return await compare(
+            cursor=cursor,
+            first_query=student_command,
+            second_query=true_command,
+            ordered=ordered,
+            fingerprints=fingerprints
+        )
+
+    @classmethod
+    async def _get_references(
+        cls,
+        cursor: AsyncCursor,
+        db_version: Tuple[str, int],
+        ordered: bool,
+        tests: List[TestData],
+        references: Dict[str, ResultFingerprint]
+    ):
+
+        """ see PostgresqlService._get_references """
+
+        for test_data in tests:
+            true_command = test_data.data_in
+            if true_command in references:
+                continue
+            cache_key = cls._get_reference_cache_key(
+                db_version, ordered, true_command
+            )
+            fingerprint = reference_cache.get(cache_key)
+            if fingerprint is None:
+                await cursor.execute('SAVEPOINT reference')
+                try:
+                    fingerprint = await get_fingerprint(
+                        cursor, clean_sql(true_command), ordered
+                    )
+                except psycopg.Error as e:
+                    logger.debug(e)
+                    await cursor.execute('ROLLBACK TO SAVEPOINT reference')
+                    continue
+                await cursor.execute('RELEASE SAVEPOINT reference')
+                reference_cache.set(cache_key, fingerprint)
+            references[true_command] = fingerprint
+
+    @classmethod
+    async def _test(
+        cls,
+        cursor: AsyncCursor,
+        check_code: str,
+        student_command: str,
+        student_error: Optional[Exception],
+        request_type: SQLCommandType,
+        ordered: bool = False,
+        fingerprints: Optional[Dict[str, ResultFingerprint]] = None
+    ) -> Tuple[bool, Optional[str]]:
+
+        """ see PostgresqlService._test """
+
+        ok, error = False, None
+        try:
+            await cursor.execute('SAVEPOINT test')
+            try:
+                if request_type == SQLCommandType.SELECT:
+                    ok = await cls._check_select_command(
+                        cursor=cursor,
+                        student_command=student_command,
+                        true_command=check_code,
+                        ordered=ordered,
+                        fingerprints=fingerprints
+                    )
+                elif request_type == SQLCommandType.DELETE:
+                    if student_error:
+                        raise student_error
+                    await cursor.execute(
+                        cls._get_delete_check_sql(check_code)
+                    )
+                    ok = (await cursor.fetchone())[0]
+                else:
+                    expected_rows_count, check_command = (
+                        cls._parse_check_code(check_code)
+                    )
+                    if student_error:
+                        raise student_error
+                    await cursor.execute(
+                        cls._get_count_check_sql(check_command)
+                    )
+                    rows_count = (await cursor.fetchone())[0]
+                    ok = rows_count == expected_rows_count
+            finally:
+                await cursor.execute('ROLLBACK TO SAVEPOINT test')
+        except Exception as e:
+            logger.error(e)
+            ok = False
+            error = str(governor.get_limit_exception(e) or e)
+        return ok, error
+
+    @classmethod
+    async def _get_sandboxes(cls, name: Optional[str] = None) -> List[tuple]:
+        if not cls._evicted_table_ready:
+            await run_sync(PostgresqlService._create_evicted_table)
+        async with async_pools.connection() as con:
+            cursor = await con.execute(*cls._get_sandboxes_query(name))
+            return await cursor.fetchall()
+
+    @classmethod
+    async def _refresh_registry(cls):
+
+        """ see PostgresqlService._refresh_registry """
+
+        # первая сверка ожидается без блокировки цикла событий
+        while registry.refreshing and not registry.ready:
+            await asyncio.sleep(0.01)
+        if not registry.begin_refresh(wait=False):
+            return
+        try:
+            rows = await cls._get_sandboxes()
+        except Exception as e:
+            registry.cancel_refresh()
+            if not registry.ready:
+                raise
+            logger.error(e)
+        else:
+            registry.reconcile(rows)
+            await run_sync(PostgresqlService._evict_lost, rows)
+
+    @classmethod
+    async def status(cls, name: str) -> StatusData:
+
+        """ Returns the status of the database with the given name """
+
+        try:
+            await cls._refresh_registry()
+            data = registry.get(name)
+            if data is None:
+                registry.update(await cls._get_sandboxes(name))
+                data = registry.get(name)
+        except Exception as e:
+            logger.error(e)
+            raise exceptions.StatusCheckException(details=str(e))
+        return data or StatusData(status=DbStatus.NOT_EXISTS, name=name)
+
+    @classmethod
+    async def status_all(cls) -> List[StatusData]:
+
+        """ Returns a list for all sandbox databases with their statuses """
+
+        try:
+            await cls._refresh_registry()
+        except Exception as e:
+            logger.error(e)
+            raise exceptions.StatusCheckException(details=str(e))
+        return registry.all()
+
+    @classmethod
+    async def create(
+        cls,
+        name: str,
+        filename: str,
+        limits: Optional[dict] = None,
+        force: bool = False,
+        durability: str = Durability.FULL
+    ):
+
+        """ (Re)creates db from file, see PostgresqlService.create """
+
+        await async_pools.invalidate(cls._get_db_name(name))
+        await run_sync(
+            PostgresqlService.create,
+            name=name,
+            filename=filename,
+            limits=limits,
+            force=force,
+            durability=durability
+        )
+
+    @classmethod
+    async def create_job(cls, data: CreateData) -> JobData:
+
+        """
+        see PostgresqlService.create_job,
+        async pools of the sandbox are closed before and after the job
+        """
+
+        job = await run_sync(PostgresqlService.create_job, data)
+        db_name = cls._get_db_name(data.name)
+        await async_pools.invalidate(db_name)
+        loop = asyncio.get_running_loop()
+        jobs.future(job.id).add_done_callback(
+            lambda future: loop.call_soon_threadsafe(
+                lambda: asyncio.ensure_future(async_pools.invalidate(db_name))
+            )
+        )
+        return job
+
+    @classmethod
+    async def wait_job(cls, job_id: str) -> JobData:
+
+        """ see PostgresqlService.wait_job """
+
+        await asyncio.wrap_future(jobs.future(job_id))
+        return jobs.get(job_id)
+
+    @classmethod
+    async def create_bulk(cls, data: BulkData) -> BulkData:
+
+        """ see PostgresqlService.create_bulk """
+
+        for item in data.items:
+            await async_pools.invalidate(cls._get_db_name(item.name))
+        return await run_sync(PostgresqlService.create_bulk, data)
+
+    @classmethod
+    async def delete_bulk(cls, data: BulkData) -> BulkData:
+
+        """ see PostgresqlService.delete_bulk """
+
+        for name in data.names:
+            await async_pools.invalidate(cls._get_db_name(name))
+        return await run_sync(PostgresqlService.delete_bulk, data)
+
+    @classmethod
+    async def _restore(cls, name: str):
+
+        """
+        Restores the evicted sandbox, the pool of its database is replaced
+        only if the database has been recreated
+        """
+
+        if await run_sync(PostgresqlService._restore_evicted, name):
+            await async_pools.invalidate(cls._get_db_name(name))
+
+    @classmethod
+    async def _restore_evicted(cls, name: str):
+
+        """
+        see PostgresqlService._restore_evicted,
+        concurrent requests to the sandbox wait for the same restoration
+        """
+
+        if cls._is_lease(name):
+            return
+        try:
+            await cls._refresh_registry()
+        except Exception as e:
+            logger.error(e)
+            return
+        data = registry.get(name)
+        if data is not None and data.status != DbStatus.EVICTED:
+            return
+        db_name = cls._get_db_name(name)
+        restoring = cls._restoring.get(db_name)
+        if restoring is None:
+            restoring = asyncio.ensure_future(cls._restore(name))
+            cls._restoring[db_name] = restoring
+            restoring.add_done_callback(
+                lambda _: cls._restoring.pop(db_name, None)
+            )
+        await asyncio.shield(restoring)
+
+    @classmethod
+    async def delete(cls, name: str):
+
+        """ Delete the database with the given name """
+
+        await async_pools.invalidate(cls._get_db_name(name))
+        await run_sync(PostgresqlService.delete, name)
+
+    @classmethod
+    async def lease(
+        cls,
+        name: str,
+        ttl: float = config.LEASE_TTL
+    ) -> LeaseData:
+
+        """ see PostgresqlService.lease """
+
+        return await run_sync(PostgresqlService.lease, name, ttl)
+
+    @classmethod
+    async def release(cls, name: str):
+
+        """ see PostgresqlService.release """
+
+        if cls._is_lease(name):
+            await async_pools.invalidate(cls._get_db_name(name))
+        await run_sync(PostgresqlService.release, name)
+
+    @classmethod
+    async def stats(cls) -> StatsData:
+
+        """ Returns usage statistics of the service """
+
+        data = PostgresqlService.stats()
+        data.pools += async_pools.stats()
+        data.schedulers.append(async_scheduler.stats())
+        return data
+
+    @classmethod
+    async def _execute_debug_command(
+        cls,
+        con: AsyncConnection,
+        code: str,
+        read_only: bool = False
+    ) -> AsyncCursor:
+
+        """ see PostgresqlService._execute_debug_command """
+
+        statements = split_sql(code)
+        cursor = con.cursor()
+        if read_only:
+            await cursor.execute('SET TRANSACTION READ ONLY')
+        await cls._set_limits(cursor)
+        await cls._check_cost(cursor, code)
+        if not statements or not cls._is_cursor_statement(statements[-1]):
+            await cursor.execute(code)
+            # как и psycopg2, возвращается результат последней команды
+            while cursor.nextset():
+                pass
+            return cursor
+        for statement in statements[:-1]:
+            await cursor.execute(statement)
+        await cursor.execute('SAVEPOINT debug')
+        server_cursor = con.cursor(name='debug')
+        try:
+            await server_cursor.execute(statements[-1])
+        except psycopg.Error as e:
+            if not cls._is_cursor_rejected(e):
+                raise
+            logger.debug(e)
+            await cursor.execute('ROLLBACK TO SAVEPOINT debug')
+            await cursor.execute(statements[-1])
+            return cursor
+        return server_cursor
+
+    @classmethod
+    async def debug_rows(
+        cls,
+        data: DebugData,
+        read_only: bool = False
+    ) -> AsyncIterator[Sequence]:
+
+        """ see PostgresqlService.debug_rows """
+
+        await cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        data.truncated = False
+        rows_count, rows_size = 0, 0
+        try:
+            async with async_pools.connection(
+                cls._get_db_name(data.name)
+            ) as con:
+                cursor = await cls._execute_debug_command(
+                    con, data.code, read_only
+                )
+                server = isinstance(cursor, psycopg.AsyncServerCursor)
+                lease = cls._is_lease(data.name)
+                if lease and not server:
+                    await con.commit()
+                try:
+                    if not cursor.description:
+                        return
+                    yield [column.name for column in cursor.description]
+                    rows = await cursor.fetchmany(config.DEBUG_FETCH_SIZE)
+                    while rows:
+                        for row in rows:
+                            rows_size += len(str(row))
+                            if (
+                                rows_count >= config.DEBUG_MAX_ROWS or
+                                rows_size > config.DEBUG_MAX_BYTES
+                            ):
+                                data.truncated = True
+                                return
+                            rows_count += 1
+                            yield row
+                        rows = await cursor.fetchmany(
+                            config.DEBUG_FETCH_SIZE
+                        )
+                finally:
+                    if lease and server and not con.closed:
+                        await con.commit()
+        except Exception as e:
+            exception = governor.get_limit_exception(e)
+            if exception:
+                logger.error(e)
+                raise exception
+            data.error = str(e)
+
+    @classmethod
+    async def _debug_plan(cls, data: DebugData) -> DebugData:
+
+        """ see PostgresqlService._debug_plan """
+
+        await cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        plans = []
+        try:
+            async with async_pools.connection(
+                cls._get_db_name(data.name)
+            ) as con:
+                cursor = con.cursor()
+                await cls._set_limits(cursor)
+                await cls._check_cost(cursor, data.code)
+                for statement in split_sql(data.code):
+                    if governor.is_explainable(statement):
+                        await cursor.execute(
+                            governor.get_explain_analyze_sql(statement)
+                        )
+                        plans.extend((await cursor.fetchone())[0])
+                    else:
+                        await cursor.execute(statement)
+        except Exception as e:
+            exception = governor.get_limit_exception(e)
+            if exception:
+                logger.error(e)
+                raise exception
+            data.error = str(e)
+            return data
+        data.result = plans
+        return data
+
+    @classmethod
+    async def _is_deterministic(
+        cls,
+        name: str,
+        queries: Sequence[str]
+    ) -> bool:
+
+        """ see PostgresqlService._is_deterministic """
+
+        try:
+            async with async_pools.connection(cls._get_db_name(name)) as con:
+                cursor = con.cursor()
+                await cls._set_limits(cursor)
+                for query in queries:
+                    await cursor.execute('SAVEPOINT deterministic')
+                    await cursor.execute(
+                        f'CREATE TEMP VIEW {cls.deterministic_view} AS '
+                        f'SELECT FROM ({clean_sql(query)}) AS query'
+                    )
+                    await cursor.execute(cls._get_deterministic_sql())
+                    if not (await cursor.fetchone())[0]:
+                        return False
+                    await cursor.execute('ROLLBACK TO SAVEPOINT deterministic')
+        except psycopg.Error as e:
+            logger.debug(e)
+            return False
+        return True
+
+    @classmethod
+    async def _confirm_verdict_key(
+        cls,
+        key: Optional[tuple],
+        data: TestingData
+    ) -> Optional[tuple]:
+
+        """ see PostgresqlService._confirm_verdict_key """
+
+        if key and await cls._is_deterministic(
+            data.name, cls._get_verdict_queries(data)
+        ):
+            return key
+        return None
+
+    @classmethod
+    async def debug(cls, data: DebugData) -> DebugData:
+
+        """ debug query, see PostgresqlService.debug """
+
+        if data.format == DebugFormat.PLAN:
+            return await cls._debug_plan(data)
+        cache_key = await cls._get_debug_cache_key(data)
+        if cache_key:
+            cached = await run_sync(debug_cache.get, cache_key)
+            if cached is not None:
+                registry.touch(data.name)
+                data.result, data.truncated = cached
+                return data
+        if cache_key and not await cls._is_deterministic(
+            data.name, [data.code]
+        ):
+            cache_key = None
+        result = [
+            row async for row in
+            cls.debug_rows(data, read_only=cache_key is not None)
+        ]
+        if cache_key and cls._is_read_only_error(data.error):
+            cache_key, data.error = None, None
+            result = [row async for row in cls.debug_rows(data)]
+        if data.error:
+            return data
+        if data.format == DebugFormat.TABULAR:
+            if result:
+                data.result = tabulate(
+                    tabular_data=result[1:],
+                    headers=result[0],
+                    tablefmt="psql"
+                )
+        else:
+            data.result = result
+        if cache_key:
+            await run_sync(
+                debug_cache.set, cache_key, (data.result, data.truncated)
+            )
+        return data
+
+    @classmethod
+    async def _run_tests(
+        cls,
+        data: TestingData,
+        tests: List[TestData],
+        references: Dict[str, ResultFingerprint]
+    ):
+
+        """ see PostgresqlService._run_tests """
+
+        db_name = cls._get_db_name(data.name)
+        try:
+            async with async_pools.connection(db_name) as con:
+                cursor = con.cursor()
+                await cls._set_limits(cursor)
+                await cursor.execute(*comparison.get_settings_sql())
+                if data.request_type == SQLCommandType.SELECT:
+                    await cls._get_references(
+                        cursor=cursor,
+                        db_version=(
+                            db_name, await cls._get_db_version(cursor)
+                        ),
+                        ordered=data.ordered,
+                        tests=tests,
+                        references=references
+                    )
+                fingerprints = dict(references)
+                student_command, student_error = (
+                    await cls._execute_student_command(
+                        cursor=cursor,
+                        student_command=data.code,
+                        request_type=data.request_type
+                    )
+                )
+                for test_data in tests:
+                    started = time.perf_counter()
+                    test_data.ok, test_data.error = await cls._test(
+                        cursor=cursor,
+                        check_code=test_data.data_in,
+                        student_command=student_command,
+                        student_error=student_error,
+                        request_type=data.request_type,
+                        ordered=data.ordered,
+                        fingerprints=fingerprints
+                    )
+                    test_data.duration = time.perf_counter() - started
+        except Exception as e:
+            logger.error(e)
+            error = str(governor.get_limit_exception(e) or e)
+            for test_data in tests:
+                test_data.ok, test_data.error = False, error
+            return False
+        return True
+
+    @classmethod
+    def _get_testing_workers(cls, data: TestingData) -> int:
+
+        """ see PostgresqlService._get_testing_workers """
+
+        if not data.parallel:
+            return 0
+        return cls._reserve_testing_slots(
+            min(config.TESTING_PARALLEL_WORKERS, len(data.tests)) - 1
+        )
+
+    @classmethod
+    def _reserve_testing_slots(cls, amount: int) -> int:
+
+        """ see PostgresqlService._reserve_testing_slots """
+
+        free = config.TESTING_MAX_WORKERS - cls._testing_workers
+        workers = max(min(amount, free), 0)
+        cls._testing_workers += workers
+        return workers
+
+    @classmethod
+    async def testing(cls, data: TestingData) -> TestingData:
+
+        """ runs _test for all items in data.tests (TestData) """
+
+        await cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        verdict_key = await cls._get_verdict_key(data)
+        if cls._get_verdicts(verdict_key, data):
+            return data
+        verdict_key = await cls._confirm_verdict_key(verdict_key, data)
+        references = {}
+        workers = cls._get_testing_workers(data)
+        try:
+            completed = all(await asyncio.gather(*(
+                cls._run_tests(data, tests, references)
+                for tests in cls._split_tests(data.tests, workers + 1)
+            )))
+        finally:
+            cls._testing_workers -= workers
+        cls._set_verdicts(verdict_key, data, completed)
+        return data
+
+    @classmethod
+    async def _test_submission(
+        cls,
+        data: TestingBatchData,
+        code: str,
+        references: Dict[str, ResultFingerprint]
+    ) -> TestingData:
+
+        """ see PostgresqlService._test_submission """
+
+        registry.touch(data.name)
+        submission = TestingData(
+            tests=[TestData(data_in=test.data_in) for test in data.tests],
+            code=code,
+            name=data.name,
+            request_type=data.request_type,
+            ordered=data.ordered
+        )
+        verdict_key = await cls._get_verdict_key(submission)
+        if cls._get_verdicts(verdict_key, submission):
+            return submission
+        verdict_key = await cls._confirm_verdict_key(verdict_key, submission)
+        completed = await cls._run_tests(
+            submission, submission.tests, references
+        )
+        cls._set_verdicts(verdict_key, submission, completed)
+        return submission
+
+    @classmethod
+    async def testing_batch(
+        cls,
+        data: TestingBatchData
+    ) -> AsyncIterator[TestingData]:
+
+        """ see PostgresqlService.testing_batch """
+
+        await cls._restore_evicted(data.name)
+        references = {}
+        workers = 0
+        if data.parallel:
+            workers = cls._reserve_testing_slots(
+                min(config.TESTING_PARALLEL_WORKERS, len(data.codes))
+            )
+        tasks = deque()
+        try:
+            for code in data.codes:
+                tasks.append(asyncio.ensure_future(
+                    cls._test_submission(data, code, references)
+                ))
+                if len(tasks) >= max(workers, 1):
+                    yield await tasks.popleft()
+            while tasks:
+                yield await tasks.popleft()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            cls._testing_workers -= workers
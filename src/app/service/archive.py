@@ -0,0 +1,134 @@
+"""
+Restoring databases from pg_dump archives with parallel jobs.
+Files of the custom format (pg_dump -Fc) are restored directly.
+Plain SQL files are loaded once and compiled into the directory format
+archive (pg_dump -Fd) in config.ARCHIVE_DIR, the archive is named
+by the file name and the hash of its content, so it is used
+to restore the file until the file changes.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+from typing import List, Optional
+from app import config
+from app.utils import get_file_hash
+from app.service import exceptions
+from app.logger import get_logger
+logger = get_logger()
+
+# сигнатура архива pg_dump
+ARCHIVE_MAGIC = b'PGDMP'
+ARCHIVE_NAME = re.compile(r'^(?P<filename>.+)\.(?P<hash>[0-9a-f]{16})$')
+
+
+def is_archive(file_path: str) -> bool:
+
+    """ True if the file is the custom format archive of pg_dump """
+
+    with open(file_path, 'rb') as file:
+        return file.read(len(ARCHIVE_MAGIC)) == ARCHIVE_MAGIC
+
+
+def get_archive_path(filename: str, file_hash: str) -> Optional[str]:
+
+    """ Path of the compiled archive, None - compilation is disabled """
+
+    if not config.ARCHIVE_DIR:
+        return None
+    return os.path.join(config.ARCHIVE_DIR, f'{filename}.{file_hash}')
+
+
+def _run(args: List[str]):
+    logger.debug(' '.join(args))
+    env = dict(os.environ, PGPASSWORD=config.PSQL_PASSWORD)
+    result = subprocess.run(
+        args,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if result.returncode:
+        raise exceptions.CreationException(
+            details=result.stderr.strip() or f'{args[0]} failed'
+        )
+
+
+def _get_connection_args(db_name: str) -> List[str]:
+    return [
+        f'--host={config.PSQL_HOST}',
+        f'--port={config.PSQL_PORT}',
+        f'--username={config.PSQL_USER}',
+        f'--dbname={db_name}',
+    ]
+
+
+def restore_archive(db_name: str, archive_path: str):
+
+    """
+    Restores the archive into the database with config.RESTORE_JOBS jobs,
+    ownership and privileges are not restored
+    """
+
+    _run([
+        'pg_restore',
+        *_get_connection_args(db_name),
+        f'--jobs={config.RESTORE_JOBS}',
+        '--no-owner',
+        '--no-privileges',
+        '--exit-on-error',
+        archive_path,
+    ])
+
+
+def compile_archive(db_name: str, archive_path: str):
+
+    """
+    Dumps the database into the directory format archive,
+    the archive appears under its name only when it is complete
+    """
+
+    tmp_path = f'{archive_path}.{os.getpid()}'
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    try:
+        _run([
+            'pg_dump',
+            *_get_connection_args(db_name),
+            f'--jobs={config.RESTORE_JOBS}',
+            '--format=directory',
+            f'--file={tmp_path}',
+        ])
+        os.rename(tmp_path, archive_path)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def delete_stale_archives():
+
+    """ Deletes archives whose source file was changed or removed """
+
+    if not config.ARCHIVE_DIR or not os.path.isdir(config.ARCHIVE_DIR):
+        return
+    for path, dirs, _ in os.walk(config.ARCHIVE_DIR):
+        for name in list(dirs):
+            match = ARCHIVE_NAME.match(name)
+            if not match:
+                continue
+            # каталог архива не просматривается
+            dirs.remove(name)
+            filename = os.path.relpath(
+                os.path.join(path, match.group('filename')),
+                config.ARCHIVE_DIR
+            )
+            file_path = os.path.join(config.SQL_FILES_DIR, filename)
+            if (
+                os.path.isfile(file_path) and
+                get_file_hash(file_path) == match.group('hash')
+            ):
+                continue
+            logger.info(f'Stale archive {name} is deleted')
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+from app import config
+from app.entities import CacheStatsData
+from app.logger import get_logger
+logger = get_logger()
+
+
+class LRUCache:
+
+    """
+    Thread-safe LRU cache limited by the size of keys and values in bytes
+    max_bytes: the size of the cache, least recently used items
+      are evicted on overflow
+    ttl: lifetime of the item in seconds, None - unlimited
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_bytes: int,
+        ttl: Optional[float] = None
+    ):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _pop(self, key: Hashable):
+        _, size, _ = self._items.pop(key)
+        self._bytes -= size
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, _, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self._hits += 1
+                    return value
+                self._pop(key)
+            self._misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any):
+        size = (
+            len(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)) +
+            len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        )
+        if size > self.max_bytes:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            self._items[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._items)))
+                self._evictions += 1
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]):
+
+        """ Removes items whose key matches the predicate """
+
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self._pop(key)
+
+    def stats(self) -> CacheStatsData:
+        with self._lock:
+            requests = self._hits + self._misses
+            return CacheStatsData(
+                name=self.name,
+                items=len(self._items),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                hits=self._hits,
+                misses=self._misses,
+                hit_ratio=self._hits / requests if requests else 0.0,
+                evictions=self._evictions,
+            )
+
+
+class SharedCache:
+
+    """
+    LRU cache shared by the processes of the host, items are stored
+    in the SQLite database file, see LRUCache.
+    Statistics of hits and misses are counted by each process separately,
+    errors of the storage are treated as misses
+    path: path of the database file, its directory is created
+      accessible only by the owner. Values are unpickled, so the cache
+      isn't used if the directory isn't owned by the user of the process
+      or can be written by other users
+    """
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        max_bytes: int,
+        ttl: Optional[float] = None
+    ):
+        self.name = name
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # соединение не переходит в дочерний процесс после fork
+        pid, con = getattr(self._local, 'connection', (None, None))
+        if pid == os.getpid():
+            return con
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self._check_directory(directory)
+        con = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+        con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA synchronous = OFF')
+        con.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            '  key TEXT PRIMARY KEY,'
+            '  value BLOB NOT NULL,'
+            '  size INTEGER NOT NULL,'
+            '  expires REAL,'
+            '  used REAL NOT NULL'
+            ')'
+        )
+        con.execute('CREATE INDEX IF NOT EXISTS items_used ON items (used)')
+        self._local.connection = (os.getpid(), con)
+        return con
+
+    def _check_directory(self, directory: str):
+
+        """ Raises PermissionError if other users can write the directory """
+
+        info = os.stat(directory)
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            logger.error(
+                f'{directory} is not owned by the user or is writable '
+                f'by other users, the cache {self.name} is disabled'
+            )
+            raise PermissionError(directory)
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        key = json.dumps(key)
+        now = time.time()
+        try:
+            con = self._connect()
+            row = con.execute(
+                'SELECT value, expires FROM items WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                con.execute(
+                    'UPDATE items SET used = ? WHERE key = ?', (now, key)
+                )
+                value = pickle.loads(row[0])
+                self._count(hit=True)
+                return value
+            if row is not None:
+                con.execute('DELETE FROM items WHERE key = ?', (key,))
+        except (sqlite3.Error, OSError):
+            pass
+        self._count(hit=False)
+        return None
+
+    def set(self, key: Hashable, value: Any):
+        key = json.dumps(key)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = len(key) + len(value)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        expires = None
+        if self.ttl is not None:
+            expires = now + self.ttl
+        evictions = 0
+        try:
+            con = self._connect()
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                con.execute('DELETE FROM items WHERE expires <= ?', (now,))
+                con.execute(
+                    'INSERT OR REPLACE INTO items '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, value, size, expires, now)
+                )
+                total = con.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM items'
+                ).fetchone()[0]
+                while total > self.max_bytes:
+                    old_key, old_size = con.execute(
+                        'SELECT key, size FROM items ORDER BY used LIMIT 1'
+                    ).fetchone()
+                    con.execute('DELETE FROM items WHERE key = ?', (old_key,))
+                    total -= old_size
+                    evictions += 1
+                con.execute('COMMIT')
+            except sqlite3.Error:
+                con.execute('ROLLBACK')
+                raise
+        except (sqlite3.Error, OSError):
+            return
+        with self._lock:
+            self._evictions += evictions
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]):
+
+        """ Removes items whose key matches the predicate """
+
+        try:
+            con = self._connect()
+            keys = [
+                (key,) for (key,) in con.execute('SELECT key FROM items')
+                if predicate(tuple(json.loads(key)))
+            ]
+            con.executemany('DELETE FROM items WHERE key = ?', keys)
+        except (sqlite3.Error, OSError):
+            pass
+
+    def stats(self) -> CacheStatsData:
+        items, size = 0, 0
+        try:
+            items, size = self._connect().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM items'
+            ).fetchone()
+        except (sqlite3.Error, OSError):
+            pass
+        with self._lock:
+            requests = self._hits + self._misses
+            return CacheStatsData(
+                name=self.name,
+                items=items,
+                bytes=size,
+                max_bytes=self.max_bytes,
+                hits=self._hits,
+                misses=self._misses,
+                hit_ratio=self._hits / requests if requests else 0.0,
+                evictions=self._evictions,
+            )
+
+
+reference_cache = LRUCache(
+    name='reference',
+    max_bytes=config.REFERENCE_CACHE_MAX_BYTES,
+    ttl=config.REFERENCE_CACHE_TTL
+)
+plan_cache = LRUCache(
+    name='plan',
+    max_bytes=config.PLAN_CACHE_MAX_BYTES,
+    ttl=config.PLAN_CACHE_TTL
+)
+verdict_cache = LRUCache(
+    name='verdict',
+    max_bytes=config.VERDICT_CACHE_MAX_BYTES,
+    ttl=config.VERDICT_CACHE_TTL
+)
+debug_cache = SharedCache(
+    name='debug',
+    path=config.DEBUG_CACHE_PATH,
+    max_bytes=config.DEBUG_CACHE_MAX_BYTES,
+    ttl=config.DEBUG_CACHE_TTL
+)
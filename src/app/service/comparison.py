@@ -0,0 +1,238 @@
+"""
+Comparison of the results of two SELECT queries.
+Each query is executed once to calculate the fingerprint of its result:
+amount of rows and two sums of row hashes calculated on the server.
+The sums don't depend on the order of rows, so equal fingerprints
+mean equal multisets of rows.
+
+Rows are hashed by their text representation, so values which are
+equal but have different text (1.0 and 1.00 for numeric) give different
+hashes. Exact comparison with EXCEPT ALL is used if the fingerprints
+differ and can't prove that the results differ.
+
+The text representation of some types depends on settings of the session
+(DateStyle, TimeZone etc.), so the settings are pinned (TEXT_SETTINGS)
+for the transaction of the check and before each comparison,
+fingerprints calculated in different sessions are comparable
+and the user's query can't change them by set_config.
+"""
+
+import json
+from typing import Tuple, Dict, Optional
+import psycopg2
+from psycopg2.extensions import cursor as Cursor
+from app.utils import clean_sql
+from app.service import exceptions
+from app.service.entities import ResultFingerprint
+
+# типы, для которых равенство значений равносильно равенству
+# их текстового представления (не зависящего от настроек сеанса,
+# поэтому типы даты и времени сравниваются точно)
+EXACT_TEXT_TYPES = frozenset((
+    16,    # bool
+    19,    # name
+    20,    # int8
+    21,    # int2
+    23,    # int4
+    25,    # text
+    26,    # oid
+    1043,  # varchar
+    2950,  # uuid
+))
+
+# настройки, от которых зависит текстовое представление значений
+TEXT_SETTINGS = {
+    'DateStyle': 'ISO, MDY',
+    'TimeZone': 'UTC',
+    'IntervalStyle': 'postgres',
+    'extra_float_digits': '1',
+    'bytea_output': 'hex',
+}
+
+
+def get_settings_sql() -> Tuple[str, dict]:
+
+    """ Query which pins TEXT_SETTINGS for the transaction """
+
+    return (
+        """
+        SELECT set_config(settings.key, settings.value, true)
+        FROM jsonb_each_text(%(settings)s::jsonb) AS settings
+        """,
+        {'settings': json.dumps(TEXT_SETTINGS)}
+    )
+
+
+def get_columns_sql(query: str) -> str:
+
+    """ Query which describes columns of the result without execution """
+
+    return f'SELECT * FROM ({query}) AS result LIMIT 0'
+
+
+def get_fingerprint_sql(query: str, ordered: bool = False) -> str:
+
+    """
+    Query which returns amount of rows and two sums of row hashes
+    ordered - the number of the row is included into the row hash
+    """
+
+    if ordered:
+        source = (
+            'SELECT row_number() OVER () || result::text AS row_text '
+            f'FROM ({query}) AS result'
+        )
+    else:
+        source = f'SELECT result::text AS row_text FROM ({query}) AS result'
+    return f"""
+        SELECT
+          COUNT(*),
+          COALESCE(SUM(hashtextextended(result_rows.row_text, 0)), 0),
+          COALESCE(SUM(hashtextextended(result_rows.row_text, 1)), 0)
+        FROM ({source}) AS result_rows
+    """
+
+
+def get_exact_sql(
+    first_query: str,
+    second_query: str,
+    ordered: bool = False
+) -> str:
+
+    """ Query which compares results of the queries with EXCEPT ALL """
+
+    if ordered:
+        first_query = (
+            'SELECT row_number() OVER (), first_result.* '
+            f'FROM ({first_query}) AS first_result'
+        )
+        second_query = (
+            'SELECT row_number() OVER (), second_result.* '
+            f'FROM ({second_query}) AS second_result'
+        )
+    return f"""
+        SELECT
+          CASE
+            WHEN NOT EXISTS (
+              SELECT *
+              FROM (
+                ({first_query})
+                EXCEPT ALL
+                ({second_query})
+              ) AS first_command
+              UNION ALL
+              SELECT *
+              FROM (
+                ({second_query})
+                EXCEPT ALL
+                ({first_query})
+              ) AS second_command
+            ) THEN TRUE
+            ELSE FALSE
+          END
+    """
+
+
+def is_columns_mismatch(error: Exception) -> bool:
+    return 'each EXCEPT query must have the same number of columns' in str(error)
+
+
+def check_fingerprints(
+    first: ResultFingerprint,
+    second: ResultFingerprint
+) -> Optional[bool]:
+
+    """
+    Returns True if results are identical, False if they differ
+    and None if they must be compared exactly
+    """
+
+    if len(first.columns) != len(second.columns):
+        raise exceptions.CheckException()
+    if first.columns == second.columns:
+        if first.rows == second.rows and first.hash == second.hash:
+            return True
+        if first.rows != second.rows:
+            return False
+        if EXACT_TEXT_TYPES.issuperset(first.columns):
+            return False
+    return None
+
+
+def get_columns(cursor: Cursor, query: str) -> Tuple[int, ...]:
+
+    """ Returns types of the columns of the query result without execution """
+
+    cursor.execute(get_columns_sql(query))
+    return tuple(column.type_code for column in cursor.description)
+
+
+def get_fingerprint(
+    cursor: Cursor,
+    query: str,
+    ordered: bool = False
+) -> ResultFingerprint:
+
+    """ Executes the query and returns the fingerprint of its result """
+
+    columns = get_columns(cursor, query)
+    cursor.execute(get_fingerprint_sql(query, ordered))
+    rows, first_hash, second_hash = cursor.fetchone()
+    return ResultFingerprint(
+        columns=columns,
+        rows=rows,
+        hash=(first_hash, second_hash)
+    )
+
+
+def compare_exactly(
+    cursor: Cursor,
+    first_query: str,
+    second_query: str,
+    ordered: bool = False
+) -> bool:
+
+    """ Compares results of the queries with EXCEPT ALL """
+
+    try:
+        cursor.execute(get_exact_sql(first_query, second_query, ordered))
+    except psycopg2.errors.SyntaxError as e:
+        if is_columns_mismatch(e):
+            raise exceptions.CheckException()
+        raise
+    return cursor.fetchone()[0]
+
+
+def compare(
+    cursor: Cursor,
+    first_query: str,
+    second_query: str,
+    ordered: bool = False,
+    fingerprints: Dict[str, ResultFingerprint] = None,
+) -> bool:
+
+    """
+    Returns True if the queries return identical rows
+    ordered - rows must also be in the same order
+    fingerprints - fingerprints of the already executed queries,
+      calculated fingerprints are saved here
+    """
+
+    if fingerprints is None:
+        fingerprints = {}
+    # настройки могли быть изменены запросом пользователя
+    cursor.execute(*get_settings_sql())
+    for query in (first_query, second_query):
+        if query not in fingerprints:
+            fingerprints[query] = get_fingerprint(
+                cursor, clean_sql(query), ordered
+            )
+    result = check_fingerprints(
+        fingerprints[first_query],
+        fingerprints[second_query]
+    )
+    if result is None:
+        result = compare_exactly(
+            cursor, clean_sql(first_query), clean_sql(second_query), ordered
+        )
+    return result
@@ -1,3 +1,4 @@
 from collections import namedtuple
 
 ExecuteResult = namedtuple('ExecuteResult', ('result', 'error'))
+ResultFingerprint = namedtuple('ResultFingerprint', ('columns', 'rows', 'hash'))
@@ -14,13 +14,54 @@ class DbStatus:
 
     ACTIVE = 'active'
     NOT_EXISTS = 'not exists'
+    EVICTED = 'evicted'
 
-    VALUES = (ACTIVE, NOT_EXISTS)
+    VALUES = (ACTIVE, NOT_EXISTS, EVICTED)
 
 
 class DebugFormat:
 
     TABULAR = 'tabular'
     ARRAY = 'array'
+    PLAN = 'plan'
 
-    VALUES = (TABULAR, ARRAY)
+    VALUES = (TABULAR, ARRAY, PLAN)
+
+
+class Durability:
+
+    FULL = 'full'
+    UNLOGGED = 'unlogged'
+
+    VALUES = (FULL, UNLOGGED)
+
+
+class JobStatus:
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    VALUES = (QUEUED, RUNNING, DONE, FAILED)
+
+
+class JobPhase:
+
+    LOAD = 'load'
+    ANALYZE = 'analyze'
+    DROP = 'drop'
+    CREATE = 'create'
+    PREWARM = 'prewarm'
+
+    VALUES = (LOAD, ANALYZE, DROP, CREATE, PREWARM)
+
+
+class NamePrefix:
+
+    """ Prefixes of names reserved for the service's own databases """
+
+    LEASE = 'lease_'
+    TEMPLATE = 'tpl_'
+
+    VALUES = (LEASE, TEMPLATE)
@@ -41,3 +41,40 @@ class InvalidCheckCommand(ServiceException):
 
 class CheckException(ServiceException):
     default_message = messages.MSG_8
+
+
+class ConnectionPoolException(ServiceException):
+    default_message = messages.MSG_9
+
+
+class QueryTimeoutException(ServiceException):
+    default_message = messages.MSG_10
+
+
+class ResourceLimitException(ServiceException):
+    default_message = messages.MSG_11
+
+
+class QueueFullException(ServiceException):
+    default_message = messages.MSG_12
+
+    def __init__(
+        self,
+        message: Optional[str] = None,
+        details: Optional[Any] = None,
+        retry_after: int = 1
+    ):
+        self.retry_after = retry_after
+        super().__init__(message, details)
+
+
+class CostLimitException(ServiceException):
+    default_message = messages.MSG_13
+
+
+class LeaseException(ServiceException):
+    default_message = messages.MSG_14
+
+
+class JobNotFound(ServiceException):
+    default_message = messages.MSG_15
@@ -0,0 +1,177 @@
+"""
+Resource limits of the queries executed in sandbox databases.
+Limits are set at the beginning of each transaction by set_config(..., true),
+which is the same as SET LOCAL, so they are reset with the transaction
+and SET commands in the user's code don't affect other requests.
+Global limits are taken from config.SANDBOX_LIMITS and can be overridden
+for the sandbox by the "limits" key of the JSON comment of its database.
+
+Limits of the planner estimates (COST_LIMITS) are set the same way
+as custom settings. The user's statements are explained before execution
+and rejected with CostLimitException if the estimated total cost
+or amount of rows exceeds the limits, so runaway queries don't run
+until the timeout. Estimates are cached by the normalized statement.
+"""
+
+import json
+from typing import Optional, Tuple, List, Dict
+from app import config
+from app.utils import split_sql, normalize_sql
+from app.service import exceptions
+
+
+# SQLSTATE ошибок превышения ограничений
+ERRORS = {
+    '57014': exceptions.QueryTimeoutException,  # query_canceled
+    '55P03': exceptions.QueryTimeoutException,  # lock_not_available
+    '53400': exceptions.ResourceLimitException,  # configuration_limit_exceeded
+}
+
+# ограничения оценки планировщика: параметр настройки и поле плана
+COST_LIMITS = {
+    'sandbox.max_cost': 'Total Cost',
+    'sandbox.max_rows': 'Plan Rows',
+}
+# команды, план которых можно получить EXPLAIN
+EXPLAIN_STATEMENTS = (
+    'select', 'with', 'values', 'table', 'insert', 'update', 'delete'
+)
+
+
+def get_limits_sql() -> Tuple[str, dict]:
+
+    """ Query which sets limits of the current database for the transaction """
+
+    return (
+        """
+        SELECT set_config(limits.key, limits.value, true)
+        FROM jsonb_each_text(
+          %(limits)s::jsonb || COALESCE((
+            SELECT
+              CASE WHEN comment LIKE '{%%' THEN
+                NULLIF(comment::jsonb -> 'limits', 'null')
+              END
+            FROM shobj_description(
+              (SELECT oid FROM pg_database WHERE datname = current_database()),
+              'pg_database'
+            ) AS comment
+          ), '{}')
+        ) AS limits
+        WHERE limits.value <> ''
+        """,
+        {'limits': json.dumps(config.SANDBOX_LIMITS)}
+    )
+
+
+def get_check_limits_sql(limits: dict) -> Tuple[str, dict]:
+
+    """ Query which checks that the values of limits are valid """
+
+    return (
+        """
+        SELECT set_config(limits.key, limits.value, true)
+        FROM jsonb_each_text(%(limits)s::jsonb) AS limits
+        WHERE limits.value <> ''
+        """,
+        {'limits': json.dumps(limits)}
+    )
+
+
+def get_cost_limits_sql() -> Tuple[str, dict]:
+
+    """
+    Query which returns values of COST_LIMITS set for the transaction
+    and the oid of the current database
+    """
+
+    return (
+        """
+        SELECT
+          array_agg(current_setting(name, true) ORDER BY num),
+          (SELECT oid FROM pg_database WHERE datname = current_database())
+        FROM unnest(%(names)s::text[]) WITH ORDINALITY AS names(name, num)
+        """,
+        {'names': list(COST_LIMITS)}
+    )
+
+
+def parse_cost_limits(values: List[Optional[str]]) -> Dict[str, float]:
+
+    """ Returns set limits of COST_LIMITS by fields of the plan """
+
+    limits = {}
+    for field, value in zip(COST_LIMITS.values(), values):
+        try:
+            limits[field] = float(value)
+        except (TypeError, ValueError):
+            continue
+    return limits
+
+
+def is_explainable(statement: str) -> bool:
+    return normalize_sql(statement).lstrip('(').startswith(EXPLAIN_STATEMENTS)
+
+
+def get_explain_statements(code: str) -> List[str]:
+
+    """ Returns statements of the code which can be explained """
+
+    return [
+        statement for statement in split_sql(code)
+        if is_explainable(statement)
+    ]
+
+
+def get_explain_sql(statement: str) -> str:
+    return f'EXPLAIN (FORMAT JSON) {statement}'
+
+
+def get_explain_analyze_sql(statement: str) -> str:
+    return f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}'
+
+
+def get_estimate(plan: list) -> Dict[str, float]:
+
+    """ Returns fields of COST_LIMITS of the plan returned by EXPLAIN """
+
+    node = plan[0]['Plan']
+    return {field: float(node[field]) for field in COST_LIMITS.values()}
+
+
+def check_estimate(estimate: Dict[str, float], limits: Dict[str, float]):
+
+    """ Raises CostLimitException if the estimate exceeds the limits """
+
+    for field, limit in limits.items():
+        if estimate[field] > limit:
+            raise exceptions.CostLimitException(
+                details=f'{field}: {estimate[field]:.0f} > {limit:.0f}'
+            )
+
+
+def get_limit_exception(
+    error: Exception
+) -> Optional[exceptions.ServiceException]:
+
+    """
+    Returns ServiceException if the error is caused by the exceeded limit,
+    errors of psycopg2 and psycopg 3 are supported
+    """
+
+    if isinstance(error, exceptions.CostLimitException):
+        return error
+    code = getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)
+    exception = ERRORS.get(code)
+    if exception:
+        return exception(details=str(error))
+    return None
+
+
+def is_limit_error(error: Optional[str]) -> bool:
+
+    """ True if the error of the test is caused by the exceeded limit """
+
+    return error in {
+        exception.default_message
+        for exception in (*ERRORS.values(), exceptions.CostLimitException)
+    }
@@ -0,0 +1,186 @@
+"""
+Background jobs creating sandboxes, /create/ enqueues the job
+and returns it at once, the job is polled by /jobs/<id>/.
+Jobs are executed by config.JOBS_WORKERS threads of the process
+which has enqueued them. States of jobs are kept for config.JOBS_TTL
+seconds in the store shared by the processes of the server
+(config.JOBS_STORE_PATH), so the job is polled from any process
+"""
+
+import time
+import uuid
+import threading
+from datetime import datetime, timezone
+from dataclasses import replace
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, Callable, Dict, Hashable
+from app import config
+from app.entities import JobData
+from app.service import exceptions
+from app.service.cache import SharedCache
+from app.service.enums import JobStatus
+
+# функция задания вызывается с функцией report(phase, progress)
+Report = Callable[[str, Optional[float]], None]
+
+
+class Job:
+
+    def __init__(self, data: JobData, key: Hashable):
+        self.data = data
+        self.key = key
+        self.future: Optional[Future] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+
+
+class JobQueue:
+
+    """
+    Thread-safe queue of the jobs
+    workers: amount of jobs executed at once
+    max_queue: amount of waiting jobs, QueueFullException is raised
+      when the queue is full
+    ttl: time in seconds finished jobs are kept
+    store: states of the jobs shared by the processes,
+      None - jobs are available only in the process
+    """
+
+    def __init__(
+        self,
+        workers: int = config.JOBS_WORKERS,
+        max_queue: int = config.JOBS_MAX_QUEUE,
+        ttl: float = config.JOBS_TTL,
+        store: Optional[SharedCache] = None
+    ):
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='job'
+        )
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+
+    def _purge(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished > self.ttl:
+                del self._jobs[job_id]
+
+    def _make_data(self, job: Job) -> JobData:
+        data = replace(job.data)
+        if job.started:
+            data.duration = (job.finished or time.monotonic()) - job.started
+        return data
+
+    def _save(self, job: Job):
+        # вызывается под блокировкой, чтобы состояния сохранялись по порядку
+        if self.store:
+            self.store.set(job.data.id, self._make_data(job))
+
+    def submit(
+        self,
+        name: str,
+        key: Hashable,
+        func: Callable[[Report], None]
+    ) -> JobData:
+
+        """
+        Enqueues the job of the sandbox, func is called with the function
+        reporting the phase and the progress of the job.
+        The unfinished job of the sandbox with the same key
+        is returned instead of a new one
+        """
+
+        with self._lock:
+            self._purge()
+            queued = 0
+            for job in self._jobs.values():
+                if job.finished:
+                    continue
+                if job.data.name == name and job.key == key:
+                    return self._make_data(job)
+                if job.data.status == JobStatus.QUEUED:
+                    queued += 1
+            if queued >= self.max_queue:
+                raise exceptions.QueueFullException(
+                    details=f'{queued} jobs are waiting'
+                )
+            job = Job(
+                data=JobData(
+                    id=uuid.uuid4().hex,
+                    name=name,
+                    created_at=datetime.now(timezone.utc).isoformat()
+                ),
+                key=key
+            )
+            self._jobs[job.data.id] = job
+            self._save(job)
+            job.future = self._executor.submit(self._run, job, func)
+            return self._make_data(job)
+
+    def _report(self, job: Job, phase: str, progress: Optional[float] = None):
+        with self._lock:
+            job.data.phase = phase
+            job.data.progress = progress
+            self._save(job)
+
+    def _run(self, job: Job, func: Callable[[Report], None]):
+        with self._lock:
+            job.data.status = JobStatus.RUNNING
+            job.started = time.monotonic()
+            self._save(job)
+        try:
+            func(partial(self._report, job))
+        except Exception as e:
+            with self._lock:
+                job.data.status = JobStatus.FAILED
+                job.data.error = getattr(e, 'message', str(e))
+                job.data.details = getattr(e, 'details', None)
+                job.finished = time.monotonic()
+                self._save(job)
+            raise
+        with self._lock:
+            job.data.status = JobStatus.DONE
+            job.data.progress = 1.0
+            job.finished = time.monotonic()
+            self._save(job)
+
+    def get(self, job_id: str) -> JobData:
+
+        """
+        Returns the job, the job of another process is returned
+        from the store, raises JobNotFound if there is no such job
+        """
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._make_data(job)
+        data = self.store.get(job_id) if self.store else None
+        if data is None:
+            raise exceptions.JobNotFound(details=job_id)
+        return data
+
+    def future(self, job_id: str) -> Future:
+
+        """ Returns the future of the job, its result raises the error """
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise exceptions.JobNotFound(details=job_id)
+            return job.future
+
+
+jobs = JobQueue(
+    store=SharedCache(
+        name='jobs',
+        path=config.JOBS_STORE_PATH,
+        max_bytes=config.JOBS_STORE_MAX_BYTES,
+        ttl=config.JOBS_TTL
+    ) if config.JOBS_STORE_PATH else None
+)
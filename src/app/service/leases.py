@@ -0,0 +1,92 @@
+"""
+Pool of the ready clones of sandboxes, which are leased by sessions
+as private sandboxes (see PostgresqlService.lease).
+Ready clones are created in background by each process for itself,
+so a clone is handed out by one process only. Leased clones are tracked
+by the expiration time in the comment of their databases, so they are
+reclaimed by any process (see PostgresqlService.reap_leases)
+"""
+
+import threading
+from collections import deque
+from typing import Optional, Dict, Deque, Tuple, List
+from app import config
+
+
+class LeasePool:
+
+    """
+    Thread-safe pool of ready clones of sandboxes
+    size: amount of ready clones kept for each leased sandbox
+    """
+
+    def __init__(self, size: int = config.LEASE_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        # имя песочницы -> (база клона, комментарий базы клона)
+        self._ready: Dict[str, Deque[Tuple[str, dict]]] = {}
+        self._pending: Dict[str, int] = {}
+
+    def pop(self, name: str) -> Optional[Tuple[str, dict]]:
+
+        """ Takes the ready clone of the sandbox, None if there is none """
+
+        with self._lock:
+            ready = self._ready.get(name)
+            return ready.popleft() if ready else None
+
+    def reserve(self, name: str) -> int:
+
+        """
+        Returns amount of clones which have to be created
+        to fill the pool of the sandbox, the caller has to add
+        or cancel each of them
+        """
+
+        with self._lock:
+            amount = (
+                self.size -
+                len(self._ready.get(name, ())) -
+                self._pending.get(name, 0)
+            )
+            if amount <= 0:
+                return 0
+            self._pending[name] = self._pending.get(name, 0) + amount
+            return amount
+
+    def add(self, name: str, db_name: str, comment: dict):
+
+        """ Adds the created clone of the reserved ones """
+
+        with self._lock:
+            self._pending[name] -= 1
+            self._ready.setdefault(name, deque()).append((db_name, comment))
+
+    def cancel(self, name: str):
+
+        """ Cancels the reserved clone which hasn't been created """
+
+        with self._lock:
+            self._pending[name] -= 1
+
+    def clear(self, name: str) -> List[str]:
+
+        """ Removes ready clones of the sandbox and returns their databases """
+
+        with self._lock:
+            ready = self._ready.pop(name, ())
+            return [db_name for db_name, _ in ready]
+
+    def remove(self, db_names: List[str]):
+
+        """ Removes clones whose databases were dropped """
+
+        db_names = set(db_names)
+        with self._lock:
+            for name, ready in self._ready.items():
+                self._ready[name] = deque(
+                    item for item in ready if item[0] not in db_names
+                )
+
+
+leases = LeasePool()
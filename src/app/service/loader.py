@@ -0,0 +1,237 @@
+"""
+Loader of SQL files (plain pg_dump dumps and SQL scripts) into the database.
+The file is read line by line and split into statements, statements
+are sent to the server in batches, data of COPY ... FROM stdin sections
+is sent by copy_expert, the whole file is loaded in one transaction.
+
+The file is decoded as latin-1, which maps each byte to one character,
+so the text is sent to the server byte to byte as by psql, whatever
+client_encoding the dump sets.
+
+Like pg_restore --no-owner --no-privileges, ownership and privileges
+are not restored: the database belongs to the service user.
+Meta-commands of psql (\\connect, \\restrict, ...) are skipped.
+CREATE INDEX statements followed by data are executed after the data
+is loaded, so indexes are built once instead of being updated by each row.
+"""
+
+import os
+from typing import Optional, Callable, Iterator, Tuple, List
+import psycopg2
+from psycopg2.extensions import connection, cursor as Cursor
+from app import config
+from app.utils import scan_sql, split_sql, normalize_sql
+from app.service import exceptions
+from app.service.pool import connect
+from app.logger import get_logger
+logger = get_logger()
+
+ENCODING = 'latin-1'
+COPY_END = b'\\.'
+# длина начала команды, по которому определяется ее тип
+HEAD_SIZE = 4096
+
+
+class CopyData:
+
+    """ File-like object reading data of the COPY section of the file """
+
+    def __init__(self, loader: 'SqlFileLoader'):
+        self.loader = loader
+        self.finished = False
+
+    def read(self, size: int = -1) -> bytes:
+        chunks, length = [], 0
+        while not self.finished and (size < 0 or length < size):
+            line = self.loader._readline()
+            if not line or line.rstrip(b'\r\n') == COPY_END:
+                self.finished = True
+            else:
+                chunks.append(line)
+                length += len(line)
+        return b''.join(chunks)
+
+
+class SqlFileLoader:
+
+    """
+    file_path: path to the SQL file
+    progress: function called with the amount of read bytes
+      and the size of the file while loading
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        progress: Optional[Callable[[int, int], None]] = None
+    ):
+        self.file_path = file_path
+        self.progress = progress
+        self.size = os.path.getsize(file_path)
+        self.position = 0
+        self.line_num = 0
+        self._file = None
+        self._reported = 0
+        self._batch: List[Tuple[int, str]] = []
+        self._batch_size = 0
+        self._indexes: List[Tuple[int, str]] = []
+
+    def _readline(self) -> bytes:
+        line = self._file.readline()
+        self.position += len(line)
+        self.line_num += 1
+        if self.position - self._reported >= config.LOADER_PROGRESS_STEP:
+            self._report()
+        return line
+
+    def _report(self):
+        self._reported = self.position
+        logger.info(
+            f'{self.file_path}: loaded {self.position} of {self.size} bytes'
+        )
+        if self.progress:
+            self.progress(self.position, self.size)
+
+    def _statements(self) -> Iterator[Tuple[int, str]]:
+
+        """
+        Yields statements of the file with numbers of their first lines,
+        a statement is complete when it's followed by a semicolon
+        outside strings and comments
+        """
+
+        buffer, start = '', 1
+        while True:
+            line = self._readline()
+            if not line:
+                break
+            text = line.decode(ENCODING)
+            if text.startswith('\\') and all(
+                kind in ('space', 'comment') for kind, _ in scan_sql(buffer)
+            ):
+                logger.debug(f'{self.file_path}: skipped {text.strip()}')
+                buffer, start = '', self.line_num + 1
+                continue
+            if not buffer.strip():
+                start = self.line_num
+            buffer += text
+            if ';' not in text:
+                continue
+            end, position = 0, 0
+            for kind, token in scan_sql(buffer):
+                position += len(token)
+                if kind == 'semicolon':
+                    end = position
+            if end:
+                for statement in split_sql(buffer[:end]):
+                    yield start, statement
+                buffer, start = buffer[end:], self.line_num + 1
+        for statement in split_sql(buffer):
+            yield start, statement
+
+    def _execute(self, cursor: Cursor, statements: List[Tuple[int, str]]):
+
+        """
+        Executes statements by one query, if it fails statements are
+        executed one by one to find the line of the failed statement
+        """
+
+        if not statements:
+            return
+        cursor.execute('SAVEPOINT loader')
+        try:
+            cursor.execute(
+                ';\n'.join(statement for _, statement in statements)
+                .encode(ENCODING)
+            )
+        except psycopg2.Error:
+            cursor.execute('ROLLBACK TO SAVEPOINT loader')
+            for line_num, statement in statements:
+                try:
+                    cursor.execute(statement.encode(ENCODING))
+                except psycopg2.Error as e:
+                    raise exceptions.CreationException(
+                        details=f'{self.file_path}, line {line_num}: {e}'
+                    )
+        cursor.execute('RELEASE SAVEPOINT loader')
+
+    def _add(self, cursor: Cursor, line_num: int, statement: str):
+        self._batch.append((line_num, statement))
+        self._batch_size += len(statement)
+        if self._batch_size >= config.LOADER_BATCH_SIZE:
+            self._flush(cursor)
+
+    def _flush(self, cursor: Cursor):
+        self._execute(cursor, self._batch)
+        self._batch, self._batch_size = [], 0
+
+    def _flush_indexes(self, cursor: Cursor):
+        self._flush(cursor)
+        self._execute(cursor, self._indexes)
+        self._indexes = []
+
+    def _copy(self, cursor: Cursor, line_num: int, statement: str):
+        self._flush(cursor)
+        data = CopyData(self)
+        try:
+            cursor.copy_expert(
+                statement.encode(ENCODING),
+                data,
+                size=config.LOADER_COPY_BUFFER
+            )
+        except psycopg2.Error as e:
+            raise exceptions.CreationException(
+                details=f'{self.file_path}, line {line_num}: {e}'
+            )
+
+    def _load(self, cursor: Cursor):
+        cursor.execute(
+            'SET LOCAL maintenance_work_mem = %(value)s',
+            {'value': config.LOADER_MAINTENANCE_WORK_MEM}
+        )
+        for line_num, statement in self._statements():
+            head = normalize_sql(statement[:HEAD_SIZE])
+            if head.startswith((
+                'grant ', 'revoke ', 'alter default privileges '
+            )) or (
+                head.startswith('alter ') and ' owner to ' in head
+            ):
+                continue
+            if head.startswith('copy ') and 'from stdin' in head:
+                self._copy(cursor, line_num, statement)
+            elif head.startswith(('create index ', 'create unique index ')):
+                self._indexes.append((line_num, statement))
+            elif (
+                head.startswith('insert ') and
+                'on conflict' not in statement.lower()
+            ) or head.startswith('select pg_catalog.setval('):
+                self._add(cursor, line_num, statement)
+            else:
+                # индексы нужны следующим командам, кроме загрузки данных
+                self._flush_indexes(cursor)
+                self._add(cursor, line_num, statement)
+        self._flush_indexes(cursor)
+
+    def load(self, db_name: str):
+
+        """ Loads the file into the database in one transaction """
+
+        con: Optional[connection] = None
+        try:
+            con = connect(db_name)
+            with open(self.file_path, 'rb') as self._file:
+                with con.cursor() as cursor:
+                    self._load(cursor)
+            con.commit()
+            self._report()
+        except exceptions.CreationException as e:
+            logger.error(e.details)
+            raise
+        except Exception as e:
+            logger.error(e)
+            raise exceptions.CreationException(
+                details=f'{self.file_path}, line {self.line_num}: {e}'
+            )
+        finally:
+            if con is not None:
+                con.close()
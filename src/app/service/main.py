@@ -1,23 +1,66 @@
 import os
+import json
+import hashlib
+import secrets
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+from contextlib import contextmanager
 import psycopg2
-from typing import Optional, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, Tuple, Dict, Iterator, Sequence, Callable
 from tabulate import tabulate
-from psycopg2.extensions import (
-    AsIs,
-    ISOLATION_LEVEL_AUTOCOMMIT,
-)
+from psycopg2.extensions import AsIs, connection, cursor as Cursor
 from typing import List
 from app.entities import (
     DebugData,
+    TestData,
     TestingData,
+    TestingBatchData,
+    CreateData,
+    BulkData,
+    BulkItemData,
+    JobData,
+    LeaseData,
     StatusData,
+    StatsData,
 )
 from app import config
-from app.service import exceptions
+from app.utils import (
+    get_file_hash,
+    normalize_sql,
+    clean_sql,
+    split_sql,
+)
+from app.service import exceptions, comparison, governor
+from app.service.entities import ResultFingerprint
+from app.service.pool import pools, connect
+from app.service.loader import SqlFileLoader
+from app.service.archive import (
+    is_archive,
+    get_archive_path,
+    restore_archive,
+    compile_archive,
+    delete_stale_archives,
+)
+from app.service.cache import (
+    reference_cache,
+    plan_cache,
+    verdict_cache,
+    debug_cache,
+)
+from app.service.scheduler import scheduler
+from app.service.registry import registry
+from app.service.leases import leases
+from app.service.jobs import jobs, Report
 from app.service.enums import (
     SQLCommandType,
     DbStatus,
     DebugFormat,
+    Durability,
+    JobPhase,
+    NamePrefix,
 )
 from app.logger import get_logger
 logger = get_logger()
@@ -26,400 +69,2420 @@ logger = get_logger()
 class PostgresqlService:
 
     db_name_prefix = 'sandbox_'
+    template_db_name_prefix = f'{db_name_prefix}{NamePrefix.TEMPLATE}'
+    lease_name_prefix = NamePrefix.LEASE
+    student_result_table = 'sandbox_student_result'
+    deterministic_view = 'sandbox_deterministic'
+    evicted_table = 'sandbox_evicted'
+    cursor_statements = ('select', 'with', 'values', 'table')
+    # ошибки DECLARE для запросов, которые выполняются без курсора
+    cursor_rejections = (
+        'DECLARE CURSOR must not contain data-modifying statements in WITH',
+        'SELECT ... INTO is not allowed here',
+    )
+    _templates_lock = threading.Lock()
+    _template_locks: Dict[str, threading.Lock] = {}
+    _testing_executor = ThreadPoolExecutor(
+        max_workers=config.TESTING_MAX_WORKERS,
+        thread_name_prefix='testing'
+    )
+    _testing_slots = threading.BoundedSemaphore(config.TESTING_MAX_WORKERS)
+    _bulk_load_executor = ThreadPoolExecutor(
+        max_workers=config.BULK_LOAD_WORKERS,
+        thread_name_prefix='bulk_load'
+    )
+    _bulk_executor = ThreadPoolExecutor(
+        max_workers=config.BULK_WORKERS,
+        thread_name_prefix='bulk'
+    )
+    _lease_executor = ThreadPoolExecutor(
+        max_workers=config.LEASE_WORKERS,
+        thread_name_prefix='lease'
+    )
+    _evicted_table_ready = False
+    _eviction_thread: Optional[threading.Thread] = None
+    _lease_thread: Optional[threading.Thread] = None
 
     @classmethod
     def _get_db_name(cls, name: str) -> str:
         return f'{cls.db_name_prefix}{name}'
 
+    @classmethod
+    def _get_template_db_name(cls, file_hash: str) -> str:
+        return f'{cls.template_db_name_prefix}{file_hash}'
+
+    @classmethod
+    def _get_file_path(cls, filename: str) -> str:
+        file_path = f'{config.SQL_FILES_DIR}/{filename}'
+        if not os.path.exists(file_path):
+            raise exceptions.FileNotFound()
+        return file_path
+
+    @classmethod
+    def _invalidate(cls, db_name: str):
+
+        """ Closes connections and clears cached data of the database """
+
+        pools.invalidate(db_name)
+        reference_cache.invalidate(lambda key: key[0] == db_name)
+        plan_cache.invalidate(lambda key: key[0] == db_name)
+        verdict_cache.invalidate(lambda key: key[0] == db_name)
+        debug_cache.invalidate(lambda key: key[0] == db_name)
+
+    @classmethod
+    def _get_db_version(cls, cursor: Cursor) -> int:
+
+        """
+        Returns the version of the database of the cursor,
+        each (re)creation of the database gives a new version
+        """
+
+        cursor.execute(
+            'SELECT oid FROM pg_database WHERE datname = current_database()'
+        )
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def _get_db_oid(cls, db_name: str) -> Optional[int]:
+
+        """
+        Returns the version of the database by its name (see _get_db_version),
+        None if the database doesn't exist. The version is read
+        from the server, so it is current in all processes of the server
+        """
+
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute(
+                    'SELECT oid FROM pg_database WHERE datname = %(db_name)s',
+                    {'db_name': db_name}
+                )
+                row = cursor.fetchone()
+        return row[0] if row else None
+
     @classmethod
     def _delete_database(cls, name: str):
-        con = None
+        cls._drop_database(cls._get_db_name(name))
+        registry.remove(name)
+
+    @classmethod
+    @contextmanager
+    def _advisory_lock(cls, key: str, wait: bool = True) -> Iterator[bool]:
+
+        """
+        Holds the advisory lock with the given key in the default database,
+        yields False without waiting if wait is False
+        and the lock is held by another session.
+        The lock is held on its own connection, not a pooled one:
+        the holder creating the sandbox takes connections from the pool
+        of the default database, so waiting holders would exhaust it
+        """
+
+        con = connect()
         try:
-            con = psycopg2.connect(**config.PSQL_CONFIG)
-            if config.DEBUG:
-                con.initialize(logger)
-            con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            cursor = con.cursor()
-            cursor.execute(
-                'DROP DATABASE IF EXISTS %(db_name)s WITH (FORCE)',
-                {'db_name': AsIs(cls._get_db_name(name))}
-            )
+            con.autocommit = True
+            with con.cursor() as cursor:
+                cursor.execute(
+                    'SELECT %(function)s(hashtext(%(key)s))',
+                    {
+                        'function': AsIs(
+                            'pg_advisory_lock' if wait
+                            else 'pg_try_advisory_lock'
+                        ),
+                        'key': key
+                    }
+                )
+                # блокировка снимается при закрытии соединения
+                yield cursor.fetchone()[0] is not False
+        finally:
+            con.close()
+
+    @classmethod
+    def _drop_database(cls, db_name: str):
+        cls._invalidate(db_name)
+        try:
+            with pools.connection(autocommit=True) as con:
+                with con.cursor() as cursor:
+                    cursor.execute(
+                        'DROP DATABASE IF EXISTS %(db_name)s WITH (FORCE)',
+                        {'db_name': AsIs(db_name)}
+                    )
         except Exception as e:
             logger.error(e)
             raise exceptions.DeletionException(details=str(e))
-        finally:
-            if con:
-                con.close()
 
     @classmethod
-    def _create_database(cls, name: str):
-        con = None
+    def _create_database(cls, db_name: str, template: Optional[str] = None):
+        cls._invalidate(db_name)
         try:
-            con = psycopg2.connect(**config.PSQL_CONFIG)
-            if config.DEBUG:
-                con.initialize(logger)
-            con.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            cursor = con.cursor()
-            cursor.execute(
-                'CREATE DATABASE %(db_name)s '
-                'WITH OWNER = %(user)s',
-                {
-                    'db_name': AsIs(cls._get_db_name(name)),
-                    'user': AsIs(config.PSQL_USER)
-                }
-            )
+            with pools.connection(autocommit=True) as con:
+                with con.cursor() as cursor:
+                    cursor.execute(
+                        'CREATE DATABASE %(db_name)s '
+                        'WITH OWNER = %(user)s '
+                        'TEMPLATE = %(template)s',
+                        {
+                            'db_name': AsIs(db_name),
+                            'user': AsIs(config.PSQL_USER),
+                            'template': AsIs(template or 'template1')
+                        }
+                    )
         except Exception as e:
             logger.error(e)
             raise exceptions.CreationException(details=str(e))
-        finally:
-            if con:
-                con.close()
 
     @classmethod
-    def _load_database_from_file(cls, name: str, filename: str):
+    def _get_db_comment(cls, db_name: str) -> dict:
 
-        file_path = f'{config.SQL_FILES_DIR}/{filename}'
-        if not os.path.exists(file_path):
-            raise exceptions.FileNotFound()
-        command = (
-            f'export PGPASSWORD={config.PSQL_PASSWORD} && '
-            f'psql -U {config.PSQL_USER} '
-            f'-h {config.PSQL_HOST} '
-            f'-p {config.PSQL_PORT} '
-            f'{cls._get_db_name(name)} < {file_path}'
-        )
-        logger.debug(command)
+        """
+        Returns metadata of the sandbox saved as JSON
+        in the comment of its database, empty dict if there is no metadata
+        """
+
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute(
+                    "SELECT shobj_description(oid, 'pg_database') "
+                    "FROM pg_database WHERE datname = %(db_name)s",
+                    {'db_name': db_name}
+                )
+                row = cursor.fetchone()
+        if not row or not row[0] or not row[0].startswith('{'):
+            return {}
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return {}
+
+    @classmethod
+    def _set_db_comment(cls, db_name: str, comment: dict):
         try:
-            os.system(command)
+            with pools.connection(autocommit=True) as con:
+                with con.cursor() as cursor:
+                    cursor.execute(
+                        'COMMENT ON DATABASE %(db_name)s IS %(comment)s',
+                        {
+                            'db_name': AsIs(db_name),
+                            'comment': json.dumps(comment)
+                        }
+                    )
         except Exception as e:
             logger.error(e)
             raise exceptions.CreationException(details=str(e))
 
     @classmethod
-    def _check_select_command(
-        cls,
-        name: str,
-        student_command: str,
-        true_command: str
-    ) -> bool:
+    def _get_checksum_sql(cls) -> str:
 
         """
-        execute select query
-        name - database for the query
-        student_command - query sent by the user
-        true_command - command that successfully solves the task
-
-        return True if select rows by student_command identical rows
-        from the true_command.
+        Query which returns the checksum of the schema and data of the database.
+        Data is not read: changes of rows are detected by committed changes
+        counted by the statistics collector (n_mod_since_analyze is reset by
+        ANALYZE, so the amount of analyzes is taken into account too),
+        TRUNCATE and table rewrites change the file of the table.
+        Statistics are reported by backends with a delay of a few seconds,
+        so changes made just before the check may be not detected
+        """
 
-        Example:
-            student_command: SELECT title FROM tasks_task LIMIT 10
-            true_command: SELECT title FROM tasks_task LIMIT 10 OFFSET 0
+        return """
+            SELECT md5(COALESCE(string_agg(item, ',' ORDER BY item), ''))
+            FROM (
+              SELECT concat_ws(
+                ':',
+                c.oid::regclass,
+                c.relkind,
+                pg_relation_filenode(c.oid),
+                (
+                  SELECT string_agg(
+                    a.attname || ' ' || format_type(a.atttypid, a.atttypmod),
+                    ', ' ORDER BY a.attnum
+                  )
+                  FROM pg_attribute AS a
+                  WHERE a.attrelid = c.oid
+                    AND a.attnum > 0
+                    AND NOT a.attisdropped
+                ),
+                s.n_mod_since_analyze,
+                s.analyze_count + s.autoanalyze_count
+              ) AS item
+              FROM pg_class AS c
+              JOIN pg_namespace AS n ON n.oid = c.relnamespace
+              LEFT JOIN pg_stat_user_tables AS s ON s.relid = c.oid
+              WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname NOT LIKE 'pg\\_%%'
+              UNION ALL
+              SELECT concat_ws(':', p.oid::regprocedure, md5(p.prosrc))
+              FROM pg_proc AS p
+              JOIN pg_namespace AS n ON n.oid = p.pronamespace
+              WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+                AND n.nspname NOT LIKE 'pg\\_%%'
+            ) AS items
         """
 
-        try:
-            with psycopg2.connect(
-                **config.PSQL_CONFIG,
-                database=cls._get_db_name(name)
-            ) as con:
-                if config.DEBUG:
-                    con.initialize(logger)
-                with con.cursor() as cursor:
-                    cursor.execute(f"""
-                        SELECT
-                          CASE
-                            WHEN NOT EXISTS (
-                              SELECT *
-                              FROM (
-                                ({student_command})
-                                EXCEPT ALL
-                                ({true_command})
-                              ) AS first_command
-                              UNION ALL
-                              SELECT *
-                              FROM (
-                                ({true_command})
-                                EXCEPT ALL
-                                ({student_command})
-                              ) AS second_command
-                            ) THEN TRUE
-                            ELSE FALSE
-                          END
-                    """)
-                    result = cursor.fetchone()
-                con.rollback()
-        except psycopg2.errors.SyntaxError as e:
-            if 'each EXCEPT query must have the same number of columns' in str(e):
-                raise exceptions.CheckException()
-            raise
-        return result[0]
+    @classmethod
+    def _get_db_checksum(cls, db_name: str) -> str:
+        with pools.connection(db_name) as con:
+            with con.cursor() as cursor:
+                cursor.execute(cls._get_checksum_sql(), {})
+                return cursor.fetchone()[0]
 
     @classmethod
-    def _check_delete_command(
+    def _is_db_current(
         cls,
-        name: str,
-        student_command: str,
-        check_command: str
+        db_name: str,
+        filename: str,
+        file_hash: str,
+        limits: Optional[dict] = None,
+        durability: str = Durability.FULL
     ) -> bool:
-        """
-        execute query DELETE
-        name - database for the query
-        student_command - query sent by the user
-        true_command - command that checks changed database
-        return True if deleted row not exist in result.
 
-        Example:
-            student_command: DELETE FROM tasks_task WHERE id IN (25, 35)
-            check_command: SELECT title FROM tasks_task WHERE id IN (25, 35)
+        """
+        True if the database was created from the same content
+        of the file with the same limits and durability
+        and hasn't been changed since
         """
 
-        with psycopg2.connect(
-            **config.PSQL_CONFIG,
-            database=cls._get_db_name(name)
-        ) as con:
-            if config.DEBUG:
-                con.initialize(logger)
-            with con.cursor() as cursor:
-                cursor.execute(student_command)
-                cursor.execute(f"""
-                    SELECT 
-                      CASE 
-                        WHEN NOT EXISTS (
-                          {check_command}
-                        ) THEN TRUE
-                        ELSE FALSE
-                      END 
-                """)
-                result = cursor.fetchone()
-            con.rollback()
-        return result[0]
+        try:
+            comment = cls._get_db_comment(db_name)
+            return (
+                comment.get('filename') == filename and
+                comment.get('hash') == file_hash and
+                (comment.get('limits') or None) == (limits or None) and
+                comment.get('durability', Durability.FULL) == durability and
+                comment.get('checksum') == cls._get_db_checksum(db_name)
+            )
+        except Exception as e:
+            logger.error(e)
+            return False
 
     @classmethod
-    def _check_update_or_insert_command(
+    def _load_database_from_file(
         cls,
-        name: str,
-        student_command: str,
-        check_code: str
-    ) -> bool:
+        db_name: str,
+        file_path: str,
+        progress: Optional[Callable[[int, int], None]] = None
+    ):
+
+        """
+        Loads the SQL file into the database, see SqlFileLoader
+        progress: function called with the amount of loaded bytes
+          and the size of the file
         """
-        execute query UPDATE/INSERT
-        name - database for the query
-        student_command - query sent by the user
-        check_command - select command that checks changed database
-          (1st line is amount of objects returned)
-        return True if count rows from db equal check_command count
 
-          Example check_command for UPDATE:
-            student_command:
-                UPDATE tasks_task SET title='test' WHERE id=50
-            check_code:
-                1
-                SELECT title FROM tasks_task WHERE id=50 AND title='test
+        SqlFileLoader(file_path=file_path, progress=progress).load(db_name)
+
+    @classmethod
+    def _restore_database(
+        cls,
+        db_name: str,
+        filename: str,
+        file_path: str,
+        file_hash: str,
+        progress: Optional[Callable[[int, int], None]] = None
+    ):
 
-          Example check_command for INSERT:
-            student_command:
-                INSERT INTO tasks_task (title, lang) VALUES ('test', 'psql')
-            check_code:
-                1
-                SELECT title
-                FROM tasks_task
-                WHERE title='test' AND lang = 'psql'
         """
-        with psycopg2.connect(
-            **config.PSQL_CONFIG,
-            database=cls._get_db_name(name)
-        ) as con:
-            if config.DEBUG:
-                con.initialize(logger)
-            with con.cursor() as cursor:
+        Fills the database from the file:
+        the custom format archive is restored by parallel jobs,
+        the SQL file is restored from its compiled archive if it exists,
+        otherwise the file is loaded and compiled into the archive
+        """
+
+        archive_path = get_archive_path(filename, file_hash)
+        if is_archive(file_path):
+            restore_archive(db_name, file_path)
+        elif archive_path and os.path.isdir(archive_path):
+            restore_archive(db_name, archive_path)
+        else:
+            cls._load_database_from_file(db_name, file_path, progress)
+            if archive_path:
                 try:
-                    expected_rows_count = int(check_code.split("\n", 1)[0])
-                    check_command = check_code.split("\n", 1)[1]
+                    compile_archive(db_name, archive_path)
                 except Exception as e:
-                    raise exceptions.InvalidCheckCommand(details=str(e))
-                else:
-                    cursor.execute(student_command)
-                    cursor.execute(
-                        'SELECT COUNT(*) '
-                        f'FROM ({check_command}) AS check_result'
-                    )
-                    rows_count = cursor.fetchone()[0]
-                    con.rollback()
-                    return rows_count == expected_rows_count
+                    # база загружена, архив будет создан при следующей загрузке
+                    logger.error(e)
 
     @classmethod
-    def _test(
+    def _get_templates(cls) -> List[Tuple[str, Optional[str]]]:
+
+        """ Returns names of template databases and their source files """
+
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute(
+                    'SELECT datname, '
+                    "  shobj_description(oid, 'pg_database') "
+                    'FROM pg_database '
+                    'WHERE datname LIKE %(template)s',
+                    {'template': f'{cls.template_db_name_prefix}%'}
+                )
+                return cursor.fetchall()
+
+    @classmethod
+    def _create_template(
         cls,
-        check_code: str,
-        name: str,
-        code: str,
-        request_type: SQLCommandType
-    ) -> Tuple[bool, Optional[str]]:
+        filename: str,
+        report: Optional[Report] = None
+    ) -> str:
+
+        """
+        Loads the file into the template database once,
+        the template is versioned by the hash of the file content
+        and rebuilt only when the file changes.
+        report: function called with the phase and the progress of loading
+        Returns the name of the template database
         """
-        runs a test during testing
-        name: str, query database
-        code: str, user's query
-        check_code: str, code for checking the query result
-        request_type: type of a query SELECT/DELETE/UPDATE/INSERT
-        returns two values: ok and error message """
 
-        ok, error = False, None
-        try:
-            if request_type == SQLCommandType.SELECT:
-                ok = cls._check_select_command(
-                    name=name,
-                    student_command=code,
-                    true_command=check_code
-                )
-            elif request_type == SQLCommandType.DELETE:
-                ok = cls._check_delete_command(
-                    name=name,
-                    student_command=code,
-                    check_command=check_code
-                )
-            else:
-                ok = cls._check_update_or_insert_command(
-                    name=name,
-                    student_command=code,
-                    check_code=check_code
+        file_path = cls._get_file_path(filename)
+        file_hash = get_file_hash(file_path)
+        db_name = cls._get_template_db_name(file_hash)
+        # шаблоны разных файлов загружаются параллельно
+        with cls._templates_lock:
+            lock = cls._template_locks.setdefault(db_name, threading.Lock())
+        with lock:
+            templates = cls._get_templates()
+            if any(name == db_name for name, _ in templates):
+                return db_name
+
+            # база загружается под временным именем и переименовывается
+            # после загрузки, недозагруженный шаблон не будет использован
+            tmp_db_name = f'{db_name}_{os.getpid()}'
+            cls._drop_database(tmp_db_name)
+            cls._create_database(tmp_db_name)
+            progress = None
+            if report:
+                report(JobPhase.LOAD, 0.0)
+
+                def progress(position: int, size: int):
+                    report(JobPhase.LOAD, position / size if size else None)
+
+            try:
+                cls._restore_database(
+                    db_name=tmp_db_name,
+                    filename=filename,
+                    file_path=file_path,
+                    file_hash=file_hash,
+                    progress=progress
                 )
-        except Exception as e:
-            logger.error(e)
-            ok = False
-            error = str(e)
-        return ok, error
+                if config.WARMUP_VACUUM:
+                    if report:
+                        report(JobPhase.ANALYZE, None)
+                    cls._vacuum_template(tmp_db_name)
+                with pools.connection(autocommit=True) as con:
+                    with con.cursor() as cursor:
+                        cursor.execute(
+                            'ALTER DATABASE %(tmp_db_name)s '
+                            'RENAME TO %(db_name)s',
+                            {
+                                'tmp_db_name': AsIs(tmp_db_name),
+                                'db_name': AsIs(db_name)
+                            }
+                        )
+                        cursor.execute(
+                            'ALTER DATABASE %(db_name)s '
+                            'WITH IS_TEMPLATE true ALLOW_CONNECTIONS false',
+                            {'db_name': AsIs(db_name)}
+                        )
+                        cursor.execute(
+                            'COMMENT ON DATABASE %(db_name)s '
+                            'IS %(filename)s',
+                            {'db_name': AsIs(db_name), 'filename': filename}
+                        )
+            except psycopg2.errors.DuplicateDatabase:
+                # шаблон уже создан другим процессом
+                cls._drop_database(tmp_db_name)
+            except exceptions.CreationException:
+                cls._drop_database(tmp_db_name)
+                raise
+            except Exception as e:
+                logger.error(e)
+                cls._drop_database(tmp_db_name)
+                raise exceptions.CreationException(details=str(e))
+            cls._delete_stale_templates()
+        return db_name
 
     @classmethod
-    def status(cls, name: str) -> StatusData:
+    def _get_server_started(cls) -> str:
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute('SELECT pg_postmaster_start_time()::text')
+                return cursor.fetchone()[0]
 
-        """ Returns the status of the database with the given name """
+    @classmethod
+    def _set_unlogged(cls, db_name: str):
 
-        data = StatusData(
-            status=DbStatus.NOT_EXISTS,
-            name=name
-        )
+        """
+        Converts tables of the database to UNLOGGED and turns off
+        the synchronous commit, so changes of the sandbox are not written
+        to WAL. A logged table can't reference an unlogged one,
+        so referenced tables are converted after the referencing ones,
+        tables which can't be converted remain logged
+        """
+
+        started = time.monotonic()
+        # соединение не из пула: настройки базы применяются к новым сеансам
+        con = connect(db_name)
         try:
-            with psycopg2.connect(**config.PSQL_CONFIG) as con:
-                if config.DEBUG:
-                    con.initialize(logger)
-                with con.cursor() as cursor:
-                    cursor.execute(
-                        'SELECT datname '
-                        'FROM pg_database '
-                        'WHERE datname = %(db_name)s',
-                        {'db_name': cls._get_db_name(name)}
-                    )
-                    if cursor.fetchone():
-                        data.status = DbStatus.ACTIVE
-        except Exception as e:
-            logger.error(e)
-            raise exceptions.StatusCheckException(details=str(e))
-        return data
+            with con.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT c.oid::regclass::text
+                    FROM pg_class AS c
+                    JOIN pg_namespace AS n ON n.oid = c.relnamespace
+                    WHERE c.relkind = 'r'
+                      AND c.relpersistence = 'p'
+                      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+                      AND n.nspname NOT LIKE 'pg\\_%%'
+                    """,
+                    {}
+                )
+                tables = [row[0] for row in cursor.fetchall()]
+                while tables:
+                    failed = []
+                    for table in tables:
+                        cursor.execute('SAVEPOINT unlogged')
+                        try:
+                            cursor.execute(
+                                'ALTER TABLE %(table)s SET UNLOGGED',
+                                {'table': AsIs(table)}
+                            )
+                        except psycopg2.Error as e:
+                            cursor.execute('ROLLBACK TO SAVEPOINT unlogged')
+                            failed.append((table, e))
+                    if len(failed) == len(tables):
+                        for table, e in failed:
+                            logger.warning(
+                                f'{db_name}: {table} remains logged, {e}'
+                            )
+                        break
+                    tables = [table for table, _ in failed]
+                cursor.execute(
+                    'ALTER DATABASE %(db_name)s SET synchronous_commit = off',
+                    {'db_name': AsIs(db_name)}
+                )
+            con.commit()
+        finally:
+            con.close()
+        logger.info(
+            f'{db_name} is unlogged in {time.monotonic() - started:.2f}s'
+        )
 
     @classmethod
-    def status_all(cls) -> List[StatusData]:
+    def _evict_lost(cls, rows: List[tuple]):
 
-        """ Returns a list for all sandbox databases with their statuses """
+        """
+        Unlogged tables are emptied by the recovery after a crash
+        of the server, a crash can't be told apart from a restart,
+        so sandboxes with unlogged tables created before the start
+        of the server are evicted, they are recreated
+        from their source file on access.
+        Called on the refresh of the registry, so locked sandboxes
+        are skipped instead of waiting, they are evicted by the next refresh
+        rows: sandboxes, see _get_sandboxes
+        """
 
-        data = []
-        try:
-            with psycopg2.connect(**config.PSQL_CONFIG) as con:
-                if config.DEBUG:
-                    con.initialize(logger)
-                with con.cursor() as cursor:
-                    cursor.execute(
-                        'SELECT split_part(datname, %(db_name_prefix)s, 2) ' 
-                        'FROM pg_database '
-                        'WHERE datname LIKE %(db_name_prefix_template)s',
-                        {
-                            'db_name_prefix': cls.db_name_prefix,
-                            'db_name_prefix_template': f'{cls.db_name_prefix}%'
-                        }
-                    )
-                    result = cursor.fetchall()
-        except Exception as e:
-            logger.error(e)
-            raise exceptions.StatusCheckException(details=str(e))
-        else:
-            for row in result:
-                data.append(
-                    StatusData(
-                        name=row[0],
-                        status=DbStatus.ACTIVE
-                    )
-                )
-            return data
+        unlogged = []
+        for name, _, comment, status in rows:
+            if status != DbStatus.ACTIVE or not comment:
+                continue
+            if not comment.startswith('{'):
+                continue
+            comment = json.loads(comment)
+            if comment.get('durability') == Durability.UNLOGGED:
+                unlogged.append((name, comment))
+        if not unlogged:
+            return
+        server_started = cls._get_server_started()
+        for name, comment in unlogged:
+            if comment.get('server_started') != server_started:
+                logger.warning(f'{name} is lost after restart of the server')
+                cls._evict(name, wait=False)
 
     @classmethod
-    def create(cls, name: str, filename: str):
+    def _vacuum_template(cls, db_name: str):
+
         """
-        (Re)creates db from file
-        data.filename: database dump file from directory /files
-        Returns state of the database, 'active' - successfully created,
-        'not exists' - error occurred
+        Freezes rows and collects planner statistics of the loaded template,
+        databases cloned from the template inherit statistics, hint bits
+        and visibility maps, so the first queries to them are not planned
+        without statistics and don't rewrite pages to set hint bits
         """
 
-        cls._delete_database(name)
-        cls._create_database(name)
-        cls._load_database_from_file(name=name, filename=filename)
+        started = time.monotonic()
+        # соединение не из пула: шаблон переименовывается после загрузки
+        con = connect(db_name)
+        try:
+            con.autocommit = True
+            with con.cursor() as cursor:
+                cursor.execute('VACUUM (FREEZE, ANALYZE)')
+        finally:
+            con.close()
+        logger.info(
+            f'{db_name} is vacuumed in {time.monotonic() - started:.2f}s'
+        )
 
     @classmethod
-    def delete(cls, name: str):
+    def _get_prewarm_sql(cls) -> str:
 
-        """ Delete the database with the given name """
+        """ Query which returns tables and indexes, smaller ones first """
 
-        cls._delete_database(name)
+        return """
+            SELECT
+              c.oid,
+              c.oid::regclass::text,
+              c.relkind,
+              pg_relation_size(c.oid)
+            FROM pg_class AS c
+            JOIN pg_namespace AS n ON n.oid = c.relnamespace
+            WHERE c.relkind IN ('r', 'm', 'i')
+              AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+              AND n.nspname NOT LIKE 'pg\\_%%'
+            ORDER BY 4, 1
+        """
 
     @classmethod
-    def debug(cls, data: DebugData) -> DebugData:
+    def _prewarm(cls, db_name: str):
+
         """
-        debug query
-        data.request_typ: 'select'/'something else', meaning DELETE/UPDATE/INSERT
-        returns list of bools, corresponding to success or failure of a test
+        Loads tables and indexes of the database into shared_buffers
+        up to config.WARMUP_PREWARM_MAX_BYTES, smaller relations first.
+        The pg_prewarm extension is created in the transaction which
+        is rolled back, so it is not left in the sandbox. Without
+        the extension only tables are read by sequential scans, and only
+        tables smaller than a quarter of shared_buffers are cached by them
         """
-        result = []
-        column_names = None
-        try:
-            with psycopg2.connect(
-                **config.PSQL_CONFIG,
-                database=cls._get_db_name(data.name)
-            ) as con:
-                if config.DEBUG:
-                    con.initialize(logger)
+
+        started = time.monotonic()
+        amount = 0
+        with pools.connection(db_name) as con:
+            try:
                 with con.cursor() as cursor:
-                    cursor.execute(data.code)
-                    if cursor.description:
-                        column_names = [desc[0] for desc in cursor.description]
-                        if data.format == DebugFormat.ARRAY:
-                            result.append(column_names)
-                        for row in cursor.fetchall():
-                            result.append(row)
-                con.rollback()
-        except Exception as e:
-            data.error = str(e)
-        else:
-            if data.format == DebugFormat.TABULAR:
-                if column_names:
-                    data.result = tabulate(
-                        tabular_data=result,
-                        headers=column_names,
-                        tablefmt="psql"
+                    cursor.execute(
+                        'SELECT EXISTS ('
+                        '  SELECT FROM pg_available_extensions '
+                        "  WHERE name = 'pg_prewarm'"
+                        "), pg_size_bytes(current_setting('shared_buffers'))"
                     )
-            else:
-                data.result = result
-        return data
+                    extension, shared_buffers = cursor.fetchone()
+                    if extension:
+                        cursor.execute(
+                            'CREATE EXTENSION IF NOT EXISTS pg_prewarm'
+                        )
+                    cursor.execute(cls._get_prewarm_sql(), {})
+                    for oid, relation, kind, size in cursor.fetchall():
+                        if amount + size > config.WARMUP_PREWARM_MAX_BYTES:
+                            break
+                        if extension:
+                            cursor.execute(
+                                'SELECT pg_prewarm(%(oid)s::regclass)',
+                                {'oid': oid}
+                            )
+                        elif kind != 'i' and size < shared_buffers / 4:
+                            cursor.execute(
+                                'SELECT count(*) FROM ONLY %(relation)s',
+                                {'relation': AsIs(relation)}
+                            )
+                        else:
+                            continue
+                        amount += size
+            finally:
+                con.rollback()
+        logger.info(
+            f'{db_name}: {amount} bytes are prewarmed '
+            f'in {time.monotonic() - started:.2f}s'
+        )
 
     @classmethod
-    def testing(cls, data: TestingData) -> TestingData:
+    def _delete_stale_templates(cls):
+
         """
-        runs _test for all items in data.tests (TestData)
-        returns results of running all tests
+        Deletes templates and compiled archives
+        whose source file was changed or removed
         """
-        for test_data in data.tests:
-            test_data.ok, test_data.error = cls._test(
-                check_code=test_data.data_in,
-                name=data.name,
-                code=data.code,
-                request_type=data.request_type
-            )
-        return data
+
+        for db_name, filename in cls._get_templates():
+            if filename is None:
+                continue
+            file_path = f'{config.SQL_FILES_DIR}/{filename}'
+            if (
+                os.path.exists(file_path) and
+                db_name == cls._get_template_db_name(get_file_hash(file_path))
+            ):
+                continue
+            try:
+                with pools.connection(autocommit=True) as con:
+                    with con.cursor() as cursor:
+                        cursor.execute(
+                            'ALTER DATABASE %(db_name)s '
+                            'WITH IS_TEMPLATE false',
+                            {'db_name': AsIs(db_name)}
+                        )
+                cls._drop_database(db_name)
+            except Exception as e:
+                logger.error(e)
+        delete_stale_archives()
+
+    @classmethod
+    def _get_student_result_sql(cls, student_command: str) -> str:
+        return (
+            f'CREATE TEMP TABLE {cls.student_result_table} AS '
+            f'SELECT * FROM ({clean_sql(student_command)}) AS student_result'
+        )
+
+    @classmethod
+    def _get_delete_check_sql(cls, check_command: str) -> str:
+        return f"""
+            SELECT 
+              CASE 
+                WHEN NOT EXISTS (
+                  {clean_sql(check_command)}
+                ) THEN TRUE
+                ELSE FALSE
+              END 
+        """
+
+    @classmethod
+    def _get_count_check_sql(cls, check_command: str) -> str:
+        return (
+            'SELECT COUNT(*) '
+            f'FROM ({clean_sql(check_command)}) AS check_result'
+        )
+
+    @classmethod
+    def _get_reference_cache_key(
+        cls,
+        db_version: Tuple[str, int],
+        ordered: bool,
+        true_command: str
+    ) -> tuple:
+        return (*db_version, ordered, normalize_sql(true_command))
+
+    @classmethod
+    def _set_limits(cls, cursor: Cursor):
+
+        """ Sets resource limits of the sandbox for the current transaction """
+
+        cursor.execute(*governor.get_limits_sql())
+
+    @classmethod
+    def _check_limits(cls, limits: dict):
+
+        """ Raises CreationException if values of the limits are invalid """
+
+        try:
+            with pools.connection() as con:
+                with con.cursor() as cursor:
+                    cursor.execute(*governor.get_check_limits_sql(limits))
+        except psycopg2.Error as e:
+            logger.error(e)
+            raise exceptions.CreationException(details=str(e))
+
+    @classmethod
+    def _check_cost(cls, cursor: Cursor, code: str):
+
+        """
+        Explains statements of the user's code before execution,
+        raises CostLimitException if the estimate exceeds the limits
+        of the sandbox, estimates are cached for the version of the database.
+        Statements which can't be explained (e.g. using objects created
+        by the previous statements) are not checked
+        """
+
+        cursor.execute(*governor.get_cost_limits_sql())
+        values, db_oid = cursor.fetchone()
+        limits = governor.parse_cost_limits(values)
+        if not limits:
+            return
+        db_name = cursor.connection.info.dbname
+        for statement in governor.get_explain_statements(code):
+            cache_key = (db_name, db_oid, normalize_sql(statement))
+            estimate = plan_cache.get(cache_key)
+            if estimate is None:
+                cursor.execute('SAVEPOINT explain')
+                try:
+                    cursor.execute(governor.get_explain_sql(statement))
+                    estimate = governor.get_estimate(cursor.fetchone()[0])
+                except psycopg2.Error as e:
+                    logger.debug(e)
+                    cursor.execute('ROLLBACK TO SAVEPOINT explain')
+                    continue
+                cursor.execute('RELEASE SAVEPOINT explain')
+                plan_cache.set(cache_key, estimate)
+            governor.check_estimate(estimate, limits)
+
+    @classmethod
+    def _execute_student_command(
+        cls,
+        cursor: Cursor,
+        student_command: str,
+        request_type: SQLCommandType
+    ) -> Tuple[str, Optional[Exception]]:
+
+        """
+        executes the user's query once for all tests of the submission,
+        tests are run afterwards in the same transaction
+        student_command - query sent by the user
+        request_type - type of a query SELECT/DELETE/UPDATE/INSERT
+
+        the result of SELECT is saved into the temporary table,
+        if it can't be saved (e.g. duplicate column names)
+        the query will be executed by each test,
+        the exceeded resource limit is raised instead.
+        DELETE/UPDATE/INSERT changes are kept until the end of the transaction.
+        The query exceeding the cost limits is not executed,
+        CostLimitException is raised
+
+        returns the query which gives the user's result
+        and the error of the user's query
+        """
+
+        cls._check_cost(cursor, student_command)
+        cursor.execute('SAVEPOINT student_command')
+        try:
+            if request_type == SQLCommandType.SELECT:
+                cursor.execute(cls._get_student_result_sql(student_command))
+                return f'TABLE {cls.student_result_table}', None
+            cursor.execute(student_command)
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT student_command')
+            if request_type != SQLCommandType.SELECT:
+                return student_command, e
+            if governor.get_limit_exception(e):
+                raise
+            return student_command, None
+        return student_command, None
+
+    @classmethod
+    def _check_select_command(
+        cls,
+        cursor: Cursor,
+        student_command: str,
+        true_command: str,
+        ordered: bool = False,
+        fingerprints: Optional[Dict[str, ResultFingerprint]] = None
+    ) -> bool:
+
+        """
+        execute select query
+        cursor - cursor of the database for the query
+        student_command - query sent by the user
+        true_command - command that successfully solves the task
+        ordered - rows must be returned in the same order
+        fingerprints - fingerprints of results of the queries
+          executed in the submission, each query is executed once,
+          see _get_references
+
+        return True if select rows by student_command identical rows
+        from the true_command.
+
+        Example:
+            student_command: SELECT title FROM tasks_task LIMIT 10
+            true_command: SELECT title FROM tasks_task LIMIT 10 OFFSET 0
+        """
+
+        return comparison.compare(
+            cursor=cursor,
+            first_query=student_command,
+            second_query=true_command,
+            ordered=ordered,
+            fingerprints=fingerprints
+        )
+
+    @classmethod
+    def _get_references(
+        cls,
+        cursor: Cursor,
+        db_version: Tuple[str, int],
+        ordered: bool,
+        tests: List[TestData],
+        references: Dict[str, ResultFingerprint]
+    ):
+
+        """
+        Calculates fingerprints of the check queries of SELECT tests
+        before the user's query is executed in the transaction,
+        so the user's code (e.g. set_config in the query) can't affect them.
+        Fingerprints are cached for the version of the database
+        and saved to references, the check query which fails
+        is left to its test
+        """
+
+        for test_data in tests:
+            true_command = test_data.data_in
+            if true_command in references:
+                continue
+            cache_key = cls._get_reference_cache_key(
+                db_version, ordered, true_command
+            )
+            fingerprint = reference_cache.get(cache_key)
+            if fingerprint is None:
+                cursor.execute('SAVEPOINT reference')
+                try:
+                    fingerprint = comparison.get_fingerprint(
+                        cursor, clean_sql(true_command), ordered
+                    )
+                except psycopg2.Error as e:
+                    logger.debug(e)
+                    cursor.execute('ROLLBACK TO SAVEPOINT reference')
+                    continue
+                cursor.execute('RELEASE SAVEPOINT reference')
+                reference_cache.set(cache_key, fingerprint)
+            references[true_command] = fingerprint
+
+    @classmethod
+    def _check_delete_command(
+        cls,
+        cursor: Cursor,
+        check_command: str
+    ) -> bool:
+        """
+        check result of query DELETE
+        cursor - cursor of the database where the user's query was executed
+        check_command - command that checks changed database
+        return True if deleted row not exist in result.
+
+        Example:
+            student_command: DELETE FROM tasks_task WHERE id IN (25, 35)
+            check_command: SELECT title FROM tasks_task WHERE id IN (25, 35)
+        """
+
+        cursor.execute(cls._get_delete_check_sql(check_command))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def _parse_check_code(cls, check_code: str) -> Tuple[int, str]:
+
+        """
+        Returns amount of objects and select command from the check code
+        of UPDATE/INSERT (1st line is amount of objects returned)
+        """
+
+        try:
+            expected_rows_count = int(check_code.split("\n", 1)[0])
+            check_command = check_code.split("\n", 1)[1]
+        except Exception as e:
+            raise exceptions.InvalidCheckCommand(details=str(e))
+        return expected_rows_count, check_command
+
+    @classmethod
+    def _check_update_or_insert_command(
+        cls,
+        cursor: Cursor,
+        check_command: str,
+        expected_rows_count: int
+    ) -> bool:
+        """
+        check result of query UPDATE/INSERT
+        cursor - cursor of the database where the user's query was executed
+        check_command - select command that checks changed database
+        expected_rows_count - amount of objects returned by check_command
+        return True if count rows from db equal check_command count
+
+          Example check_code for UPDATE:
+            student_command:
+                UPDATE tasks_task SET title='test' WHERE id=50
+            check_code:
+                1
+                SELECT title FROM tasks_task WHERE id=50 AND title='test
+
+          Example check_code for INSERT:
+            student_command:
+                INSERT INTO tasks_task (title, lang) VALUES ('test', 'psql')
+            check_code:
+                1
+                SELECT title
+                FROM tasks_task
+                WHERE title='test' AND lang = 'psql'
+        """
+
+        cursor.execute(cls._get_count_check_sql(check_command))
+        rows_count = cursor.fetchone()[0]
+        return rows_count == expected_rows_count
+
+    @classmethod
+    def _test(
+        cls,
+        cursor: Cursor,
+        check_code: str,
+        student_command: str,
+        student_error: Optional[Exception],
+        request_type: SQLCommandType,
+        ordered: bool = False,
+        fingerprints: Optional[Dict[str, ResultFingerprint]] = None
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        runs a test during testing, changes made by the test
+        are rolled back to the savepoint
+        cursor: cursor of the database where the user's query was executed
+        check_code: str, code for checking the query result
+        student_command: str, query which gives the user's result
+        student_error: error of the user's query
+        request_type: type of a query SELECT/DELETE/UPDATE/INSERT
+        ordered: SELECT rows must be returned in the same order
+        fingerprints: fingerprints of results of executed SELECT queries
+        returns two values: ok and error message """
+
+        ok, error = False, None
+        try:
+            cursor.execute('SAVEPOINT test')
+            try:
+                if request_type == SQLCommandType.SELECT:
+                    ok = cls._check_select_command(
+                        cursor=cursor,
+                        student_command=student_command,
+                        true_command=check_code,
+                        ordered=ordered,
+                        fingerprints=fingerprints
+                    )
+                elif request_type == SQLCommandType.DELETE:
+                    if student_error:
+                        raise student_error
+                    ok = cls._check_delete_command(
+                        cursor=cursor,
+                        check_command=check_code
+                    )
+                else:
+                    expected_rows_count, check_command = (
+                        cls._parse_check_code(check_code)
+                    )
+                    if student_error:
+                        raise student_error
+                    ok = cls._check_update_or_insert_command(
+                        cursor=cursor,
+                        check_command=check_command,
+                        expected_rows_count=expected_rows_count
+                    )
+            finally:
+                cursor.execute('ROLLBACK TO SAVEPOINT test')
+        except Exception as e:
+            logger.error(e)
+            ok = False
+            error = str(governor.get_limit_exception(e) or e)
+        return ok, error
+
+    @classmethod
+    def _create_evicted_table(cls):
+
+        """
+        Creates the table of evicted sandboxes in the default database,
+        the metadata of the sandbox is saved there instead of the comment
+        of its dropped database
+        """
+
+        if cls._evicted_table_ready:
+            return
+        with cls._advisory_lock(cls.evicted_table):
+            with pools.connection(autocommit=True) as con:
+                with con.cursor() as cursor:
+                    cursor.execute(
+                        'CREATE TABLE IF NOT EXISTS %(table)s ('
+                        '  name text PRIMARY KEY,'
+                        '  comment text NOT NULL,'
+                        '  evicted_at timestamptz NOT NULL DEFAULT now()'
+                        ')',
+                        {'table': AsIs(cls.evicted_table)}
+                    )
+        PostgresqlService._evicted_table_ready = True
+
+    @classmethod
+    def _forget_evicted(cls, name: str):
+        cls._create_evicted_table()
+        with pools.connection(autocommit=True) as con:
+            with con.cursor() as cursor:
+                cursor.execute(
+                    'DELETE FROM %(table)s WHERE name = %(name)s',
+                    {'table': AsIs(cls.evicted_table), 'name': name}
+                )
+
+    @classmethod
+    def _get_sandboxes_query(
+        cls,
+        name: Optional[str] = None
+    ) -> Tuple[str, dict]:
+
+        """
+        Query which returns names of sandboxes, sizes and comments
+        of their databases and statuses of sandboxes including evicted ones,
+        name - only the sandbox with the given name
+        """
+
+        return (
+            'SELECT '
+            'split_part(datname, %(db_name_prefix)s, 2), '
+            'pg_database_size(oid), '
+            "shobj_description(oid, 'pg_database'), "
+            '%(active)s '
+            'FROM pg_database '
+            'WHERE datname LIKE %(db_name_prefix_template)s '
+            'AND datname NOT LIKE %(template_prefix_template)s '
+            'AND datname NOT LIKE %(lease_prefix_template)s '
+            'AND (%(db_name)s::name IS NULL OR datname = %(db_name)s) '
+            'UNION ALL '
+            'SELECT name, NULL, comment, %(evicted)s '
+            # имя таблицы в тексте запроса: запрос выполняется и psycopg 3
+            f'FROM {cls.evicted_table} '
+            'WHERE (%(name)s::text IS NULL OR name = %(name)s) '
+            'AND NOT EXISTS ('
+            '  SELECT FROM pg_database '
+            '  WHERE datname = %(db_name_prefix)s || name'
+            ')',
+            {
+                'db_name_prefix': cls.db_name_prefix,
+                'db_name_prefix_template': f'{cls.db_name_prefix}%',
+                'template_prefix_template': f'{cls.template_db_name_prefix}%',
+                'lease_prefix_template': (
+                    f'{cls._get_db_name(cls.lease_name_prefix)}%'
+                ),
+                'db_name': cls._get_db_name(name) if name else None,
+                'name': name,
+                'active': DbStatus.ACTIVE,
+                'evicted': DbStatus.EVICTED
+            }
+        )
+
+    @classmethod
+    def _get_sandboxes(cls, name: Optional[str] = None) -> List[tuple]:
+        cls._create_evicted_table()
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute(*cls._get_sandboxes_query(name))
+                return cursor.fetchall()
+
+    @classmethod
+    def _refresh_registry(cls):
+
+        """
+        Reconciles the registry with pg_database if it is outdated,
+        the outdated registry is used if the reconciliation fails
+        """
+
+        if not registry.begin_refresh():
+            return
+        try:
+            rows = cls._get_sandboxes()
+        except Exception as e:
+            registry.cancel_refresh()
+            if not registry.ready:
+                raise
+            logger.error(e)
+        else:
+            registry.reconcile(rows)
+            cls._evict_lost(rows)
+
+    @classmethod
+    def _register(cls, name: str):
+
+        """ Adds the created sandbox to the registry """
+
+        try:
+            registry.update(cls._get_sandboxes(name))
+        except Exception as e:
+            logger.error(e)
+
+    @classmethod
+    def status(cls, name: str) -> StatusData:
+
+        """
+        Returns the status of the database with the given name,
+        the sandbox missing in the registry is looked for in pg_database,
+        it could be created by another process
+        """
+
+        try:
+            cls._refresh_registry()
+            data = registry.get(name)
+            if data is None:
+                registry.update(cls._get_sandboxes(name))
+                data = registry.get(name)
+        except Exception as e:
+            logger.error(e)
+            raise exceptions.StatusCheckException(details=str(e))
+        return data or StatusData(status=DbStatus.NOT_EXISTS, name=name)
+
+    @classmethod
+    def status_all(cls) -> List[StatusData]:
+
+        """ Returns a list for all sandbox databases with their statuses """
+
+        try:
+            cls._refresh_registry()
+        except Exception as e:
+            logger.error(e)
+            raise exceptions.StatusCheckException(details=str(e))
+        return registry.all()
+
+    @classmethod
+    def create(
+        cls,
+        name: str,
+        filename: str,
+        limits: Optional[dict] = None,
+        force: bool = False,
+        durability: str = Durability.FULL,
+        report: Optional[Report] = None
+    ):
+        """
+        (Re)creates db from file
+        data.filename: database dump file from directory /files
+        data.limits: resource limits of queries overriding config.SANDBOX_LIMITS
+        data.force: recreate the database even if it is current
+        data.durability: 'unlogged' - tables are converted to UNLOGGED,
+          changes are not written to WAL, the sandbox is recreated
+          from the file after restart of the server
+        report: function called with the phase and the progress
+          of the creation, see jobs.JobQueue
+        the database is cloned from the template loaded from the file,
+        the database which was created from the same content of the file
+        and hasn't been changed since is not recreated.
+        Returns state of the database, 'active' - successfully created,
+        'not exists' - error occurred
+        """
+
+        db_name = cls._get_db_name(name)
+        file_hash = get_file_hash(cls._get_file_path(filename))
+        # пустые ограничения равносильны их отсутствию
+        limits = limits or None
+        if not force and cls._is_db_current(
+            db_name, filename, file_hash, limits, durability
+        ):
+            logger.info(f'{db_name} is current, creation is skipped')
+            cls._register(name)
+            return
+        if limits:
+            cls._check_limits(limits)
+        report = report or (lambda phase, progress: None)
+        template = cls._create_template(filename, report)
+        report(JobPhase.DROP, None)
+        cls._delete_database(name)
+        report(JobPhase.CREATE, None)
+        cls._create_database(db_name=db_name, template=template)
+        if durability == Durability.UNLOGGED:
+            cls._set_unlogged(db_name)
+        comment = {
+            'filename': filename,
+            'hash': file_hash,
+            'checksum': cls._get_db_checksum(db_name),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        }
+        if limits:
+            comment['limits'] = limits
+        if durability == Durability.UNLOGGED:
+            comment['durability'] = durability
+            comment['server_started'] = cls._get_server_started()
+        cls._set_db_comment(db_name, comment)
+        cls._forget_evicted(name)
+        cls._register(name)
+        if config.WARMUP_PREWARM_MAX_BYTES:
+            report(JobPhase.PREWARM, None)
+            try:
+                cls._prewarm(db_name)
+            except Exception as e:
+                logger.error(e)
+
+    @classmethod
+    def _get_job_key(cls, data: CreateData) -> tuple:
+        return (
+            data.filename,
+            json.dumps(data.limits, sort_keys=True),
+            data.force,
+            data.durability
+        )
+
+    @classmethod
+    def _check_create(cls, data: CreateData):
+
+        """ Checks the file and the limits before the creation is enqueued """
+
+        cls._get_file_path(data.filename)
+        if data.limits:
+            cls._check_limits(data.limits)
+
+    @classmethod
+    def create_job(cls, data: CreateData) -> JobData:
+
+        """
+        Enqueues the (re)creation of the sandbox by create,
+        returns the job polled by get_job.
+        The unfinished job of the sandbox with the same parameters
+        is returned instead of a new one, jobs of the same sandbox
+        are executed one by one (in all processes)
+        """
+
+        cls._check_create(data)
+        db_name = cls._get_db_name(data.name)
+
+        def run(report: Report):
+            with cls._advisory_lock(db_name):
+                cls.create(
+                    name=data.name,
+                    filename=data.filename,
+                    limits=data.limits,
+                    force=data.force,
+                    durability=data.durability,
+                    report=report
+                )
+
+        return jobs.submit(data.name, cls._get_job_key(data), run)
+
+    @classmethod
+    def get_job(cls, job_id: str) -> JobData:
+
+        """ Returns the state of the creation job """
+
+        return jobs.get(job_id)
+
+    @classmethod
+    def wait_job(cls, job_id: str) -> JobData:
+
+        """ Waits for the job, raises the error of the failed job """
+
+        jobs.future(job_id).result()
+        return jobs.get(job_id)
+
+    @classmethod
+    def _run_bulk_item(
+        cls,
+        name: str,
+        func: Callable,
+        *args
+    ) -> BulkItemData:
+
+        """ Calls the function for the item of the bulk request """
+
+        result = BulkItemData(name=name)
+        started = time.perf_counter()
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(e)
+            result.error = getattr(e, 'message', str(e))
+            result.details = getattr(e, 'details', None)
+        else:
+            result.ok = True
+        result.duration = time.perf_counter() - started
+        return result
+
+    @classmethod
+    def _create_bulk_item(cls, data: CreateData):
+        with cls._advisory_lock(cls._get_db_name(data.name)):
+            cls.create(
+                name=data.name,
+                filename=data.filename,
+                limits=data.limits,
+                force=data.force,
+                durability=data.durability
+            )
+
+    @classmethod
+    def create_bulk(cls, data: BulkData) -> BulkData:
+
+        """
+        (Re)creates sandboxes of the manifest (data.items) by create.
+        Templates of distinct files are loaded first by
+        config.BULK_LOAD_WORKERS threads, since loading is bound
+        by the I/O of the server, then sandboxes are cloned from them
+        by config.BULK_WORKERS threads. All threads share the pool
+        of connections to the default database.
+        data.results: results of the items in the order of the manifest,
+          an item whose file failed to load fails without retrying the load
+        """
+
+        started = time.perf_counter()
+        filenames = list(dict.fromkeys(item.filename for item in data.items))
+        loads = dict(zip(filenames, cls._bulk_load_executor.map(
+            lambda filename: cls._run_bulk_item(
+                filename, cls._create_template, filename
+            ),
+            filenames
+        )))
+        futures = []
+        for item in data.items:
+            load = loads[item.filename]
+            if not load.ok:
+                futures.append(None)
+                continue
+            futures.append(cls._bulk_executor.submit(
+                cls._run_bulk_item, item.name, cls._create_bulk_item, item
+            ))
+        data.results = []
+        for item, future in zip(data.items, futures):
+            if future is None:
+                load = loads[item.filename]
+                data.results.append(BulkItemData(
+                    name=item.name,
+                    error=load.error,
+                    details=load.details,
+                    duration=0.0
+                ))
+            else:
+                data.results.append(future.result())
+        data.duration = time.perf_counter() - started
+        return data
+
+    @classmethod
+    def delete_bulk(cls, data: BulkData) -> BulkData:
+
+        """
+        Deletes sandboxes data.names by delete in config.BULK_WORKERS threads
+        data.results: results of the sandboxes in the order of data.names
+        """
+
+        started = time.perf_counter()
+        data.results = list(cls._bulk_executor.map(
+            lambda name: cls._run_bulk_item(name, cls.delete, name),
+            data.names
+        ))
+        data.duration = time.perf_counter() - started
+        return data
+
+    @classmethod
+    def delete(cls, name: str):
+
+        """ Delete the database with the given name """
+
+        cls._delete_database(name)
+        cls._forget_evicted(name)
+        for db_name in leases.clear(name):
+            cls._lease_executor.submit(cls._drop_lease, db_name)
+
+    @classmethod
+    def _restore_evicted(cls, name: str) -> bool:
+
+        """
+        Recreates the evicted sandbox from its source file,
+        errors of the check are left to the query to the sandbox.
+        Returns True if the sandbox has been recreated
+        """
+
+        if cls._is_lease(name):
+            return False
+        try:
+            cls._refresh_registry()
+            data = registry.get(name)
+            if data is None:
+                registry.update(cls._get_sandboxes(name))
+                data = registry.get(name)
+        except Exception as e:
+            logger.error(e)
+            return False
+        if data is None or data.status != DbStatus.EVICTED:
+            return False
+        db_name = cls._get_db_name(name)
+        with cls._advisory_lock(db_name):
+            # песочница могла быть создана заново другим запросом
+            rows = cls._get_sandboxes(name)
+            registry.update(rows)
+            if not rows or rows[0][3] != DbStatus.EVICTED:
+                return False
+            comment = json.loads(rows[0][2])
+            logger.info(f'{db_name} is recreated after eviction')
+            cls.create(
+                name=name,
+                filename=comment['filename'],
+                limits=comment.get('limits'),
+                durability=comment.get('durability', Durability.FULL)
+            )
+        return True
+
+    @classmethod
+    def _evict(cls, name: str, wait: bool = True):
+
+        """
+        Drops the database of the sandbox,
+        its metadata is saved to the table of evicted sandboxes
+        wait: False - the sandbox is skipped if it's locked
+          by another session (e.g. it's being created)
+        """
+
+        db_name = cls._get_db_name(name)
+        with cls._advisory_lock(db_name, wait) as locked:
+            if not locked:
+                return
+            comment = cls._get_db_comment(db_name)
+            if not comment.get('filename'):
+                return
+            with pools.connection(autocommit=True) as con:
+                with con.cursor() as cursor:
+                    cursor.execute(
+                        'INSERT INTO %(table)s (name, comment) '
+                        'VALUES (%(name)s, %(comment)s) '
+                        'ON CONFLICT (name) DO UPDATE '
+                        'SET comment = EXCLUDED.comment, evicted_at = now()',
+                        {
+                            'table': AsIs(cls.evicted_table),
+                            'name': name,
+                            'comment': json.dumps(comment)
+                        }
+                    )
+            cls._drop_database(db_name)
+            registry.update(
+                [(name, None, json.dumps(comment), DbStatus.EVICTED)]
+            )
+        logger.info(f'{db_name} is evicted')
+
+    @classmethod
+    def _save_usage(cls):
+
+        """
+        Saves the last used time of the sandboxes used by the process
+        to the comments of their databases. The comment is rewritten
+        under the lock of the sandbox, sandboxes locked by another
+        process (e.g. being recreated) are skipped until the next save
+        """
+
+        for name, last_used in registry.usage().items():
+            db_name = cls._get_db_name(name)
+            try:
+                with cls._advisory_lock(db_name, wait=False) as locked:
+                    if not locked:
+                        continue
+                    comment = cls._get_db_comment(db_name)
+                    if comment and comment.get('last_used', '') < last_used:
+                        comment['last_used'] = last_used
+                        cls._set_db_comment(db_name, comment)
+            except Exception as e:
+                logger.error(e)
+
+    @classmethod
+    def _get_last_used(cls, data: StatusData) -> str:
+        return max(data.last_used or '', data.created_at or '')
+
+    @classmethod
+    def evict(cls):
+
+        """
+        Evicts least recently used sandboxes while the total size
+        of their databases exceeds config.EVICTION_DISK_BUDGET.
+        Sandboxes used within config.EVICTION_MIN_IDLE seconds
+        and sandboxes without the recorded source file are not evicted.
+        Only one process evicts sandboxes at once
+        """
+
+        cls._save_usage()
+        with cls._advisory_lock('sandbox_eviction', wait=False) as locked:
+            if not locked:
+                return
+            registry.reconcile(cls._get_sandboxes())
+            sandboxes = [
+                data for data in registry.all()
+                if data.status == DbStatus.ACTIVE
+            ]
+            total = sum(data.size or 0 for data in sandboxes)
+            idle_since = (
+                datetime.now(timezone.utc) -
+                timedelta(seconds=config.EVICTION_MIN_IDLE)
+            ).isoformat()
+            for data in sorted(sandboxes, key=cls._get_last_used):
+                if total <= config.EVICTION_DISK_BUDGET:
+                    break
+                if (
+                    not data.filename or
+                    cls._get_last_used(data) > idle_since
+                ):
+                    continue
+                try:
+                    cls._evict(data.name)
+                except Exception as e:
+                    logger.error(e)
+                else:
+                    total -= data.size or 0
+
+    @classmethod
+    def _run_eviction(cls):
+        while True:
+            time.sleep(config.EVICTION_INTERVAL)
+            try:
+                cls.evict()
+            except Exception as e:
+                logger.error(e)
+
+    @classmethod
+    def start_eviction(cls):
+
+        """ Starts the background eviction if the disk budget is set """
+
+        if not config.EVICTION_DISK_BUDGET or cls._eviction_thread:
+            return
+        PostgresqlService._eviction_thread = threading.Thread(
+            target=cls._run_eviction,
+            name='eviction',
+            daemon=True
+        )
+        cls._eviction_thread.start()
+
+    @classmethod
+    def _is_lease(cls, name: str) -> bool:
+        return name.startswith(cls.lease_name_prefix)
+
+    @classmethod
+    def _get_expires_at(cls, ttl: float) -> str:
+        return (
+            datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        ).isoformat()
+
+    @classmethod
+    def _clone_lease(cls, name: str, comment: dict) -> Tuple[str, dict]:
+
+        """
+        Clones the sandbox from its template into a new database,
+        the clone which isn't leased expires after config.LEASE_MAX_TTL.
+        comment: metadata of the sandbox
+        Returns the name of the database and its metadata
+        """
+
+        template = cls._get_template_db_name(comment['hash'])
+        if not any(db_name == template for db_name, _ in cls._get_templates()):
+            template = cls._create_template(comment['filename'])
+        db_name = cls._get_db_name(
+            f'{cls.lease_name_prefix}{secrets.token_hex(8)}'
+        )
+        cls._create_database(db_name=db_name, template=template)
+        clone_comment = {
+            'sandbox': name,
+            'hash': template[len(cls.template_db_name_prefix):],
+            # версия песочницы, для которой создана копия
+            'created_at': comment.get('created_at'),
+            'expires_at': cls._get_expires_at(config.LEASE_MAX_TTL),
+        }
+        if comment.get('limits'):
+            clone_comment['limits'] = comment['limits']
+        try:
+            if comment.get('durability') == Durability.UNLOGGED:
+                cls._set_unlogged(db_name)
+            cls._set_db_comment(db_name, clone_comment)
+        except Exception:
+            cls._drop_database(db_name)
+            raise
+        return db_name, clone_comment
+
+    @classmethod
+    def _refill_leases(cls, name: str, comment: dict):
+
+        """ Fills the pool of ready clones of the sandbox """
+
+        for _ in range(leases.reserve(name)):
+            try:
+                db_name, clone_comment = cls._clone_lease(name, comment)
+            except Exception as e:
+                logger.error(e)
+                leases.cancel(name)
+            else:
+                leases.add(name, db_name, clone_comment)
+
+    @classmethod
+    def _drop_lease(cls, db_name: str):
+        try:
+            cls._drop_database(db_name)
+        except Exception as e:
+            logger.error(e)
+
+    @classmethod
+    def lease(cls, name: str, ttl: float = config.LEASE_TTL) -> LeaseData:
+
+        """
+        Hands out a private copy of the sandbox to the session,
+        the copy is used by its name ('lease_...') in other requests
+        instead of the name of the sandbox, changes made by /debug/
+        are committed there, so DDL and queries can be sent
+        in separate requests. The copy is dropped after ttl seconds
+        or by release.
+        The ready clone is taken from the pool and the pool is refilled
+        in background, the clone is created at once if the pool is empty
+        """
+
+        if cls._is_lease(name):
+            raise exceptions.LeaseException(
+                details=f'{name} is a leased sandbox'
+            )
+        cls._restore_evicted(name)
+        comment = cls._get_db_comment(cls._get_db_name(name))
+        if not comment.get('filename'):
+            raise exceptions.LeaseException(
+                details=f'Sandbox {name} is not created from a file'
+            )
+        expires_at = cls._get_expires_at(ttl)
+        # готовая копия не выдается, если она может быть удалена
+        # до изменения срока аренды
+        valid_after = cls._get_expires_at(config.LEASE_INTERVAL)
+        db_name = None
+        while db_name is None:
+            clone = leases.pop(name)
+            if clone is None:
+                db_name, clone_comment = cls._clone_lease(name, comment)
+            else:
+                db_name, clone_comment = clone
+                # копия пересозданной песочницы (в том числе другим
+                # процессом) может иметь другие ограничения
+                if (
+                    clone_comment['hash'] != comment.get('hash') or
+                    clone_comment.get('created_at') !=
+                    comment.get('created_at') or
+                    clone_comment['expires_at'] < valid_after
+                ):
+                    cls._lease_executor.submit(cls._drop_lease, db_name)
+                    db_name = None
+                    continue
+            try:
+                cls._set_db_comment(
+                    db_name, {**clone_comment, 'expires_at': expires_at}
+                )
+            except exceptions.CreationException as e:
+                # копия удалена другим процессом
+                logger.error(e)
+                db_name = None
+        cls._lease_executor.submit(cls._refill_leases, name, comment)
+        return LeaseData(
+            name=name,
+            ttl=ttl,
+            lease=db_name[len(cls.db_name_prefix):],
+            expires_at=expires_at
+        )
+
+    @classmethod
+    def release(cls, name: str):
+
+        """ Drops the leased copy of the sandbox """
+
+        if not cls._is_lease(name):
+            raise exceptions.LeaseException(
+                details=f'{name} is not a leased sandbox'
+            )
+        cls._drop_database(cls._get_db_name(name))
+        registry.remove(name)
+
+    @classmethod
+    def _get_expired_leases_query(cls) -> Tuple[str, dict]:
+        return (
+            'SELECT datname '
+            'FROM pg_database, '
+            "  shobj_description(oid, 'pg_database') AS comment "
+            'WHERE datname LIKE %(lease_prefix_template)s '
+            'AND CASE WHEN comment LIKE %(json_template)s THEN '
+            "  (comment::jsonb ->> 'expires_at')::timestamptz < now() "
+            'END',
+            {
+                'lease_prefix_template': (
+                    f'{cls._get_db_name(cls.lease_name_prefix)}%'
+                ),
+                'json_template': '{%'
+            }
+        )
+
+    @classmethod
+    def reap_leases(cls):
+
+        """
+        Drops copies of sandboxes whose lease has expired,
+        including ready clones of stopped processes
+        """
+
+        with pools.connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute(*cls._get_expired_leases_query())
+                db_names = [row[0] for row in cursor.fetchall()]
+        leases.remove(db_names)
+        for db_name in db_names:
+            logger.info(f'{db_name} is released after expiration')
+            cls._drop_lease(db_name)
+
+    @classmethod
+    def _run_lease_reaper(cls):
+        while True:
+            time.sleep(config.LEASE_INTERVAL)
+            try:
+                cls.reap_leases()
+            except Exception as e:
+                logger.error(e)
+
+    @classmethod
+    def start_leases(cls):
+
+        """ Starts the background release of expired leases """
+
+        if cls._lease_thread:
+            return
+        PostgresqlService._lease_thread = threading.Thread(
+            target=cls._run_lease_reaper,
+            name='lease',
+            daemon=True
+        )
+        cls._lease_thread.start()
+
+    @classmethod
+    def stats(cls) -> StatsData:
+
+        """ Returns usage statistics of the service """
+
+        return StatsData(
+            pools=pools.stats(),
+            caches=[
+                reference_cache.stats(),
+                plan_cache.stats(),
+                verdict_cache.stats(),
+                debug_cache.stats()
+            ],
+            schedulers=[scheduler.stats()]
+        )
+
+    @classmethod
+    def _is_cursor_statement(cls, statement: str) -> bool:
+        return normalize_sql(statement).lstrip('(').startswith(
+            cls.cursor_statements
+        )
+
+    @classmethod
+    def _is_cursor_rejected(cls, error: Exception) -> bool:
+        return any(message in str(error) for message in cls.cursor_rejections)
+
+    @classmethod
+    def _is_read_only_error(cls, error: Optional[str]) -> bool:
+        return bool(error) and 'in a read-only transaction' in error
+
+    @classmethod
+    def _execute_debug_command(
+        cls,
+        con: connection,
+        code: str,
+        read_only: bool = False
+    ) -> Cursor:
+
+        """
+        executes the debug query, leading statements are executed
+        with the client cursor and the last one returning rows
+        with the server-side cursor, so rows are fetched from the server
+        by batches. The last statement which can't be the cursor
+        (e.g. WITH with data modification) and other commands
+        are executed with the client cursor, the whole result
+        is loaded then and debug_rows returns its capped part
+        read_only: the query is executed in the READ ONLY transaction,
+          the error is raised if it modifies data
+        """
+
+        statements = split_sql(code)
+        cursor = con.cursor()
+        if read_only:
+            cursor.execute('SET TRANSACTION READ ONLY')
+        cls._set_limits(cursor)
+        cls._check_cost(cursor, code)
+        if not statements or not cls._is_cursor_statement(statements[-1]):
+            cursor.execute(code)
+            return cursor
+        for statement in statements[:-1]:
+            cursor.execute(statement)
+        # отклонённый DECLARE не прерывает транзакцию
+        cursor.execute('SAVEPOINT debug')
+        server_cursor = con.cursor(name='debug')
+        try:
+            server_cursor.execute(statements[-1])
+        except psycopg2.Error as e:
+            # запрос не выполнялся, ошибки выполнения не повторяются
+            if not cls._is_cursor_rejected(e):
+                raise
+            logger.debug(e)
+            cursor.execute('ROLLBACK TO SAVEPOINT debug')
+            cursor.execute(statements[-1])
+            return cursor
+        return server_cursor
+
+    @classmethod
+    def debug_rows(
+        cls,
+        data: DebugData,
+        read_only: bool = False
+    ) -> Iterator[Sequence]:
+
+        """
+        executes the debug query and yields the list of column names
+        followed by rows of the result (nothing for commands without result)
+        rows are fetched by batches and fetching stops after
+        config.DEBUG_MAX_ROWS rows or config.DEBUG_MAX_BYTES bytes,
+        data.truncated is set in this case.
+        the error of the query is saved to data.error,
+        QueryTimeoutException or ResourceLimitException is raised
+        if the query exceeds the resource limit
+        read_only: see _execute_debug_command
+        """
+
+        cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        data.truncated = False
+        rows_count, rows_size = 0, 0
+        try:
+            with pools.connection(cls._get_db_name(data.name)) as con:
+                cursor = cls._execute_debug_command(
+                    con, data.code, read_only
+                )
+                # изменения в арендованной копии сохраняются
+                lease = cls._is_lease(data.name)
+                if lease and not cursor.name:
+                    con.commit()
+                try:
+                    rows = []
+                    if cursor.name or cursor.description:
+                        rows = cursor.fetchmany(config.DEBUG_FETCH_SIZE)
+                    if cursor.description:
+                        yield [desc[0] for desc in cursor.description]
+                    while rows:
+                        for row in rows:
+                            rows_size += len(str(row))
+                            if (
+                                rows_count >= config.DEBUG_MAX_ROWS or
+                                rows_size > config.DEBUG_MAX_BYTES
+                            ):
+                                data.truncated = True
+                                return
+                            rows_count += 1
+                            yield row
+                        rows = cursor.fetchmany(config.DEBUG_FETCH_SIZE)
+                finally:
+                    # курсор закрывается при фиксации транзакции
+                    if lease and cursor.name and not con.closed:
+                        con.commit()
+        except Exception as e:
+            exception = governor.get_limit_exception(e)
+            if exception:
+                logger.error(e)
+                raise exception
+            data.error = str(e)
+
+    @classmethod
+    def _debug_plan(cls, data: DebugData) -> DebugData:
+
+        """
+        executes the debug query by EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON),
+        data.result is the list of plans of the statements which can be
+        explained (other statements are executed as is) with execution
+        and planning time, amounts of rows and buffers.
+        changes of the query are rolled back as by other formats
+        """
+
+        cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        plans = []
+        try:
+            with pools.connection(cls._get_db_name(data.name)) as con:
+                with con.cursor() as cursor:
+                    cls._set_limits(cursor)
+                    cls._check_cost(cursor, data.code)
+                    for statement in split_sql(data.code):
+                        if governor.is_explainable(statement):
+                            cursor.execute(
+                                governor.get_explain_analyze_sql(statement)
+                            )
+                            plans.extend(cursor.fetchone()[0])
+                        else:
+                            cursor.execute(statement)
+        except Exception as e:
+            exception = governor.get_limit_exception(e)
+            if exception:
+                logger.error(e)
+                raise exception
+            data.error = str(e)
+            return data
+        data.result = plans
+        return data
+
+    @classmethod
+    def _get_deterministic_sql(cls) -> str:
+
+        """
+        Query checking the temporary view of the user's query.
+        Dependencies of the view (and of the views it reads) show
+        user-defined functions and operators, system views, sequences
+        and foreign tables. Built-in functions and system catalogs
+        are not recorded as dependencies, so they are found by the names
+        in the definitions of the views, also as CURRENT_TIMESTAMP etc.
+        Only immutable functions are allowed, stable ones (e.g. now())
+        may return different results in the next transaction
+        """
+
+        return f"""
+            WITH RECURSIVE rules(oid) AS (
+                SELECT oid FROM pg_rewrite
+                WHERE ev_class = 'pg_temp.{cls.deterministic_view}'::regclass
+              UNION
+                SELECT r.oid
+                FROM rules
+                JOIN pg_depend AS d
+                  ON d.classid = 'pg_rewrite'::regclass
+                 AND d.objid = rules.oid
+                JOIN pg_rewrite AS r
+                  ON d.refclassid = 'pg_class'::regclass
+                 AND r.ev_class = d.refobjid
+            ), refs AS (
+                SELECT d.refclassid, d.refobjid
+                FROM rules
+                JOIN pg_depend AS d
+                  ON d.classid = 'pg_rewrite'::regclass
+                 AND d.objid = rules.oid
+            ), words AS (
+                SELECT DISTINCT word[1] AS word, word[2] = '(' AS call
+                FROM rules, regexp_matches(
+                    lower(pg_get_ruledef(rules.oid)),
+                    '([a-z_][a-z0-9_$]*)\\s*(\\(?)',
+                    'g'
+                ) AS word
+            )
+            SELECT NOT EXISTS (
+                SELECT FROM refs
+                LEFT JOIN pg_operator AS o
+                  ON refs.refclassid = 'pg_operator'::regclass
+                 AND o.oid = refs.refobjid
+                JOIN pg_proc AS p
+                  ON p.oid = o.oprcode
+                  OR (
+                    refs.refclassid = 'pg_proc'::regclass AND
+                    p.oid = refs.refobjid
+                  )
+                WHERE p.provolatile <> 'i'
+            ) AND NOT EXISTS (
+                SELECT FROM refs
+                JOIN pg_class AS c
+                  ON refs.refclassid = 'pg_class'::regclass
+                 AND c.oid = refs.refobjid
+                JOIN pg_namespace AS n ON n.oid = c.relnamespace
+                WHERE n.nspname IN ('pg_catalog', 'information_schema')
+                   OR c.relkind IN ('S', 'f')
+            ) AND NOT EXISTS (
+                SELECT FROM words
+                JOIN pg_proc AS p ON p.proname = words.word
+                WHERE words.call AND p.provolatile <> 'i'
+            ) AND NOT EXISTS (
+                SELECT FROM words
+                JOIN pg_class AS c ON c.relname = words.word
+                WHERE c.relnamespace = 'pg_catalog'::regnamespace
+            ) AND NOT EXISTS (
+                SELECT FROM words
+                WHERE words.word IN (
+                    'current_date', 'current_time', 'current_timestamp',
+                    'localtime', 'localtimestamp'
+                )
+            )
+        """
+
+    @classmethod
+    def _is_deterministic(cls, name: str, queries: Sequence[str]) -> bool:
+
+        """
+        True if the queries return the same result in each transaction
+        in the same version of the sandbox, so the result can be cached.
+        Each query is saved as the temporary view and checked
+        by _get_deterministic_sql, data modifying queries can't be saved
+        as views. The views are rolled back
+        """
+
+        try:
+            with pools.connection(cls._get_db_name(name)) as con:
+                with con.cursor() as cursor:
+                    cls._set_limits(cursor)
+                    for query in queries:
+                        cursor.execute('SAVEPOINT deterministic')
+                        cursor.execute(
+                            f'CREATE TEMP VIEW {cls.deterministic_view} AS '
+                            f'SELECT FROM ({clean_sql(query)}) AS query'
+                        )
+                        cursor.execute(cls._get_deterministic_sql())
+                        if not cursor.fetchone()[0]:
+                            return False
+                        cursor.execute('ROLLBACK TO SAVEPOINT deterministic')
+        except psycopg2.Error as e:
+            logger.debug(e)
+            return False
+        return True
+
+    @classmethod
+    def _is_debug_cacheable(cls, data: DebugData) -> bool:
+        """
+        Returns False if the result can't be cached: the cache is disabled,
+        the sandbox is leased or unknown, or the code isn't a single query
+        returning rows
+        """
+        if not config.DEBUG_CACHE_PATH or cls._is_lease(data.name):
+            return False
+        statements = split_sql(data.code)
+        if len(statements) != 1 or not cls._is_cursor_statement(statements[0]):
+            return False
+        sandbox = registry.get(data.name)
+        return sandbox is not None and sandbox.status == DbStatus.ACTIVE
+
+    @classmethod
+    def _make_debug_cache_key(
+        cls,
+        data: DebugData,
+        db_version: Optional[int]
+    ) -> Optional[tuple]:
+        if db_version is None:
+            return None
+        return (
+            cls._get_db_name(data.name),
+            db_version,
+            data.format,
+            normalize_sql(split_sql(data.code)[0])
+        )
+
+    @classmethod
+    def _get_debug_cache_key(cls, data: DebugData) -> Optional[tuple]:
+        """
+        Returns the key of the cached result of the debug query:
+        the version of the sandbox (see _get_db_oid), the format
+        and the normalized query. None if the result can't be cached
+        (see _is_debug_cacheable). Results are cached only
+        for deterministic queries (see _is_deterministic)
+        """
+        if not cls._is_debug_cacheable(data):
+            return None
+        return cls._make_debug_cache_key(
+            data, cls._get_db_oid(cls._get_db_name(data.name))
+        )
+
+    @classmethod
+    def debug(cls, data: DebugData) -> DebugData:
+        """
+        debug query
+        data.request_typ: 'select'/'something else', meaning DELETE/UPDATE/INSERT
+        data.format: 'plan' - plans of the query with execution statistics
+        the result of the query which is executed successfully
+        in the READ ONLY transaction is cached (see _get_debug_cache_key)
+        in the cache shared by the processes of the server
+        returns list of bools, corresponding to success or failure of a test
+        """
+        if data.format == DebugFormat.PLAN:
+            return cls._debug_plan(data)
+        cache_key = cls._get_debug_cache_key(data)
+        if cache_key:
+            cached = debug_cache.get(cache_key)
+            if cached is not None:
+                registry.touch(data.name)
+                data.result, data.truncated = cached
+                return data
+        if cache_key and not cls._is_deterministic(data.name, [data.code]):
+            cache_key = None
+        result = list(cls.debug_rows(data, read_only=cache_key is not None))
+        if cache_key and cls._is_read_only_error(data.error):
+            # запрос изменяет данные, он выполняется повторно
+            # без режима READ ONLY и не кэшируется
+            cache_key, data.error = None, None
+            result = list(cls.debug_rows(data))
+        if data.error:
+            return data
+        if data.format == DebugFormat.TABULAR:
+            if result:
+                data.result = tabulate(
+                    tabular_data=result[1:],
+                    headers=result[0],
+                    tablefmt="psql"
+                )
+        else:
+            data.result = result
+        if cache_key:
+            debug_cache.set(cache_key, (data.result, data.truncated))
+        return data
+
+    @classmethod
+    def _run_tests(
+        cls,
+        data: TestingData,
+        tests: List[TestData],
+        references: Dict[str, ResultFingerprint]
+    ):
+        """
+        runs _test for the given tests on one connection,
+        the user's query is executed once.
+        settings of the text representation of values are pinned
+        for the transaction and fingerprints of the check queries
+        are calculated before the user's query (see _get_references),
+        references are shared between connections and submissions,
+        fingerprints calculated after the user's query are not
+        returns False if the tests failed to run (e.g. connection error)
+        """
+        db_name = cls._get_db_name(data.name)
+        try:
+            with pools.connection(db_name) as con:
+                with con.cursor() as cursor:
+                    cls._set_limits(cursor)
+                    cursor.execute(*comparison.get_settings_sql())
+                    if data.request_type == SQLCommandType.SELECT:
+                        cls._get_references(
+                            cursor=cursor,
+                            db_version=(
+                                db_name, cls._get_db_version(cursor)
+                            ),
+                            ordered=data.ordered,
+                            tests=tests,
+                            references=references
+                        )
+                    fingerprints = dict(references)
+                    student_command, student_error = (
+                        cls._execute_student_command(
+                            cursor=cursor,
+                            student_command=data.code,
+                            request_type=data.request_type
+                        )
+                    )
+                    for test_data in tests:
+                        started = time.perf_counter()
+                        test_data.ok, test_data.error = cls._test(
+                            cursor=cursor,
+                            check_code=test_data.data_in,
+                            student_command=student_command,
+                            student_error=student_error,
+                            request_type=data.request_type,
+                            ordered=data.ordered,
+                            fingerprints=fingerprints
+                        )
+                        test_data.duration = time.perf_counter() - started
+        except Exception as e:
+            logger.error(e)
+            error = str(governor.get_limit_exception(e) or e)
+            for test_data in tests:
+                test_data.ok, test_data.error = False, error
+            return False
+        return True
+
+    @classmethod
+    def _get_testing_workers(cls, data: TestingData) -> int:
+        """
+        Reserves global slots for additional connections
+        of the parallel testing without waiting,
+        returns amount of the reserved slots
+        """
+        if not data.parallel:
+            return 0
+        return cls._reserve_testing_slots(
+            min(config.TESTING_PARALLEL_WORKERS, len(data.tests)) - 1
+        )
+
+    @classmethod
+    def _reserve_testing_slots(cls, amount: int) -> int:
+        """ Reserves up to amount global slots of the testing workers """
+        workers = 0
+        while workers < amount and cls._testing_slots.acquire(blocking=False):
+            workers += 1
+        return workers
+
+    @classmethod
+    def _split_tests(
+        cls,
+        tests: List[TestData],
+        parts: int
+    ) -> List[List[TestData]]:
+        """ Splits tests into parts, order of data.tests is not changed """
+        return [tests[num::parts] for num in range(parts)]
+
+    @classmethod
+    def _is_verdict_cacheable(cls, data: TestingData) -> bool:
+        """
+        Returns False if the verdicts can't be reused: the sandbox
+        is leased or unknown, or the user's query modifies data
+        """
+        if (
+            cls._is_lease(data.name) or
+            data.request_type != SQLCommandType.SELECT
+        ):
+            return False
+        sandbox = registry.get(data.name)
+        return sandbox is not None and sandbox.status == DbStatus.ACTIVE
+
+    @classmethod
+    def _make_verdict_key(
+        cls,
+        data: TestingData,
+        db_version: Optional[int]
+    ) -> Optional[tuple]:
+        if db_version is None:
+            return None
+        tests = json.dumps([test.data_in for test in data.tests])
+        return (
+            cls._get_db_name(data.name),
+            db_version,
+            data.request_type,
+            data.ordered,
+            hashlib.sha256(tests.encode()).hexdigest(),
+            hashlib.sha256(normalize_sql(data.code).encode()).hexdigest()
+        )
+
+    @classmethod
+    def _get_verdict_key(cls, data: TestingData) -> Optional[tuple]:
+        """
+        Returns the key of the verdicts of the submission: the version
+        of the sandbox (see _get_db_oid), the request type,
+        hashes of the tests and of the normalized user's query.
+        None if the verdicts can't be reused (see _is_verdict_cacheable).
+        Verdicts are cached only for deterministic queries
+        (see _confirm_verdict_key)
+        """
+        if not cls._is_verdict_cacheable(data):
+            return None
+        return cls._make_verdict_key(
+            data, cls._get_db_oid(cls._get_db_name(data.name))
+        )
+
+    @classmethod
+    def _get_verdict_queries(cls, data: TestingData) -> List[str]:
+        return [data.code, *(test.data_in for test in data.tests)]
+
+    @classmethod
+    def _confirm_verdict_key(
+        cls,
+        key: Optional[tuple],
+        data: TestingData
+    ) -> Optional[tuple]:
+        """
+        Returns the key of the verdicts which will be cached,
+        None if the queries of the submission aren't deterministic
+        """
+        if key and cls._is_deterministic(
+            data.name, cls._get_verdict_queries(data)
+        ):
+            return key
+        return None
+
+    @classmethod
+    def _get_error_verdict_key(cls, key: tuple, data: TestingData) -> tuple:
+        """
+        Returns the key of the verdicts with errors, the error quotes
+        the user's query, so the verdicts are reused only for the same
+        (not normalized) query
+        """
+        return (*key[:-1], hashlib.sha256(data.code.encode()).hexdigest())
+
+    @classmethod
+    def _get_verdicts(cls, key: Optional[tuple], data: TestingData) -> bool:
+        """ Sets cached results of the tests, returns False on a miss """
+        if not key:
+            return False
+        verdicts = verdict_cache.get(key)
+        if verdicts is None:
+            verdicts = verdict_cache.get(
+                cls._get_error_verdict_key(key, data)
+            )
+        if verdicts is None:
+            return False
+        for test_data, (ok, error) in zip(data.tests, verdicts):
+            test_data.ok, test_data.error = ok, error
+        return True
+
+    @classmethod
+    def _set_verdicts(
+        cls,
+        key: Optional[tuple],
+        data: TestingData,
+        completed: bool
+    ):
+        """
+        Caches results of the tests, results of the tests which
+        failed to run or exceeded the limits are not cached,
+        results with errors are cached for the same query only
+        """
+        if not key or not completed or any(
+            governor.is_limit_error(test_data.error)
+            for test_data in data.tests
+        ):
+            return
+        if any(test_data.error for test_data in data.tests):
+            key = cls._get_error_verdict_key(key, data)
+        verdict_cache.set(
+            key, [(test_data.ok, test_data.error) for test_data in data.tests]
+        )
+
+    @classmethod
+    def testing(cls, data: TestingData) -> TestingData:
+        """
+        runs _test for all items in data.tests (TestData)
+        on one connection, the user's query is executed once
+        data.parallel - tests are split between several connections,
+          the user's query is executed once on each connection
+        results of the same (normalized) query are returned
+        from the verdict cache without running the tests
+        returns results of running all tests
+        """
+        cls._restore_evicted(data.name)
+        registry.touch(data.name)
+        verdict_key = cls._get_verdict_key(data)
+        if cls._get_verdicts(verdict_key, data):
+            return data
+        verdict_key = cls._confirm_verdict_key(verdict_key, data)
+        references = {}
+        workers = cls._get_testing_workers(data)
+        try:
+            tests, *worker_tests = cls._split_tests(data.tests, workers + 1)
+            futures = [
+                cls._testing_executor.submit(
+                    cls._run_tests, data, part, references
+                )
+                for part in worker_tests
+            ]
+            completed = cls._run_tests(data, tests, references)
+            wait(futures)
+            completed = all([completed, *(f.result() for f in futures)])
+        finally:
+            for _ in range(workers):
+                cls._testing_slots.release()
+        cls._set_verdicts(verdict_key, data, completed)
+        return data
+
+    @classmethod
+    def _test_submission(
+        cls,
+        data: TestingBatchData,
+        code: str,
+        references: Dict[str, ResultFingerprint]
+    ) -> TestingData:
+        """
+        runs data.tests for one user's query of the batch on one connection,
+        fingerprints of the check queries (references) are shared
+        between submissions, see _run_tests
+        """
+        registry.touch(data.name)
+        submission = TestingData(
+            tests=[TestData(data_in=test.data_in) for test in data.tests],
+            code=code,
+            name=data.name,
+            request_type=data.request_type,
+            ordered=data.ordered
+        )
+        verdict_key = cls._get_verdict_key(submission)
+        if cls._get_verdicts(verdict_key, submission):
+            return submission
+        verdict_key = cls._confirm_verdict_key(verdict_key, submission)
+        completed = cls._run_tests(submission, submission.tests, references)
+        cls._set_verdicts(verdict_key, submission, completed)
+        return submission
+
+    @classmethod
+    def testing_batch(cls, data: TestingBatchData) -> Iterator[TestingData]:
+        """
+        runs data.tests for each user's query of data.codes,
+        results of the check queries are computed once for the batch
+        data.parallel - submissions are tested on several connections
+        yields results of the submissions in the order of data.codes
+        """
+        cls._restore_evicted(data.name)
+        references = {}
+        workers = 0
+        if data.parallel:
+            workers = cls._reserve_testing_slots(
+                min(config.TESTING_PARALLEL_WORKERS, len(data.codes))
+            )
+        if not workers:
+            for code in data.codes:
+                yield cls._test_submission(data, code, references)
+            return
+        # не более workers решений в работе, результаты не копятся в памяти
+        futures = deque()
+        try:
+            for code in data.codes:
+                futures.append(
+                    cls._testing_executor.submit(
+                        cls._test_submission, data, code, references
+                    )
+                )
+                if len(futures) >= workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            for _ in range(workers):
+                cls._testing_slots.release()
@@ -5,3 +5,10 @@ MSG_4 = 'Unexpected error during code execution.'
 MSG_5 = 'Database file not found'
 MSG_7 = 'The check command has an invalid format'
 MSG_8 = 'SELECT command has an invalid number of columns'
+MSG_9 = 'No free database connection available'
+MSG_10 = 'Query execution time limit exceeded'
+MSG_11 = 'Query resource limit exceeded'
+MSG_12 = 'Too many requests, try again later'
+MSG_13 = 'Estimated query cost exceeds the limit'
+MSG_14 = 'Failed to lease the sandbox'
+MSG_15 = 'Job not found'
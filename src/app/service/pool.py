@@ -0,0 +1,293 @@
+import time
+import select
+import threading
+import psycopg2
+from typing import Optional, Dict, List
+from contextlib import contextmanager
+from psycopg2.extensions import (
+    connection,
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+)
+from app import config
+from app.entities import PoolStatsData
+from app.service import exceptions
+from app.logger import get_logger
+logger = get_logger()
+
+
+def connect(database: Optional[str] = None) -> connection:
+
+    """ Opens a new (not pooled) connection to the database """
+
+    params = dict(config.PSQL_CONFIG)
+    if database:
+        params['database'] = database
+    con = psycopg2.connect(**params)
+    if config.DEBUG:
+        con.initialize(logger)
+    return con
+
+
+class ConnectionPool:
+
+    """
+    Thread-safe pool of connections to one database
+    database: database name, None - default database of the user
+    min_size: amount of connections which are never closed as idle
+    max_size: max amount of opened connections
+    """
+
+    def __init__(
+        self,
+        database: Optional[str] = None,
+        min_size: int = config.PSQL_POOL_MIN_SIZE,
+        max_size: int = config.PSQL_POOL_MAX_SIZE,
+        timeout: float = config.PSQL_POOL_TIMEOUT,
+    ):
+        self.database = database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.closed = False
+        self._idle: List[connection] = []
+        self._last_used: Dict[int, float] = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._checkouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def _close_connection(self, con: connection):
+        self._last_used.pop(id(con), None)
+        self._size -= 1
+        self._discarded += 1
+        try:
+            con.close()
+        except Exception as e:
+            logger.error(e)
+
+    def _is_healthy(self, con: connection) -> bool:
+
+        """
+        Checks the idle connection before checkout.
+        The server sends a message to an idle connection only if
+        the backend was terminated (e.g. DROP DATABASE ... WITH (FORCE)),
+        so a readable socket means the connection is broken.
+        Long idle connections are additionally checked with a query
+        """
+
+        if con.closed:
+            return False
+        try:
+            if select.select([con], [], [], 0)[0]:
+                return False
+            idle_time = time.monotonic() - self._last_used.get(id(con), 0)
+            if idle_time > config.PSQL_POOL_PING_INTERVAL:
+                with con.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                con.rollback()
+        except Exception as e:
+            logger.debug(e)
+            return False
+        return True
+
+    def _remove_expired(self):
+
+        """ Closes connections over min_size which have been idle too long """
+
+        now = time.monotonic()
+        while len(self._idle) and self._size > self.min_size:
+            con = self._idle[0]
+            last_used = self._last_used.get(id(con), now)
+            if now - last_used < config.PSQL_POOL_MAX_IDLE:
+                break
+            self._idle.pop(0)
+            self._close_connection(con)
+
+    def getconn(self) -> connection:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            con = None
+            with self._cond:
+                if self.closed:
+                    raise exceptions.ConnectionPoolException(
+                        details=f'Pool for {self.database} is closed'
+                    )
+                self._remove_expired()
+                if self._idle:
+                    con = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    break
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise exceptions.ConnectionPoolException(
+                            details=f'Pool for {self.database} is exhausted'
+                        )
+                    self._waits += 1
+                    self._cond.wait(remaining)
+                    continue
+
+            # проверка соединения выполняется вне блокировки
+            if self._is_healthy(con):
+                with self._cond:
+                    self._checkouts += 1
+                return con
+            with self._cond:
+                self._close_connection(con)
+                self._cond.notify()
+
+        # слот зарезервирован, соединение открывается вне блокировки
+        try:
+            con = connect(self.database)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created += 1
+            self._checkouts += 1
+        return con
+
+    def _reset(self, con: connection):
+
+        """
+        Resets the state of the session left by the user's code
+        (temporary tables, settings, prepared statements and so on),
+        so it doesn't leak into the next checkout of the connection
+        """
+
+        # COMMIT в коде пользователя завершает транзакцию на сервере,
+        # но не в psycopg2, который иначе не переключит autocommit
+        con.rollback()
+        con.autocommit = True
+        with con.cursor() as cursor:
+            cursor.execute('DISCARD ALL')
+        con.autocommit = False
+
+    def putconn(self, con: connection, discard: bool = False):
+        if not discard and not con.closed:
+            try:
+                status = con.info.transaction_status
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != TRANSACTION_STATUS_IDLE:
+                    con.rollback()
+                if not discard:
+                    self._reset(con)
+            except Exception as e:
+                logger.debug(e)
+                discard = True
+        with self._cond:
+            if discard or con.closed or self.closed:
+                self._close_connection(con)
+            else:
+                self._last_used[id(con)] = time.monotonic()
+                self._idle.append(con)
+            self._cond.notify()
+
+    def close(self):
+
+        """
+        Closes idle connections, connections in use
+        will be closed on return to the pool
+        """
+
+        with self._cond:
+            self.closed = True
+            while self._idle:
+                self._close_connection(self._idle.pop())
+            self._cond.notify_all()
+
+    def stats(self) -> PoolStatsData:
+        with self._cond:
+            return PoolStatsData(
+                database=self.database,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._size - len(self._idle),
+                min_size=self.min_size,
+                max_size=self.max_size,
+                checkouts=self._checkouts,
+                created=self._created,
+                discarded=self._discarded,
+                waits=self._waits,
+                timeouts=self._timeouts,
+            )
+
+
+class PoolManager:
+
+    """ Connection pools keyed by database name """
+
+    def __init__(self):
+        self._pools: Dict[Optional[str], ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, database: Optional[str] = None) -> ConnectionPool:
+        with self._lock:
+            pool = self._pools.get(database)
+            if pool is None:
+                pool = ConnectionPool(database=database)
+                self._pools[database] = pool
+            return pool
+
+    @contextmanager
+    def connection(
+        self,
+        database: Optional[str] = None,
+        autocommit: bool = False
+    ) -> connection:
+
+        """
+        Checks out the connection to the database,
+        an open transaction is rolled back when the connection is returned
+        """
+
+        pool = self.get_pool(database)
+        try:
+            con = pool.getconn()
+        except psycopg2.Error:
+            # пул не хранится для базы, которая не существует
+            # (например, имя неизвестной песочницы)
+            self._discard_empty(database, pool)
+            raise
+        try:
+            if autocommit:
+                con.autocommit = True
+            yield con
+        finally:
+            pool.putconn(con)
+
+    def _discard_empty(self, database: Optional[str], pool: ConnectionPool):
+
+        """ Closes the pool without connections after the failed connection """
+
+        with self._lock:
+            if self._pools.get(database) is not pool or pool.stats().size:
+                return
+            del self._pools[database]
+        pool.close()
+
+    def invalidate(self, database: str):
+
+        """ Closes the pool of the database before it will be dropped """
+
+        with self._lock:
+            pool = self._pools.pop(database, None)
+        if pool:
+            pool.close()
+
+    def stats(self) -> List[PoolStatsData]:
+        with self._lock:
+            pools = list(self._pools.values())
+        return [pool.stats() for pool in pools]
+
+
+pools = PoolManager()
@@ -0,0 +1,166 @@
+"""
+In-process registry of sandbox databases, statuses of sandboxes
+are served from memory. Create and delete keep the registry up to date,
+the registry is reconciled with pg_database when it is older than
+config.REGISTRY_REFRESH_INTERVAL, so sandboxes created or deleted
+by other processes and sizes of databases are updated periodically.
+Usage of sandboxes (last used time, amount of queries) is counted
+by each process separately, only the last used time is saved
+to the comment of the database by the eviction (see PostgresqlService.evict).
+"""
+
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from dataclasses import replace
+from typing import Optional, Iterable, Tuple, Dict, List
+from app import config
+from app.entities import StatusData
+
+# строка pg_database: имя песочницы, размер базы, комментарий базы, статус
+Row = Tuple[str, Optional[int], Optional[str], str]
+
+
+class SandboxRegistry:
+
+    """
+    Thread-safe registry of sandboxes
+    refresh_interval: time in seconds after which
+      the registry is reconciled with pg_database
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = config.REGISTRY_REFRESH_INTERVAL
+    ):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refreshed_cond = threading.Condition(self._lock)
+        self._sandboxes: Dict[str, StatusData] = {}
+        self._usage: Dict[str, Tuple[str, int]] = {}
+        self._refreshed: Optional[float] = None
+        self._refreshing = False
+
+    @property
+    def ready(self) -> bool:
+
+        """ True if the registry has been reconciled at least once """
+
+        return self._refreshed is not None
+
+    def _make_data(self, row: Row) -> StatusData:
+        name, size, comment, status = row
+        metadata = {}
+        if comment and comment.startswith('{'):
+            try:
+                metadata = json.loads(comment)
+            except ValueError:
+                pass
+        return StatusData(
+            name=name,
+            status=status,
+            size=size,
+            filename=metadata.get('filename'),
+            created_at=metadata.get('created_at'),
+            last_used=metadata.get('last_used'),
+        )
+
+    def _with_usage(self, data: StatusData) -> StatusData:
+        if data.name not in self._usage:
+            return replace(data)
+        last_used, queries = self._usage[data.name]
+        return replace(data, last_used=last_used, queries=queries)
+
+    @property
+    def refreshing(self) -> bool:
+
+        """ True if the registry is being reconciled """
+
+        return self._refreshing
+
+    def begin_refresh(self, wait: bool = True) -> bool:
+
+        """
+        True if the registry is outdated and the caller has to reconcile it,
+        only one caller reconciles the outdated registry at once.
+        Until the first reconciliation other callers wait for it
+        and reconcile the registry themselves if it fails,
+        wait: False - the caller reconciles the registry without waiting
+        """
+
+        with self._lock:
+            while self._refreshing and not self.ready and wait:
+                self._refreshed_cond.wait()
+            if self.ready and (
+                self._refreshing or
+                time.monotonic() - self._refreshed < self.refresh_interval
+            ):
+                return False
+            self._refreshing = True
+            return True
+
+    def cancel_refresh(self):
+        with self._lock:
+            self._refreshing = False
+            self._refreshed_cond.notify_all()
+
+    def reconcile(self, rows: Iterable[Row]):
+
+        """ Replaces sandboxes of the registry by the rows of pg_database """
+
+        sandboxes = {row[0]: self._make_data(row) for row in rows}
+        with self._lock:
+            self._sandboxes = sandboxes
+            for name in list(self._usage):
+                if name not in sandboxes:
+                    del self._usage[name]
+            self._refreshed = time.monotonic()
+            self._refreshing = False
+            self._refreshed_cond.notify_all()
+
+    def update(self, rows: Iterable[Row]):
+
+        """ Adds or updates sandboxes of the rows of pg_database """
+
+        sandboxes = {row[0]: self._make_data(row) for row in rows}
+        with self._lock:
+            self._sandboxes.update(sandboxes)
+
+    def remove(self, name: str):
+        with self._lock:
+            self._sandboxes.pop(name, None)
+            self._usage.pop(name, None)
+
+    def touch(self, name: str):
+
+        """ Counts the query to the sandbox """
+
+        with self._lock:
+            _, queries = self._usage.get(name, (None, 0))
+            self._usage[name] = (
+                datetime.now(timezone.utc).isoformat(),
+                queries + 1
+            )
+
+    def usage(self) -> Dict[str, str]:
+
+        """ Returns last used time of the sandboxes used by the process """
+
+        with self._lock:
+            return {name: usage[0] for name, usage in self._usage.items()}
+
+    def get(self, name: str) -> Optional[StatusData]:
+        with self._lock:
+            data = self._sandboxes.get(name)
+            return self._with_usage(data) if data else None
+
+    def all(self) -> List[StatusData]:
+        with self._lock:
+            return [
+                self._with_usage(self._sandboxes[name])
+                for name in sorted(self._sandboxes)
+            ]
+
+
+registry = SandboxRegistry()
@@ -0,0 +1,493 @@
+"""
+Admission control of requests to sandbox databases.
+A request is admitted if the amount of running requests is below
+the global limit and the limit of its sandbox, otherwise it waits
+in the bounded queue. Waiting requests are admitted by priority
+of the request type (config.SCHEDULER_PRIORITIES), then by arrival.
+Requests are rejected with QueueFullException if the queue is full
+or the request has waited too long.
+
+Limits of the scheduler are kept in the memory of the process,
+the total amount of running requests of all processes of the server
+is limited by the shared slots (SharedSlots): the admitted request
+waits for a free shared slot until the timeout of the queue.
+"""
+
+import math
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import psycopg2
+from collections import Counter
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, List, Set, Tuple, Iterator, AsyncIterator
+from psycopg2.extensions import connection
+from app import config
+from app.entities import SchedulerStatsData
+from app.service import exceptions
+from app.service.pool import connect
+from app.logger import get_logger
+logger = get_logger()
+
+# общий слот: номер соединения процесса и номер слота
+Slot = Tuple[int, int]
+
+
+class SharedSlots:
+
+    """
+    Slots of running requests shared by the processes of the server.
+    The slot is the advisory lock (hashtext(key), number) held by the own
+    connection of the process to the default database, so slots
+    of the stopped process are released with its connection.
+    Advisory locks are reentrant within a session, so the process
+    doesn't try to take the slots it already holds
+    size: amount of slots, 0 - slots are not used
+    """
+
+    def __init__(self, size: int, key: str = 'sandbox_scheduler'):
+        self.size = size
+        self.key = key
+        self._lock = threading.Lock()
+        self._con: Optional[connection] = None
+        # номер соединения, слоты закрытого соединения освобождены сервером
+        self._generation = 0
+        self._held: Set[int] = set()
+
+    def _get_connection(self) -> connection:
+        if self._con is None or self._con.closed:
+            self._con = connect()
+            self._con.autocommit = True
+            self._generation += 1
+            self._held.clear()
+        return self._con
+
+    def _close(self):
+        if self._con is not None:
+            self._con.close()
+        self._held.clear()
+
+    def acquire(self) -> Optional[Slot]:
+
+        """
+        Takes a free slot without waiting, returns None if all slots
+        are taken, psycopg2.Error is raised if the database is not available
+        """
+
+        with self._lock:
+            free = [num for num in range(self.size) if num not in self._held]
+            if not free:
+                return None
+            try:
+                with self._get_connection().cursor() as cursor:
+                    cursor.execute(
+                        'SELECT num FROM unnest(%(free)s::int[]) AS num '
+                        'WHERE pg_try_advisory_lock(hashtext(%(key)s), num) '
+                        'LIMIT 1',
+                        {'free': free, 'key': self.key}
+                    )
+                    row = cursor.fetchone()
+            except psycopg2.Error:
+                self._close()
+                raise
+            if row is None:
+                return None
+            self._held.add(row[0])
+            return self._generation, row[0]
+
+    def release(self, slot: Slot):
+        generation, num = slot
+        with self._lock:
+            if generation != self._generation or num not in self._held:
+                return
+            self._held.discard(num)
+            try:
+                with self._con.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT '
+                        'pg_advisory_unlock(hashtext(%(key)s), %(num)s)',
+                        {'key': self.key, 'num': num}
+                    )
+            except psycopg2.Error as e:
+                logger.error(e)
+                self._close()
+
+
+class Waiter:
+
+    """ Request waiting in the queue """
+
+    def __init__(self, priority: int, seq: int, name: Optional[str]):
+        self.priority = priority
+        self.seq = seq
+        self.name = name
+        self.enqueued = time.monotonic()
+        self.admitted = False
+        self.event = threading.Event()
+
+    def __lt__(self, other: 'Waiter') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self):
+        self.event.set()
+
+
+class Scheduler:
+
+    """
+    Thread-safe scheduler of requests
+    max_active: max amount of running requests
+    max_active_per_sandbox: max amount of running requests to one sandbox
+    max_queue: max amount of waiting requests
+    timeout: max waiting time in seconds
+    shared_slots: slots shared by the processes of the server,
+      None - the requests are limited only within the process
+    """
+
+    waiter_class = Waiter
+
+    def __init__(
+        self,
+        name: str,
+        max_active: int = config.SCHEDULER_MAX_ACTIVE,
+        max_active_per_sandbox: int = config.SCHEDULER_MAX_ACTIVE_PER_SANDBOX,
+        max_queue: int = config.SCHEDULER_MAX_QUEUE,
+        timeout: float = config.SCHEDULER_QUEUE_TIMEOUT,
+        priorities: List[str] = config.SCHEDULER_PRIORITIES,
+        shared_slots: Optional[SharedSlots] = None,
+        poll_interval: float = config.SCHEDULER_SHARED_POLL_INTERVAL,
+    ):
+        self.name = name
+        self.max_active = max_active
+        self.max_active_per_sandbox = max_active_per_sandbox
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.priorities = {kind: num for num, kind in enumerate(priorities)}
+        self.shared_slots = shared_slots
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._queue: List[Waiter] = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._active_by_name = Counter()
+        self._shared_active = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        # среднее время выполнения запроса, для оценки Retry-After
+        self._avg_run_time = 0.0
+
+    def _can_run(self, name: Optional[str]) -> bool:
+        return self._active < self.max_active and (
+            name is None or
+            self._active_by_name[name] < self.max_active_per_sandbox
+        )
+
+    def _admit(self, name: Optional[str], wait_time: float = 0.0):
+        self._active += 1
+        if name is not None:
+            self._active_by_name[name] += 1
+        self._admitted += 1
+        self._wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def _get_retry_after(self) -> int:
+
+        """ Estimated time in seconds until the queue is free """
+
+        return max(1, math.ceil(
+            self._avg_run_time * (len(self._queue) + 1) / self.max_active
+        ))
+
+    def _enqueue(self, kind: str, name: Optional[str]) -> Optional[Waiter]:
+
+        """
+        Admits the request if it can run, otherwise puts it into the queue,
+        returns None for the admitted request
+        """
+
+        with self._lock:
+            # в очереди нет запросов, которые могут быть выполнены,
+            # поэтому новый запрос не обгоняет ожидающие запросы
+            if self._can_run(name):
+                self._admit(name)
+                return None
+            if len(self._queue) >= self.max_queue:
+                self._rejected += 1
+                raise exceptions.QueueFullException(
+                    details=f'{len(self._queue)} requests are waiting',
+                    retry_after=self._get_retry_after()
+                )
+            waiter = self.waiter_class(
+                priority=self.priorities.get(kind, len(self.priorities)),
+                seq=next(self._seq),
+                name=name
+            )
+            heapq.heappush(self._queue, waiter)
+            return waiter
+
+    def _cancel(self, waiter: Waiter) -> bool:
+
+        """
+        Removes the waiter from the queue,
+        returns True if it has been admitted in the meantime
+        """
+
+        with self._lock:
+            if waiter.admitted:
+                return True
+            self._queue.remove(waiter)
+            heapq.heapify(self._queue)
+            return False
+
+    def _timeout(self, waiter: Waiter):
+
+        """ Rejects the waiter which has not been admitted in time """
+
+        if self._cancel(waiter):
+            return
+        with self._lock:
+            self._timeouts += 1
+            self._rejected += 1
+            retry_after = self._get_retry_after()
+        raise exceptions.QueueFullException(
+            details=f'Request waited more than {self.timeout} seconds',
+            retry_after=retry_after
+        )
+
+    def _release(self, name: Optional[str], run_time: float):
+        with self._lock:
+            self._active -= 1
+            if name is not None:
+                self._active_by_name[name] -= 1
+                if not self._active_by_name[name]:
+                    del self._active_by_name[name]
+            self._avg_run_time += (run_time - self._avg_run_time) * 0.1
+            self._dispatch()
+
+    def _dispatch(self):
+
+        """ Admits waiting requests which can run, by priority """
+
+        now = time.monotonic()
+        for waiter in sorted(self._queue):
+            if self._active >= self.max_active:
+                break
+            if self._can_run(waiter.name):
+                self._queue.remove(waiter)
+                self._admit(waiter.name, now - waiter.enqueued)
+                waiter.admitted = True
+                waiter.wake()
+        heapq.heapify(self._queue)
+
+    def _is_shared(self) -> bool:
+        return bool(self.shared_slots and self.shared_slots.size)
+
+    def _reject_shared(self, name: Optional[str]):
+
+        """ Releases the admitted request which hasn't got the shared slot """
+
+        self._release(name, 0.0)
+        with self._lock:
+            self._timeouts += 1
+            self._rejected += 1
+            retry_after = self._get_retry_after()
+        raise exceptions.QueueFullException(
+            details=(
+                f'{self.shared_slots.size} requests '
+                'are running in all processes'
+            ),
+            retry_after=retry_after
+        )
+
+    def _take_shared(self, slot: Optional[Slot]) -> Optional[Slot]:
+        if slot is not None:
+            with self._lock:
+                self._shared_active += 1
+        return slot
+
+    def _release_shared(self, slot: Optional[Slot]):
+        if slot is None:
+            return
+        self.shared_slots.release(slot)
+        with self._lock:
+            self._shared_active -= 1
+
+    def _acquire_shared(
+        self,
+        name: Optional[str],
+        deadline: float
+    ) -> Optional[Slot]:
+
+        """
+        Waits for the slot shared by the processes until the deadline,
+        returns None if shared slots are not used or the database
+        is not available, the request runs without the slot then
+        """
+
+        if not self._is_shared():
+            return None
+        while True:
+            try:
+                slot = self.shared_slots.acquire()
+            except psycopg2.Error as e:
+                logger.error(e)
+                return None
+            if slot is not None:
+                return self._take_shared(slot)
+            if time.monotonic() >= deadline:
+                self._reject_shared(name)
+            time.sleep(self.poll_interval)
+
+    @contextmanager
+    def slot(self, kind: str, name: Optional[str] = None) -> Iterator[None]:
+
+        """
+        Waits until the request can run
+        kind: type of the request, e.g. 'testing'
+        name: name of the sandbox, None - the request is limited
+          only by the global limit
+        """
+
+        deadline = time.monotonic() + self.timeout
+        waiter = self._enqueue(kind, name)
+        if waiter and not waiter.event.wait(self.timeout):
+            self._timeout(waiter)
+        shared = self._acquire_shared(name, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release_shared(shared)
+            self._release(name, time.monotonic() - started)
+
+    def stats(self) -> SchedulerStatsData:
+        with self._lock:
+            return SchedulerStatsData(
+                name=self.name,
+                active=self._active,
+                queued=len(self._queue),
+                max_active=self.max_active,
+                max_active_per_sandbox=self.max_active_per_sandbox,
+                max_queue=self.max_queue,
+                max_active_total=(
+                    self.shared_slots.size if self.shared_slots else 0
+                ),
+                shared_active=self._shared_active,
+                admitted=self._admitted,
+                rejected=self._rejected,
+                timeouts=self._timeouts,
+                wait_time=self._wait_time,
+                avg_wait_time=(
+                    self._wait_time / self._admitted
+                    if self._admitted else 0.0
+                ),
+                max_wait_time=self._max_wait_time,
+            )
+
+
+class AsyncWaiter(Waiter):
+
+    def __init__(self, priority: int, seq: int, name: Optional[str]):
+        super().__init__(priority, seq, name)
+        self.future = asyncio.get_event_loop().create_future()
+
+    def wake(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AsyncScheduler(Scheduler):
+
+    """ Scheduler of the requests of the asyncio application """
+
+    waiter_class = AsyncWaiter
+
+    def _release_cancelled(self, future: asyncio.Future):
+
+        """ Releases the shared slot taken after the request was cancelled """
+
+        if not future.cancelled() and future.exception() is None:
+            slot = self._take_shared(future.result())
+            asyncio.ensure_future(self._release_shared_async(slot))
+
+    async def _acquire_shared_async(
+        self,
+        name: Optional[str],
+        deadline: float
+    ) -> Optional[Slot]:
+
+        """ see Scheduler._acquire_shared """
+
+        if not self._is_shared():
+            return None
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.run_in_executor(None, self.shared_slots.acquire)
+            try:
+                slot = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                future.add_done_callback(self._release_cancelled)
+                self._release(name, 0.0)
+                raise
+            except psycopg2.Error as e:
+                logger.error(e)
+                return None
+            if slot is not None:
+                return self._take_shared(slot)
+            if time.monotonic() >= deadline:
+                self._reject_shared(name)
+            try:
+                await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                self._release(name, 0.0)
+                raise
+
+    async def _release_shared_async(self, slot: Optional[Slot]):
+        if slot is None:
+            return
+        loop = asyncio.get_running_loop()
+        # слот освобождается и при отмене запроса
+        await asyncio.shield(
+            loop.run_in_executor(None, self._release_shared, slot)
+        )
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        kind: str,
+        name: Optional[str] = None
+    ) -> AsyncIterator[None]:
+
+        """ see Scheduler.slot """
+
+        deadline = time.monotonic() + self.timeout
+        waiter = self._enqueue(kind, name)
+        if waiter:
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(waiter.future),
+                    self.timeout
+                )
+            except asyncio.TimeoutError:
+                self._timeout(waiter)
+            except asyncio.CancelledError:
+                if self._cancel(waiter):
+                    self._release(name, 0.0)
+                raise
+        shared = await self._acquire_shared_async(name, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            await self._release_shared_async(shared)
+            self._release(name, time.monotonic() - started)
+
+
+shared_slots = SharedSlots(size=config.SCHEDULER_MAX_ACTIVE_TOTAL)
+scheduler = Scheduler(name='sync', shared_slots=shared_slots)
+async_scheduler = AsyncScheduler(name='async', shared_slots=shared_slots)
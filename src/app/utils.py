@@ -1,7 +1,133 @@
-from typing import Optional
+import os
+import re
+import hashlib
+from typing import Optional, Dict, Tuple, List, Iterator
 
 
 def clean_str(value: Optional[str]) -> Optional[str]:
     if isinstance(value, str):
         return value.replace('\r', '').rstrip('\n')
     return value
+
+
+def clean_sql(query: str) -> str:
+
+    """ Removes trailing semicolons, so the query can be used as a subquery """
+
+    return re.sub(r'[\s;]+$', '', query)
+
+
+_file_hashes: Dict[str, Tuple[int, int, str]] = {}
+
+
+def get_file_hash(path: str) -> str:
+
+    """ Returns the hash of the file content, recalculated on file change """
+
+    stat = os.stat(path)
+    cached = _file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    result = file_hash.hexdigest()[:16]
+    _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, result)
+    return result
+
+
+_SQL_TOKEN = re.compile(r"""
+    (?P<space>\s+) |
+    (?P<comment>--[^\n]*) |
+    (?P<escape_string>[eE]'(?:[^'\\]|\\.|'')*'?) |
+    (?P<string>'(?:[^']|'')*'?) |
+    (?P<identifier>"(?:[^"]|"")*"?) |
+    (?P<semicolon>;) |
+    (?P<text>[^\s'";$/-]+|.)
+""", re.X | re.S)
+_DOLLAR_QUOTE = re.compile(r'\$([A-Za-z_\x80-￿][\w\x80-￿]*)?\$')
+_PUNCTUATION = '(),;'
+
+
+def scan_sql(query: str) -> Iterator[Tuple[str, str]]:
+
+    """
+    Splits the query into tokens, yields pairs (kind, text), kinds:
+    space, comment, string (quoted strings and identifiers),
+    semicolon, text (everything else)
+    """
+
+    i, length = 0, len(query)
+    while i < length:
+        match = _SQL_TOKEN.match(query, i)
+        kind = match.lastgroup
+        end = match.end()
+        if kind == 'text' and query.startswith('/*', i):
+            depth, end = 1, i + 2
+            while end < length and depth:
+                if query.startswith('/*', end):
+                    depth, end = depth + 1, end + 2
+                elif query.startswith('*/', end):
+                    depth, end = depth - 1, end + 2
+                else:
+                    end += 1
+            kind = 'comment'
+        elif (
+            kind == 'text' and query[i] == '$' and
+            not (i > 0 and (query[i - 1].isalnum() or query[i - 1] in '_$'))
+        ):
+            dollar_quote = _DOLLAR_QUOTE.match(query, i)
+            if dollar_quote:
+                tag = dollar_quote.group()
+                end = query.find(tag, dollar_quote.end())
+                end = length if end == -1 else end + len(tag)
+                kind = 'string'
+        elif kind in ('escape_string', 'identifier'):
+            kind = 'string'
+        yield kind, query[i:end]
+        i = end
+
+
+def split_sql(query: str) -> List[str]:
+
+    """ Splits the text into statements, empty statements are skipped """
+
+    statements, statement, empty = [], [], True
+    for kind, text in scan_sql(query):
+        if kind == 'semicolon':
+            if not empty:
+                statements.append(''.join(statement).strip())
+            statement, empty = [], True
+        else:
+            statement.append(text)
+            empty = empty and kind in ('space', 'comment')
+    if not empty:
+        statements.append(''.join(statement).strip())
+    return statements
+
+
+def normalize_sql(query: str) -> str:
+
+    """
+    Returns the query text which differs only for not equivalent queries:
+    comments are removed, whitespaces are collapsed,
+    keywords and identifiers outside quotes are lowercased,
+    trailing semicolons are removed
+    """
+
+    result = []
+    space = False
+    for kind, text in scan_sql(query):
+        if kind in ('space', 'comment'):
+            space = True
+            continue
+        if kind != 'string':
+            text = text.lower()
+        if space and result:
+            if result[-1][-1] not in _PUNCTUATION and text[0] not in _PUNCTUATION:
+                result.append(' ')
+        space = False
+        result.append(text)
+    return ''.join(result).rstrip('; ')
+
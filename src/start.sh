@@ -1,2 +1,3 @@
 #!/bin/bash
-gunicorn --bind 0:9004 app.main:app --reload -w ${GUNICORN_WORKERS:=1}
\ No newline at end of file
+# потоки выполняют запросы, ожидающие в очереди планировщика
+gunicorn --bind 0:9004 app.main:app --reload -w ${GUNICORN_WORKERS:=1} -k gthread --threads ${GUNICORN_THREADS:=8}
\ No newline at end of file
@@ -0,0 +1,57 @@
+import os
+import uuid
+import tempfile
+import pytest
+import psycopg2
+
+# кэш /debug/ тестов не смешивается с кэшем запущенного сервера
+os.environ.setdefault(
+    'DEBUG_CACHE_PATH',
+    os.path.join(tempfile.mkdtemp(), 'debug.sqlite3')
+)
+
+from app import config  # noqa: E402
+from app.service.pool import connect  # noqa: E402
+
+
+def is_database_available() -> bool:
+    try:
+        connect().close()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+database = pytest.mark.skipif(
+    not is_database_available(),
+    reason='PostgreSQL server of the sandboxes is not available'
+)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app.main import app
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(scope='session')
+def sandbox(app):
+
+    """ Name of the sandbox created from test.sql for the session """
+
+    if not os.path.exists(os.path.join(config.SQL_FILES_DIR, 'test.sql')):
+        pytest.skip('test.sql is not found in SQL_FILES_DIR')
+    name = f'pytest_{uuid.uuid4().hex[:8]}'
+    client = app.test_client()
+    response = client.post(
+        '/create/',
+        json={'name': name, 'filename': 'test.sql', 'wait': True}
+    )
+    assert response.status_code == 200, response.get_json()
+    yield name
+    client.post(f'/delete/{name}/')
@@ -0,0 +1,66 @@
+import os
+import uuid
+import shutil
+from app import config
+from app.service import exceptions
+from app.service.main import PostgresqlService
+from tests.conftest import database
+
+
+def get_names(amount: int):
+    prefix = f'pytest_{uuid.uuid4().hex[:8]}'
+    return [f'{prefix}_{num}' for num in range(amount)]
+
+
+@database
+def test_bulk_results_are_per_item(client, tmp_path, monkeypatch):
+    shutil.copy(os.path.join(config.SQL_FILES_DIR, 'test.sql'), tmp_path)
+    (tmp_path / 'broken.sql').write_text('CREATE TABLE broken (;\n')
+    monkeypatch.setattr(config, 'SQL_FILES_DIR', str(tmp_path))
+    loads = []
+    load_database_from_file = PostgresqlService._load_database_from_file
+
+    def counting_load(db_name, file_path, *args):
+        loads.append(os.path.basename(file_path))
+        return load_database_from_file(db_name, file_path, *args)
+
+    monkeypatch.setattr(
+        PostgresqlService, '_load_database_from_file', counting_load
+    )
+    names = get_names(6)
+    items = [
+        {'name': names[0], 'filename': 'test.sql'},
+        {'name': names[1], 'filename': 'broken.sql'},
+        {'name': names[2], 'filename': 'missing.sql'},
+        {'name': names[3], 'filename': 'test.sql',
+         'limits': {'work_mem': 'lots'}},
+        {'name': names[4], 'filename': 'broken.sql'},
+        {'name': names[5], 'filename': 'test.sql'},
+    ]
+    try:
+        response = client.post('/create/bulk/', json={'items': items})
+        assert response.status_code == 200, response.get_json()
+        results = response.get_json()['results']
+        assert [result['name'] for result in results] == names
+        assert [result['ok'] for result in results] == [
+            True, False, False, False, False, True
+        ]
+        assert 'line 1' in results[1]['details']
+        # файл загружается один раз для всех его песочниц
+        assert results[4] == dict(results[1], name=names[4], duration=0.0)
+        assert results[2]['error'] == exceptions.FileNotFound.default_message
+        assert results[3]['error'] == (
+            exceptions.CreationException.default_message
+        )
+        # шаблон test.sql мог быть загружен ранее
+        assert loads.count('broken.sql') == 1
+        assert loads.count('test.sql') <= 1
+        for name, ok in zip(names, [result['ok'] for result in results]):
+            status = client.get(f'/status/{name}/').get_json()
+            assert (status['status'] == 'active') is ok, status
+    finally:
+        response = client.post('/delete/bulk/', json={'names': names})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['name'] for result in results] == names
+    assert all(result['ok'] for result in results)
@@ -0,0 +1,41 @@
+import os
+from app.service.cache import SharedCache
+
+
+def test_shared_cache_is_shared_by_instances(tmp_path):
+    path = str(tmp_path / 'cache' / 'test.sqlite3')
+    first = SharedCache(name='test', path=path, max_bytes=1024)
+    second = SharedCache(name='test', path=path, max_bytes=1024)
+    first.set(('db', 1), [('row', 1)])
+    assert second.get(('db', 1)) == [('row', 1)]
+    second.invalidate(lambda key: key[0] == 'db')
+    assert first.get(('db', 1)) is None
+
+
+def test_shared_cache_evicts_least_recently_used(tmp_path):
+    cache = SharedCache(
+        name='test',
+        path=str(tmp_path / 'test.sqlite3'),
+        max_bytes=200
+    )
+    cache.set('first', 'x' * 50)
+    cache.set('second', 'x' * 50)
+    cache.get('first')
+    cache.set('third', 'x' * 50)
+    assert cache.get('second') is None
+    assert cache.get('first') is not None
+    assert cache.stats().evictions == 1
+
+
+def test_shared_cache_ignores_directory_writable_by_others(tmp_path):
+    directory = tmp_path / 'shared'
+    directory.mkdir()
+    os.chmod(directory, 0o777)
+    cache = SharedCache(
+        name='test',
+        path=str(directory / 'test.sqlite3'),
+        max_bytes=1024
+    )
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+    assert not (directory / 'test.sqlite3').exists()
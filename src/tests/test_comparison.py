@@ -0,0 +1,100 @@
+import pytest
+import psycopg2
+from app.service import comparison, exceptions
+from app.service.entities import ResultFingerprint
+from app.service.pool import connect
+from tests.conftest import database
+
+INT4, TEXT, NUMERIC, DATE = 23, 25, 1700, 1082
+
+
+def fingerprint(columns: tuple, rows: int = 1, hash: tuple = (1, 1)):
+    return ResultFingerprint(columns=columns, rows=rows, hash=hash)
+
+
+@pytest.mark.parametrize('first, second, expected', [
+    # равные отпечатки
+    (fingerprint((INT4, TEXT)), fingerprint((INT4, TEXT)), True),
+    # разное количество строк
+    (fingerprint((NUMERIC,), 1), fingerprint((NUMERIC,), 2), False),
+    # разный текст значений типов, сравниваемых по тексту
+    (fingerprint((INT4, TEXT)), fingerprint((INT4, TEXT), 1, (2, 2)), False),
+    # равные значения могут иметь разный текст
+    (fingerprint((NUMERIC,)), fingerprint((NUMERIC,), 1, (2, 2)), None),
+    (fingerprint((DATE,)), fingerprint((DATE,), 1, (2, 2)), None),
+    # разные типы столбцов сравниваются точно
+    (fingerprint((INT4,)), fingerprint((NUMERIC,)), None),
+    (fingerprint((INT4,), 1), fingerprint((NUMERIC,), 2), None),
+])
+def test_check_fingerprints(first, second, expected):
+    assert comparison.check_fingerprints(first, second) is expected
+
+
+def test_check_fingerprints_columns_count_mismatch():
+    with pytest.raises(exceptions.CheckException):
+        comparison.check_fingerprints(
+            fingerprint((INT4,)), fingerprint((INT4, INT4))
+        )
+
+
+@pytest.fixture
+def cursor():
+    con = connect()
+    try:
+        with con.cursor() as cursor:
+            yield cursor
+    finally:
+        con.rollback()
+        con.close()
+
+
+ROWS = 'SELECT * FROM (VALUES {0}) AS rows(id, title)'
+
+
+@database
+@pytest.mark.parametrize('first, second, ordered, expected', [
+    (ROWS.format("(1, 'a'), (2, 'b')"), ROWS.format("(1, 'a'), (2, 'b')"),
+     False, True),
+    (ROWS.format("(1, 'a'), (2, 'b')"), ROWS.format("(2, 'b'), (1, 'a')"),
+     False, True),
+    (ROWS.format("(1, 'a'), (2, 'b')"), ROWS.format("(2, 'b'), (1, 'a')"),
+     True, False),
+    (ROWS.format("(1, 'a'), (1, 'a')"), ROWS.format("(1, 'a')"),
+     False, False),
+    (ROWS.format("(1, 'a'), (2, 'b')"), ROWS.format("(1, 'a'), (2, 'c')"),
+     False, False),
+    # равенство чисел разной точности и разрядности
+    ('SELECT 1.0::numeric', 'SELECT 1.00::numeric', False, True),
+    ('SELECT 1.0::numeric', 'SELECT 1.01::numeric', False, False),
+    ('SELECT 1::int2, 2::int4', 'SELECT 1::int8, 2::numeric', False, True),
+    ('SELECT 1::int4', 'SELECT 2::int8', False, False),
+])
+def test_compare(cursor, first, second, ordered, expected):
+    assert comparison.compare(cursor, first, second, ordered) is expected
+
+
+@database
+def test_compare_columns_count_mismatch(cursor):
+    with pytest.raises(exceptions.CheckException):
+        comparison.compare(cursor, 'SELECT 1', 'SELECT 1, 2')
+
+
+@database
+def test_compare_columns_type_mismatch(cursor):
+    with pytest.raises(psycopg2.errors.DatatypeMismatch):
+        comparison.compare(cursor, 'SELECT 1', "SELECT 'a'::text")
+
+
+@database
+def test_dates_are_compared_exactly(cursor):
+    query = "SELECT '2020-01-02'::date, '2020-01-02 10:00+03'::timestamptz"
+    cursor.execute("SET DateStyle = 'SQL, DMY'; SET TimeZone = 'Asia/Tokyo'")
+    first = comparison.get_fingerprint(cursor, query)
+    cursor.execute("SET DateStyle = 'ISO'; SET TimeZone = 'UTC'")
+    second = comparison.get_fingerprint(cursor, query)
+    assert first.hash != second.hash
+    assert comparison.check_fingerprints(first, second) is None
+    # отпечатки вычислены при разных настройках, результаты равны
+    same = f'SELECT * FROM ({query}) AS same'
+    fingerprints = {same: first, query: second}
+    assert comparison.compare(cursor, same, query, False, fingerprints)
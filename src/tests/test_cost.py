@@ -0,0 +1,150 @@
+import uuid
+import pytest
+from app.service import exceptions, governor
+from app.service.cache import plan_cache
+from app.service.main import PostgresqlService
+from app.service.pool import connect
+from tests.conftest import database
+
+COST, ROWS = governor.COST_LIMITS.values()
+EXPENSIVE = 'SELECT * FROM generate_series(1, 1000000) AS a(id) ORDER BY id'
+
+
+@pytest.mark.parametrize('values, limits', [
+    (['1e3', '100'], {COST: 1000.0, ROWS: 100.0}),
+    (['1e3', None], {COST: 1000.0}),
+    (['', 'many'], {}),
+    ([None, None], {}),
+])
+def test_parse_cost_limits(values, limits):
+    assert governor.parse_cost_limits(values) == limits
+
+
+@pytest.mark.parametrize('estimate, exceeded', [
+    ({COST: 100.0, ROWS: 10.0}, False),
+    ({COST: 1000.0, ROWS: 10.0}, False),
+    ({COST: 1000.5, ROWS: 10.0}, True),
+    ({COST: 10.0, ROWS: 101.0}, True),
+])
+def test_check_estimate(estimate, exceeded):
+    limits = {COST: 1000.0, ROWS: 100.0}
+    if exceeded:
+        with pytest.raises(exceptions.CostLimitException):
+            governor.check_estimate(estimate, limits)
+    else:
+        governor.check_estimate(estimate, limits)
+
+
+def test_explain_statements():
+    code = (
+        'SET work_mem = 1; (SELECT 1); with a AS (SELECT 1) TABLE a; '
+        'CREATE TABLE t (id int); insert INTO t VALUES (1); '
+        'UPDATE t SET id = 2; DELETE FROM t; VALUES (1); TABLE t'
+    )
+    assert [
+        statement.split()[0].lower()
+        for statement in governor.get_explain_statements(code)
+    ] == ['(select', 'with', 'insert', 'update', 'delete', 'values', 'table']
+
+
+def test_get_estimate():
+    plan = [{'Plan': {'Node Type': 'Result', 'Total Cost': 0.01,
+                      'Plan Rows': 1, 'Startup Cost': 0}}]
+    assert governor.get_estimate(plan) == {COST: 0.01, ROWS: 1.0}
+
+
+@pytest.fixture
+def cursor():
+    con = connect()
+    try:
+        with con.cursor() as cursor:
+            yield cursor
+    finally:
+        con.rollback()
+        con.close()
+
+
+def set_cost_limits(cursor, max_cost: str, max_rows: str):
+    cursor.execute(
+        "SELECT set_config('sandbox.max_cost', %s, true), "
+        "set_config('sandbox.max_rows', %s, true)",
+        (max_cost, max_rows)
+    )
+
+
+@database
+def test_expensive_query_is_rejected(cursor):
+    set_cost_limits(cursor, '1000', '1e8')
+    PostgresqlService._check_cost(cursor, 'SELECT 1')
+    with pytest.raises(exceptions.CostLimitException):
+        PostgresqlService._check_cost(cursor, f'SELECT 1; {EXPENSIVE}')
+    set_cost_limits(cursor, '1e12', '100')
+    with pytest.raises(exceptions.CostLimitException):
+        PostgresqlService._check_cost(
+            cursor, 'SELECT * FROM generate_series(1, 1000)'
+        )
+
+
+@database
+def test_queries_are_not_checked_without_limits(cursor):
+    set_cost_limits(cursor, '', '')
+    PostgresqlService._check_cost(cursor, EXPENSIVE)
+
+
+@database
+def test_unexplainable_statement_is_skipped(cursor):
+    set_cost_limits(cursor, '1000', '1e8')
+    # таблица создается предыдущей командой, план получить нельзя
+    PostgresqlService._check_cost(
+        cursor,
+        'CREATE TEMP TABLE cost_t (id int); SELECT * FROM cost_t'
+    )
+    # транзакция продолжается после ошибки EXPLAIN
+    cursor.execute('SELECT 1')
+    assert cursor.fetchone() == (1,)
+
+
+@database
+def test_estimates_are_cached(cursor):
+    set_cost_limits(cursor, '1e12', '1e12')
+    code = f'SELECT {uuid.uuid4().int % 1000} FROM generate_series(1, 10)'
+    PostgresqlService._check_cost(cursor, code)
+    hits = plan_cache.stats().hits
+    PostgresqlService._check_cost(cursor, code.lower())
+    assert plan_cache.stats().hits == hits + 1
+
+
+@database
+def test_sandbox_cost_limits_reject_queries(client):
+    name = f'pytest_{uuid.uuid4().hex[:8]}'
+    response = client.post('/create/', json={
+        'name': name,
+        'filename': 'test.sql',
+        'limits': {'max_rows': 1000},
+        'wait': True,
+    })
+    assert response.status_code == 200, response.get_json()
+    code = (
+        'SELECT * FROM tasks_solution '
+        'CROSS JOIN generate_series(1, 100000)'
+    )
+    message = exceptions.CostLimitException.default_message
+    try:
+        response = client.post('/debug/', json={
+            'name': name, 'code': code, 'format': 'array'
+        })
+        assert response.get_json()['error'] == message
+        response = client.post('/testing/', json={
+            'name': name,
+            'code': code,
+            'request_type': 'select',
+            'tests': [{'data_in': 'SELECT 1'}],
+        })
+        assert response.get_json()['tests'][0]['error'] == message
+        # запрос с небольшой оценкой выполняется
+        response = client.post('/debug/', json={
+            'name': name, 'code': 'SELECT 1', 'format': 'array'
+        })
+        assert response.get_json()['result'] == [['?column?'], [1]]
+    finally:
+        client.post(f'/delete/{name}/')
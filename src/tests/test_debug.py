@@ -0,0 +1,90 @@
+import pytest
+import psycopg2
+from app import config
+from app.service.main import PostgresqlService
+from app.service.pool import pools
+from tests.conftest import database
+from tests.test_debug_cache import debug
+
+LEADING = "SET LOCAL work_mem = '8MB'; "
+
+
+@database
+def test_last_statement_is_fetched_by_server_cursor(sandbox):
+    db_name = PostgresqlService._get_db_name(sandbox)
+    with pools.connection(db_name) as con:
+        cursor = PostgresqlService._execute_debug_command(
+            con, LEADING + 'SELECT id FROM tasks_task ORDER BY id'
+        )
+        assert cursor.name == 'debug'
+        assert cursor.fetchone() is not None
+
+
+@database
+def test_result_after_leading_statements_is_capped(
+    client, sandbox, monkeypatch
+):
+    monkeypatch.setattr(config, 'DEBUG_MAX_ROWS', 2)
+    data = debug(client, sandbox, LEADING + 'SELECT generate_series(1, 5)')
+    assert data['result'] == [['generate_series'], [1], [2]]
+    assert data['truncated']
+
+
+@database
+def test_client_result_is_capped(client, sandbox, monkeypatch):
+    monkeypatch.setattr(config, 'DEBUG_MAX_ROWS', 2)
+    data = debug(
+        client, sandbox,
+        'CREATE TEMP TABLE debug_rows AS SELECT generate_series(1, 5) AS id;'
+        'DELETE FROM debug_rows RETURNING id'
+    )
+    assert data['result'] == [['id'], [1], [2]]
+    assert data['truncated']
+
+
+@database
+def test_rejected_cursor_is_executed_once(client, sandbox):
+    # повторное выполнение первой команды завершилось бы ошибкой
+    data = debug(
+        client, sandbox,
+        'CREATE TEMP TABLE debug_once AS SELECT 1 AS id; '
+        'WITH deleted AS (DELETE FROM debug_once RETURNING id) '
+        'SELECT count(*) FROM deleted'
+    )
+    assert data.get('error') is None
+    assert data['result'] == [['count'], [1]]
+
+
+@database
+def test_failed_query_is_not_executed_again(sandbox):
+    executed = []
+
+    class RecordingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            executed.append(query)
+            return super().execute(query, vars)
+
+    db_name = PostgresqlService._get_db_name(sandbox)
+    with pools.connection(db_name) as con:
+        con.cursor_factory = RecordingCursor
+        try:
+            with pytest.raises(psycopg2.errors.DivisionByZero):
+                PostgresqlService._execute_debug_command(con, 'SELECT 1 / 0')
+        finally:
+            con.cursor_factory = None
+    assert executed.count('SELECT 1 / 0') == 1
+
+
+@database
+def test_failed_cacheable_query_is_executed_once(client, sandbox, monkeypatch):
+    calls = []
+    debug_rows = PostgresqlService.debug_rows
+
+    def recording_debug_rows(data, read_only=False):
+        calls.append(read_only)
+        return debug_rows(data, read_only)
+
+    monkeypatch.setattr(PostgresqlService, 'debug_rows', recording_debug_rows)
+    data = debug(client, sandbox, 'SELECT 1 / (id - id) FROM tasks_task')
+    assert data['error'] == 'division by zero'
+    assert calls == [True]
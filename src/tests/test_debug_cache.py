@@ -0,0 +1,91 @@
+import pytest
+from app.service.cache import debug_cache
+from app.service.main import PostgresqlService
+from app.service.pool import pools
+from app.service.registry import registry
+from tests.conftest import database
+
+
+def debug(client, name: str, code: str, format: str = 'array') -> dict:
+    response = client.post(
+        '/debug/',
+        json={'name': name, 'code': code, 'format': format}
+    )
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def is_cached(client, name: str, code: str) -> bool:
+    hits = debug_cache.stats().hits
+    debug(client, name, code)
+    return debug_cache.stats().hits > hits
+
+
+@database
+def test_equivalent_query_is_cached(client, sandbox):
+    first = debug(client, sandbox, 'SELECT id FROM tasks_solution LIMIT 2')
+    hits = debug_cache.stats().hits
+    second = debug(client, sandbox, 'select ID\nfrom tasks_solution limit 2;')
+    assert debug_cache.stats().hits == hits + 1
+    assert second == first
+
+
+@database
+@pytest.mark.parametrize('code', [
+    'SELECT count(*) FROM pg_stat_activity',
+    "SELECT pg_database_size('postgres')",
+    'SELECT 1 FROM pg_class LIMIT 1',
+    'SELECT random() < 2',
+    'SELECT now() > CURRENT_DATE',
+    'SELECT count(*) FROM information_schema.tables',
+])
+def test_query_reading_changing_data_is_not_cached(client, sandbox, code):
+    debug(client, sandbox, code)
+    assert not is_cached(client, sandbox, code)
+
+
+@database
+def test_data_modifying_query_is_executed_and_not_cached(client, sandbox):
+    code = (
+        'WITH deleted AS (DELETE FROM tasks_solution WHERE id < 0 '
+        'RETURNING id) SELECT count(*) FROM deleted'
+    )
+    assert debug(client, sandbox, code)['result'] == [['count'], [0]]
+    assert not is_cached(client, sandbox, code)
+
+
+@database
+def test_recreated_sandbox_invalidates_results(client, sandbox):
+    code = 'SELECT id FROM tasks_solution ORDER BY id DESC LIMIT 2'
+    debug(client, sandbox, code)
+    assert is_cached(client, sandbox, code)
+    response = client.post('/create/', json={
+        'name': sandbox,
+        'filename': 'test.sql',
+        'force': True,
+        'wait': True,
+    })
+    assert response.status_code == 200
+    assert not is_cached(client, sandbox, code)
+
+
+@database
+def test_sandbox_recreated_by_other_process_invalidates_results(
+    client, sandbox, monkeypatch
+):
+    code = 'SELECT id FROM tasks_solution ORDER BY id DESC LIMIT 3'
+    debug(client, sandbox, code)
+    assert is_cached(client, sandbox, code)
+    # другой процесс пересоздает песочницу, реестр этого процесса
+    # остается прежним, кэш результатов общий
+    stale = registry.get(sandbox)
+    monkeypatch.setattr(PostgresqlService, '_invalidate', pools.invalidate)
+    response = client.post('/create/', json={
+        'name': sandbox,
+        'filename': 'test.sql',
+        'force': True,
+        'wait': True,
+    })
+    assert response.status_code == 200
+    monkeypatch.setattr(registry, 'get', lambda name: stale)
+    assert not is_cached(client, sandbox, code)
@@ -0,0 +1,152 @@
+import json
+import uuid
+import pytest
+from psycopg2 import sql
+from app import config
+from app.service import exceptions, governor
+from app.service.main import PostgresqlService
+from app.service.pool import connect
+from tests.conftest import database
+
+
+@pytest.fixture
+def cursor():
+    con = connect()
+    try:
+        with con.cursor() as cursor:
+            yield cursor
+    finally:
+        # комментарий базы восстанавливается откатом транзакции
+        con.rollback()
+        con.close()
+
+
+def set_comment(cursor, comment: str):
+    cursor.execute('SELECT current_database()')
+    cursor.execute(
+        sql.SQL('COMMENT ON DATABASE {} IS %(comment)s').format(
+            sql.Identifier(cursor.fetchone()[0])
+        ),
+        {'comment': comment}
+    )
+
+
+def get_settings(cursor, names: list) -> dict:
+    cursor.execute(*governor.get_limits_sql())
+    settings = {}
+    for name in names:
+        cursor.execute('SELECT current_setting(%s)', (name,))
+        settings[name] = cursor.fetchone()[0]
+    return settings
+
+
+@database
+@pytest.mark.parametrize('comment', [
+    None,
+    'not a json comment',
+    json.dumps({'filename': 'test.sql'}),
+    json.dumps({'filename': 'test.sql', 'limits': None}),
+])
+def test_global_limits_are_set(cursor, monkeypatch, comment):
+    monkeypatch.setitem(config.SANDBOX_LIMITS, 'work_mem', '5MB')
+    monkeypatch.setitem(config.SANDBOX_LIMITS, 'lock_timeout', '')
+    cursor.execute('SHOW lock_timeout')
+    lock_timeout = cursor.fetchone()[0]
+    set_comment(cursor, comment)
+    settings = get_settings(cursor, ['work_mem', 'lock_timeout'])
+    # пустое значение - ограничение не устанавливается
+    assert settings == {'work_mem': '5MB', 'lock_timeout': lock_timeout}
+
+
+@database
+def test_sandbox_limits_override_global_limits(cursor, monkeypatch):
+    monkeypatch.setitem(config.SANDBOX_LIMITS, 'work_mem', '5MB')
+    monkeypatch.setitem(config.SANDBOX_LIMITS, 'statement_timeout', '7s')
+    cursor.execute('SHOW lock_timeout')
+    lock_timeout = cursor.fetchone()[0]
+    set_comment(cursor, json.dumps({'limits': {
+        'work_mem': '6MB',
+        'lock_timeout': '',
+        'sandbox.max_rows': '100',
+    }}))
+    settings = get_settings(
+        cursor,
+        ['work_mem', 'statement_timeout', 'lock_timeout', 'sandbox.max_rows']
+    )
+    assert settings == {
+        'work_mem': '6MB',
+        'statement_timeout': '7s',
+        'lock_timeout': lock_timeout,
+        'sandbox.max_rows': '100',
+    }
+
+
+@database
+def test_limits_are_reset_with_transaction(cursor):
+    cursor.execute('SHOW work_mem')
+    work_mem = cursor.fetchone()[0]
+    cursor.execute(*governor.get_limits_sql())
+    cursor.connection.rollback()
+    cursor.execute('SHOW work_mem')
+    assert cursor.fetchone()[0] == work_mem
+
+
+@database
+@pytest.mark.parametrize('limits', [
+    {'work_mem': 'lots'},
+    {'statement_timeout': '-1s'},
+    {'no_such_setting': '1'},
+])
+def test_invalid_limits_are_rejected(limits):
+    with pytest.raises(exceptions.CreationException):
+        PostgresqlService._check_limits(limits)
+
+
+@database
+def test_valid_limits_are_accepted():
+    PostgresqlService._check_limits({'work_mem': '8MB', 'lock_timeout': ''})
+
+
+class Error(Exception):
+    def __init__(self, pgcode: str):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+@pytest.mark.parametrize('error, exception', [
+    (Error('57014'), exceptions.QueryTimeoutException),
+    (Error('55P03'), exceptions.QueryTimeoutException),
+    (Error('53400'), exceptions.ResourceLimitException),
+    (Error('42P01'), None),
+    (ValueError(), None),
+])
+def test_limit_exception(error, exception):
+    result = governor.get_limit_exception(error)
+    if exception is None:
+        assert result is None
+    else:
+        assert isinstance(result, exception)
+        assert governor.is_limit_error(result.message)
+
+
+@database
+def test_sandbox_limits_apply_to_queries(client):
+    name = f'pytest_{uuid.uuid4().hex[:8]}'
+    response = client.post('/create/', json={
+        'name': name,
+        'filename': 'test.sql',
+        'limits': {'statement_timeout': '100ms'},
+        'wait': True,
+    })
+    assert response.status_code == 200, response.get_json()
+    try:
+        response = client.post('/debug/', json={
+            'name': name,
+            'code': 'SELECT pg_sleep(1)',
+            'format': 'array',
+        })
+        assert response.get_json()['error'] == (
+            exceptions.QueryTimeoutException.default_message
+        )
+    finally:
+        client.post(f'/delete/{name}/')
@@ -0,0 +1,47 @@
+import time
+from app.service.cache import SharedCache
+from app.service.jobs import JobQueue
+from app.service.enums import JobStatus, JobPhase
+
+
+def wait(queue: JobQueue, job_id: str):
+    queue.future(job_id).result()
+
+
+def test_job_is_available_in_other_process(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    # очереди с общим хранилищем, как в разных процессах сервера
+    queue = JobQueue(store=SharedCache('jobs', path, 1024 * 1024))
+    other = JobQueue(store=SharedCache('jobs', path, 1024 * 1024))
+
+    def func(report):
+        report(JobPhase.LOAD, 0.5)
+
+    job = queue.submit('demo', 'key', func)
+    wait(queue, job.id)
+    data = other.get(job.id)
+    assert data.status == JobStatus.DONE
+    assert data.name == 'demo'
+    assert data.duration is not None
+
+
+def test_failed_job_is_available_in_other_process(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    queue = JobQueue(store=SharedCache('jobs', path, 1024 * 1024))
+    other = JobQueue(store=SharedCache('jobs', path, 1024 * 1024))
+
+    def func(report):
+        raise ValueError('broken file')
+
+    job = queue.submit('demo', 'key', func)
+    while queue.get(job.id).status != JobStatus.FAILED:
+        time.sleep(0.01)
+    data = other.get(job.id)
+    assert data.status == JobStatus.FAILED
+    assert data.error == 'broken file'
+
+
+def test_unknown_job_returns_404(client):
+    response = client.get('/jobs/0123456789abcdef/')
+    assert response.status_code == 404
+    assert response.get_json()['error'] == 'Job not found'
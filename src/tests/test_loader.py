@@ -0,0 +1,147 @@
+import uuid
+import pytest
+from psycopg2 import sql
+from app import config
+from app.service import exceptions
+from app.service.loader import SqlFileLoader
+from app.service.pool import connect
+from tests.conftest import database
+
+DUMP = r"""--
+-- PostgreSQL database dump
+--
+
+\restrict pytest
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+CREATE TABLE public.task (
+    id integer NOT NULL,
+    title text
+);
+
+ALTER TABLE public.task OWNER TO nobody;
+CREATE SEQUENCE public.task_id_seq AS integer START WITH 1;
+ALTER SEQUENCE public.task_id_seq OWNER TO nobody;
+
+CREATE FUNCTION public.title_of(task_id integer) RETURNS text
+    LANGUAGE sql AS $$
+    SELECT title FROM public.task WHERE id = task_id; -- ;
+$$;
+
+COPY public.task (id, title) FROM stdin;
+1	Задача; первая
+2	tab\tand \\ backslash
+3	\N
+\.
+
+INSERT INTO public.task VALUES (4, 'text with ; and -- inside');
+INSERT INTO public.task VALUES (5, 'multi
+line; value');
+/* comment; with semicolon */
+SELECT pg_catalog.setval('public.task_id_seq', 5, true);
+
+CREATE UNIQUE INDEX task_id ON public.task USING btree (id);
+
+GRANT ALL ON TABLE public.task TO nobody;
+REVOKE ALL ON SCHEMA public FROM PUBLIC;
+\unrestrict pytest
+"""
+
+
+@pytest.fixture
+def db_name():
+    name = f'pytest_loader_{uuid.uuid4().hex[:8]}'
+    con = connect()
+    con.autocommit = True
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    "CREATE DATABASE {} TEMPLATE template0 ENCODING 'UTF8'"
+                ).format(sql.Identifier(name))
+            )
+        yield name
+        with con.cursor() as cursor:
+            cursor.execute(
+                sql.SQL('DROP DATABASE {}').format(sql.Identifier(name))
+            )
+    finally:
+        con.close()
+
+
+def write(tmp_path, text: str) -> str:
+    file_path = tmp_path / 'dump.sql'
+    file_path.write_bytes(text.encode())
+    return str(file_path)
+
+
+def query(db_name: str, query: str) -> list:
+    con = connect(db_name)
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(query)
+            return cursor.fetchall()
+    finally:
+        con.close()
+
+
+@database
+@pytest.mark.parametrize('batch_size', [1, 1024 * 1024])
+def test_dump_is_loaded(tmp_path, db_name, monkeypatch, batch_size):
+    monkeypatch.setattr(config, 'LOADER_BATCH_SIZE', batch_size)
+    monkeypatch.setattr(config, 'LOADER_COPY_BUFFER', 8)
+    progress = []
+    file_path = write(tmp_path, DUMP)
+    SqlFileLoader(
+        file_path, lambda *args: progress.append(args)
+    ).load(db_name)
+    assert query(db_name, 'SELECT id, title FROM task ORDER BY id') == [
+        (1, 'Задача; первая'),
+        (2, 'tab\tand \\ backslash'),
+        (3, None),
+        (4, 'text with ; and -- inside'),
+        (5, 'multi\nline; value'),
+    ]
+    assert query(db_name, 'SELECT title_of(1)') == [('Задача; первая',)]
+    assert query(db_name, "SELECT last_value FROM task_id_seq") == [(5,)]
+    assert query(db_name, "SELECT to_regclass('task_id')::text") == [
+        ('task_id',)
+    ]
+    # владелец и права не восстанавливаются
+    assert query(
+        db_name,
+        "SELECT tableowner = current_user, "
+        "  has_table_privilege('public', 'task', 'select') "
+        "FROM pg_tables WHERE tablename = 'task'"
+    ) == [(True, False)]
+    assert progress[-1] == (len(DUMP.encode()),) * 2
+
+
+@database
+@pytest.mark.parametrize('text, line', [
+    ('CREATE TABLE t (id int);\nSELECT nope;\n', 2),
+    ('CREATE TABLE t (id int);\n'
+     'INSERT INTO t VALUES (1);\n'
+     "INSERT INTO t VALUES ('x');\n", 3),
+    ('CREATE TABLE t (id int);\n'
+     'COPY t (id) FROM stdin;\n1\nx\n\\.\n', 2),
+])
+def test_error_reports_line(tmp_path, db_name, text, line):
+    with pytest.raises(exceptions.CreationException) as error:
+        SqlFileLoader(write(tmp_path, text)).load(db_name)
+    assert f'line {line}:' in error.value.details
+    # файл загружается в одной транзакции
+    assert query(db_name, "SELECT to_regclass('t')") == [(None,)]
+
+
+@database
+def test_index_is_created_before_next_statements(tmp_path, db_name):
+    text = (
+        'CREATE TABLE t (id int);\n'
+        'CREATE UNIQUE INDEX t_id ON t (id);\n'
+        'INSERT INTO t VALUES (1);\n'
+        'INSERT INTO t VALUES (1) ON CONFLICT (id) DO NOTHING;\n'
+    )
+    SqlFileLoader(write(tmp_path, text)).load(db_name)
+    assert query(db_name, 'SELECT count(*) FROM t') == [(1,)]
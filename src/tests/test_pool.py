@@ -0,0 +1,131 @@
+import time
+import uuid
+from typing import Optional
+from app.service.pool import ConnectionPool, connect, pools
+from tests.conftest import database
+
+
+@database
+def test_session_state_is_reset_on_return():
+    pool = ConnectionPool(min_size=0, max_size=1)
+    try:
+        con = pool.getconn()
+        with con.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE leaked (id int); '
+                'INSERT INTO leaked VALUES (42); '
+                "SET search_path TO 'pg_catalog'; "
+                'PREPARE leaked_plan AS SELECT 1; '
+                'COMMIT'
+            )
+        pool.putconn(con)
+
+        con = pool.getconn()
+        with con.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('pg_temp.leaked')")
+            assert cursor.fetchone()[0] is None
+            cursor.execute('SHOW search_path')
+            assert cursor.fetchone()[0] != 'pg_catalog'
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            assert cursor.fetchone()[0] == 0
+        pool.putconn(con)
+        assert pool.stats().created == 1
+    finally:
+        pool.close()
+
+
+def debug(client, name: str, code: str) -> dict:
+    response = client.post(
+        '/debug/',
+        json={'name': name, 'code': code, 'format': 'array'}
+    )
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+@database
+def test_committed_temp_table_does_not_shadow_sandbox(client, sandbox):
+    # разные запросы, чтобы результат не брался из кэша /debug/
+    query = 'SELECT count(*) FROM tasks_solution WHERE {0} = {0}'
+    expected = debug(client, sandbox, query.format(0))['result']
+    debug(
+        client,
+        sandbox,
+        'CREATE TEMP TABLE tasks_solution (id int); '
+        'INSERT INTO tasks_solution VALUES (42); COMMIT'
+    )
+    # следующие запросы выполняются через то же соединение пула
+    for num in range(1, 3):
+        result = debug(client, sandbox, query.format(num))['result']
+        assert result == expected
+
+
+def get_pool_stats(client, name: str) -> Optional[dict]:
+    database = f'sandbox_{name}'
+    for stats in client.get('/stats/').get_json()['pools']:
+        if stats['database'] == database:
+            return stats
+    return None
+
+
+@database
+def test_pool_is_reused(client, sandbox):
+    for num in range(3):
+        debug(client, sandbox, f'SELECT {num} FROM tasks_solution LIMIT 1')
+    stats = get_pool_stats(client, sandbox)
+    assert stats['created'] == 1
+    assert stats['checkouts'] >= 3
+
+
+@database
+def test_pool_is_not_kept_for_unknown_sandbox(client):
+    name = f'pytest_nope_{uuid.uuid4().hex[:8]}'
+    assert debug(client, name, 'SELECT 1')['error']
+    assert get_pool_stats(client, name) is None
+
+
+@database
+def test_pool_is_invalidated_on_create_and_delete(client):
+    name = f'pytest_{uuid.uuid4().hex[:8]}'
+    data = {'name': name, 'filename': 'test.sql', 'wait': True}
+    response = client.post('/create/', json=data)
+    assert response.status_code == 200, response.get_json()
+    try:
+        debug(client, name, 'SELECT count(*) FROM tasks_task')
+        pool = pools.get_pool(f'sandbox_{name}')
+        # пересоздание закрывает пул прежней базы
+        response = client.post('/create/', json=dict(data, force=True))
+        assert response.status_code == 200, response.get_json()
+        assert pool.closed
+        debug(client, name, 'SELECT count(*) FROM tasks_task')
+        assert get_pool_stats(client, name)['created'] == 1
+    finally:
+        client.post(f'/delete/{name}/')
+    assert get_pool_stats(client, name) is None
+
+
+@database
+def test_broken_connection_is_not_checked_out():
+    pool = ConnectionPool(min_size=0, max_size=1)
+    try:
+        con = pool.getconn()
+        pid = con.get_backend_pid()
+        pool.putconn(con)
+        # соединение разорвано сервером, пока было свободным
+        admin = connect()
+        admin.autocommit = True
+        with admin.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', (pid,))
+        admin.close()
+        time.sleep(0.1)
+
+        con = pool.getconn()
+        with con.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            assert cursor.fetchone()[0] == 1
+        assert con.get_backend_pid() != pid
+        pool.putconn(con)
+        stats = pool.stats()
+        assert (stats.created, stats.discarded) == (2, 1)
+    finally:
+        pool.close()
@@ -0,0 +1,45 @@
+import pytest
+from tests.conftest import database
+
+TESTS = [{'data_in': 'SELECT created FROM tasks_task ORDER BY id LIMIT 3'}]
+# запрос меняет формат дат в транзакции проверки
+DATE_STYLE = (
+    'SELECT created FROM tasks_task '
+    "WHERE set_config('DateStyle', 'SQL, DMY', true) <> '' AND id > -{0} "
+    'ORDER BY id LIMIT 3'
+)
+CORRECT = 'SELECT created FROM tasks_task WHERE id > -{0} ORDER BY id LIMIT 3'
+
+
+def run(client, name: str, code: str, parallel: bool) -> dict:
+    response = client.post('/testing/', json={
+        'name': name,
+        'code': code,
+        'request_type': 'select',
+        'tests': TESTS * 2,
+        'parallel': parallel,
+    })
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+@database
+@pytest.mark.parametrize('parallel', [False, True])
+def test_user_settings_do_not_affect_references(client, sandbox, parallel):
+    # разные запросы, чтобы вердикты не брались из кэша
+    num = 1 + parallel * 10
+    first = run(client, sandbox, DATE_STYLE.format(num), parallel)
+    assert all(test['ok'] for test in first['tests']), first
+    second = run(client, sandbox, CORRECT.format(num), parallel)
+    assert all(test['ok'] for test in second['tests']), second
+
+    response = client.post('/testing/batch/', json={
+        'name': sandbox,
+        'codes': [DATE_STYLE.format(num + 1), CORRECT.format(num + 1)],
+        'request_type': 'select',
+        'tests': TESTS,
+        'parallel': parallel,
+    })
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [result['tests'][0]['ok'] for result in results] == [True, True]
@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from app.service.registry import SandboxRegistry
+
+
+def begin_refresh_in_threads(registry: SandboxRegistry, amount: int):
+    executor = ThreadPoolExecutor(max_workers=amount)
+    started = threading.Barrier(amount + 1)
+
+    def begin_refresh():
+        started.wait()
+        return registry.begin_refresh()
+
+    futures = [executor.submit(begin_refresh) for _ in range(amount)]
+    started.wait()
+    executor.shutdown(wait=False)
+    return futures
+
+
+def test_first_callers_wait_for_first_refresh():
+    registry = SandboxRegistry(refresh_interval=60)
+    assert registry.begin_refresh()
+    futures = begin_refresh_in_threads(registry, 3)
+    assert not any(future.done() for future in futures)
+    registry.reconcile([])
+    assert [future.result(5) for future in futures] == [False] * 3
+
+
+def test_waiting_caller_refreshes_after_failed_refresh():
+    registry = SandboxRegistry(refresh_interval=60)
+    assert registry.begin_refresh()
+    futures = begin_refresh_in_threads(registry, 2)
+    registry.cancel_refresh()
+    # сверку выполняет один из ожидающих, другой ожидает ее
+    done, waiting = wait(futures, timeout=5, return_when=FIRST_COMPLETED)
+    assert [future.result() for future in done] == [True]
+    registry.reconcile([])
+    assert [future.result(5) for future in waiting] == [False]
+
+
+def test_outdated_registry_is_refreshed_without_waiting():
+    registry = SandboxRegistry(refresh_interval=0)
+    assert registry.begin_refresh()
+    registry.reconcile([])
+    assert registry.begin_refresh()
+    # сверка уже выполняется, используется устаревший реестр
+    assert not registry.begin_refresh()
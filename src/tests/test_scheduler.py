@@ -0,0 +1,127 @@
+import asyncio
+from contextlib import AsyncExitStack
+from werkzeug.test import EnvironBuilder
+from app import main
+from app.service.pool import connect
+from app.service.scheduler import scheduler, shared_slots
+from tests.conftest import database
+
+
+def test_queue_full_is_rejected_with_retry_after(client, monkeypatch):
+    # запросы к песочнице не выполняются и не ожидают в очереди
+    monkeypatch.setattr(scheduler, 'max_active_per_sandbox', 0)
+    monkeypatch.setattr(scheduler, 'max_queue', 0)
+    rejected = scheduler.stats().rejected
+    response = client.get('/status/pytest_queue_full/')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert response.get_json()['error']
+    assert scheduler.stats().rejected == rejected + 1
+    assert scheduler.stats().active == 0
+
+
+def test_stream_closed_before_first_chunk_releases_slot(app, monkeypatch):
+    # ссылки на слоты сохраняются, чтобы слот не освобождался
+    # при сборке мусора незапущенного генератора
+    slots = []
+
+    def keep_slot(stream):
+        def wrapper(data, slot):
+            slots.append(slot)
+            return stream(data, slot)
+        return wrapper
+
+    for stream in ('stream_debug', 'stream_testing_batch'):
+        monkeypatch.setattr(
+            main, stream, keep_slot(getattr(main, stream))
+        )
+    requests = (
+        ('/debug/', {
+            'name': 'pytest_stream',
+            'code': 'SELECT 1',
+            'format': 'array',
+            'stream': True
+        }),
+        ('/testing/batch/', {
+            'name': 'pytest_stream',
+            'request_type': 'select',
+            'tests': [],
+            'codes': []
+        }),
+    )
+    for url, data in requests:
+        # тестовый клиент читает первую часть ответа,
+        # поэтому приложение вызывается напрямую
+        environ = EnvironBuilder(url, method='POST', json=data).get_environ()
+        status = []
+        body = app(environ, lambda *args: status.append(args[0]))
+        assert status == ['200 OK']
+        assert scheduler.stats().active == 1
+        # клиент отключился, генератор ответа не запускался
+        body.close()
+        assert scheduler.stats().active == 0
+    assert len(slots) == 2
+
+
+def test_async_stream_closed_before_first_chunk_releases_slot():
+    from app.asgi import SlotBody
+
+    released = []
+
+    async def stream():
+        async with slot:
+            yield 'chunk'
+
+    async def close_unstarted():
+        async with SlotBody(stream(), slot):
+            pass
+
+    slot = AsyncExitStack()
+    slot.callback(released.append, True)
+    asyncio.run(close_unstarted())
+    assert released == [True]
+
+
+def hold_shared_slots(con, size: int):
+    with con.cursor() as cursor:
+        cursor.execute(
+            'SELECT bool_and(pg_try_advisory_lock(hashtext(%(key)s), num)) '
+            'FROM generate_series(0, %(size)s - 1) AS num',
+            {'key': shared_slots.key, 'size': size}
+        )
+        return cursor.fetchone()[0]
+
+
+@database
+def test_shared_slots_limit_all_processes(client, monkeypatch):
+    monkeypatch.setattr(scheduler, 'timeout', 0.2)
+    # другой процесс сервера выполняет максимум запросов
+    con = connect()
+    con.autocommit = True
+    try:
+        assert hold_shared_slots(con, shared_slots.size)
+        rejected = scheduler.stats().rejected
+        response = client.get('/status/pytest_shared_slots/')
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        stats = scheduler.stats()
+        assert stats.rejected == rejected + 1
+        assert stats.active == 0 and stats.shared_active == 0
+    finally:
+        con.close()
+    response = client.get('/status/pytest_shared_slots/')
+    assert response.status_code != 429
+
+
+@database
+def test_shared_slots_are_released(client):
+    response = client.get('/status/pytest_shared_slots/')
+    assert response.status_code != 429
+    assert scheduler.stats().shared_active == 0
+    # все слоты, занятые запросом, освобождены
+    con = connect()
+    con.autocommit = True
+    try:
+        assert hold_shared_slots(con, shared_slots.size)
+    finally:
+        con.close()
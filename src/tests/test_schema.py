@@ -0,0 +1,28 @@
+import pytest
+from marshmallow import ValidationError
+from app.schema import CreateSchema, BulkCreateSchema
+
+
+@pytest.mark.parametrize('name', ['lease_demo', 'tpl_0123abcd'])
+def test_reserved_names_are_rejected(name):
+    with pytest.raises(ValidationError) as info:
+        CreateSchema().load({'name': name, 'filename': 'test.sql'})
+    assert 'name' in info.value.messages
+    with pytest.raises(ValidationError):
+        BulkCreateSchema().load(
+            {'items': [{'name': name, 'filename': 'test.sql'}]}
+        )
+
+
+def test_names_containing_prefixes_are_allowed():
+    data = CreateSchema().load({'name': 'demo_lease_tpl_', 'filename': 'f'})
+    assert data.name == 'demo_lease_tpl_'
+
+
+def test_create_view_rejects_reserved_name(client):
+    response = client.post(
+        '/create/',
+        json={'name': 'lease_demo', 'filename': 'test.sql', 'wait': True}
+    )
+    assert response.status_code == 400
+    assert 'name' in response.get_json()['details']
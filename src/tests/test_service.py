@@ -0,0 +1,138 @@
+import time
+import uuid
+import threading
+from app.service.leases import leases
+from app.service.main import PostgresqlService
+from app.service.pool import pools
+from app.service.registry import registry
+from tests.conftest import database
+
+
+def get_in_use() -> int:
+    return pools.get_pool().stats().in_use
+
+
+@database
+def test_advisory_lock_does_not_use_pool():
+    in_use = get_in_use()
+    with PostgresqlService._advisory_lock('pytest_lock') as locked:
+        assert locked
+        assert get_in_use() == in_use
+
+
+@database
+def test_advisory_lock_without_waiting():
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with PostgresqlService._advisory_lock('pytest_lock'):
+            held.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    try:
+        held.wait(10)
+        with PostgresqlService._advisory_lock(
+            'pytest_lock', wait=False
+        ) as locked:
+            assert not locked
+    finally:
+        release.set()
+        thread.join()
+    with PostgresqlService._advisory_lock('pytest_lock', wait=False) as locked:
+        assert locked
+
+
+@database
+def test_lost_sandbox_is_skipped_while_locked(monkeypatch):
+    name = 'pytest_lost'
+    comment = '{"durability": "unlogged", "server_started": "before"}'
+    monkeypatch.setattr(
+        PostgresqlService,
+        '_get_server_started',
+        classmethod(lambda cls: 'now')
+    )
+    evicted = []
+    monkeypatch.setattr(
+        PostgresqlService,
+        '_get_db_comment',
+        classmethod(lambda cls, db_name: evicted.append(db_name) or {})
+    )
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with PostgresqlService._advisory_lock(f'sandbox_{name}'):
+            held.set()
+            release.wait(10)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    try:
+        held.wait(10)
+        # заблокированная песочница пропускается без ожидания
+        PostgresqlService._evict_lost([(name, None, comment, 'active')])
+        assert evicted == []
+    finally:
+        release.set()
+        thread.join()
+    PostgresqlService._evict_lost([(name, None, comment, 'active')])
+    assert evicted == [f'sandbox_{name}']
+
+
+@database
+def test_usage_is_not_saved_while_sandbox_is_locked(sandbox):
+    db_name = PostgresqlService._get_db_name(sandbox)
+    registry.touch(sandbox)
+    last_used = registry.usage()[sandbox]
+    with PostgresqlService._advisory_lock(db_name):
+        PostgresqlService._save_usage()
+        comment = PostgresqlService._get_db_comment(db_name)
+        assert comment.get('last_used', '') < last_used
+    PostgresqlService._save_usage()
+    comment = PostgresqlService._get_db_comment(db_name)
+    assert comment['last_used'] == last_used
+
+
+@database
+def test_empty_limits_keep_current_sandbox(client, sandbox):
+    db_name = PostgresqlService._get_db_name(sandbox)
+    created_at = PostgresqlService._get_db_comment(db_name)['created_at']
+    response = client.post('/create/', json={
+        'name': sandbox,
+        'filename': 'test.sql',
+        'limits': {},
+        'wait': True,
+    })
+    assert response.status_code == 200, response.get_json()
+    comment = PostgresqlService._get_db_comment(db_name)
+    assert comment['created_at'] == created_at
+    assert 'limits' not in comment
+
+
+@database
+def test_clone_of_recreated_sandbox_is_not_leased(client):
+    name = f'pytest_{uuid.uuid4().hex[:8]}'
+    data = {'name': name, 'filename': 'test.sql', 'wait': True}
+    response = client.post('/create/', json=data)
+    assert response.status_code == 200, response.get_json()
+    try:
+        PostgresqlService.release(PostgresqlService.lease(name).lease)
+        # готовые копии создаются в фоне
+        deadline = time.monotonic() + 30
+        while not leases._ready.get(name) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert leases._ready.get(name)
+        limits = {'work_mem': '8MB'}
+        response = client.post(
+            '/create/', json=dict(data, limits=limits, force=True)
+        )
+        assert response.status_code == 200, response.get_json()
+        lease = PostgresqlService.lease(name).lease
+        comment = PostgresqlService._get_db_comment(
+            PostgresqlService._get_db_name(lease)
+        )
+        PostgresqlService.release(lease)
+        assert comment['limits'] == limits
+    finally:
+        client.post(f'/delete/{name}/')
@@ -0,0 +1,101 @@
+import pytest
+from app.service.registry import registry
+from app.service.main import PostgresqlService
+from app.service.pool import pools
+from tests.conftest import database
+
+TESTS = [
+    {'data_in': 'SELECT id FROM tasks_solution ORDER BY id LIMIT 5'},
+    {'data_in': 'SELECT count(*) FROM tasks_solution'},
+]
+
+
+def run(client, name: str, code: str) -> dict:
+    response = client.post('/testing/', json={
+        'name': name,
+        'code': code,
+        'request_type': 'select',
+        'tests': TESTS,
+    })
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def is_cached(result: dict) -> bool:
+    return all(test['duration'] is None for test in result['tests'])
+
+
+@database
+def test_equivalent_submission_reuses_verdicts(client, sandbox):
+    code = 'SELECT id FROM tasks_solution ORDER BY id LIMIT 5'
+    first = run(client, sandbox, code)
+    assert not is_cached(first)
+    second = run(client, sandbox, 'select ID\n  from tasks_solution\n'
+                                  ' order by id limit 5;')
+    assert is_cached(second)
+    assert second['tests'] == [
+        dict(test, duration=None) for test in first['tests']
+    ]
+
+
+@database
+def test_errors_are_not_shared_between_submissions(client, sandbox):
+    first = run(
+        client,
+        sandbox,
+        '/* answer of Ivan Petrov */ SELECT nope FROM tasks_solution'
+    )
+    assert 'Ivan Petrov' in first['tests'][0]['error']
+    second = run(client, sandbox, 'SELECT nope FROM tasks_solution')
+    assert not is_cached(second)
+    assert 'Ivan Petrov' not in second['tests'][0]['error']
+
+
+@database
+@pytest.mark.parametrize('code', [
+    'SELECT id FROM tasks_solution WHERE random() >= 0 ORDER BY id LIMIT 5',
+    'SELECT id FROM tasks_solution WHERE now() > now() - interval '
+    "'1 day' ORDER BY id LIMIT 5",
+    'SELECT id FROM tasks_solution WHERE id < '
+    '(SELECT count(*) FROM pg_stat_activity) ORDER BY id LIMIT 5',
+])
+def test_volatile_submission_is_not_cached(client, sandbox, code):
+    run(client, sandbox, code)
+    assert not is_cached(run(client, sandbox, code))
+
+
+@database
+def test_recreated_sandbox_invalidates_verdicts(client, sandbox):
+    code = 'SELECT id FROM tasks_solution ORDER BY id DESC LIMIT 5'
+    run(client, sandbox, code)
+    assert is_cached(run(client, sandbox, code))
+    response = client.post('/create/', json={
+        'name': sandbox,
+        'filename': 'test.sql',
+        'force': True,
+        'wait': True,
+    })
+    assert response.status_code == 200
+    assert not is_cached(run(client, sandbox, code))
+
+
+@database
+def test_sandbox_recreated_by_other_process_invalidates_verdicts(
+    client, sandbox, monkeypatch
+):
+    code = 'SELECT id FROM tasks_solution ORDER BY id DESC LIMIT 4'
+    run(client, sandbox, code)
+    assert is_cached(run(client, sandbox, code))
+    # другой процесс пересоздает песочницу: кэш и реестр
+    # этого процесса остаются прежними
+    stale = registry.get(sandbox)
+    monkeypatch.setattr(PostgresqlService, '_invalidate', pools.invalidate)
+    response = client.post('/create/', json={
+        'name': sandbox,
+        'filename': 'test.sql',
+        'force': True,
+        'wait': True,
+    })
+    assert response.status_code == 200
+    monkeypatch.setattr(registry, 'get', lambda name: stale)
+    assert not is_cached(run(client, sandbox, code))